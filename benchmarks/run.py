@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+r"""benchmark updating synthetic deploy repositories served by a local fake gitlab.
+
+Every scenario runs the fake gitlab and the update in processes of their
+own, so the peak memory reported is that of the update alone. The results
+are written as json, which --compare reads to report changes between runs.
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import typing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "tests"), os.path.dirname(os.path.abspath(__file__))]
+
+from deployversioner import deployversioner
+from deployversioner import metrics
+
+import fakegitlab
+import synthetic
+
+PROJECT_ID = 103
+PROJECT_NAME = "bench/deploy"
+BRANCH = "staging"
+
+def scenario_name(scenario: typing.Dict) -> str:
+    return ",".join("{}={}".format(key, scenario[key]) for key in
+        ["files", "documents", "latency", "page_size", "fetch_strategy", "execution", "max_concurrency"])
+
+def max_rss() -> int:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return usage if sys.platform == "darwin" else usage * 1024
+
+def serve(connection, scenario: typing.Dict) -> None:
+    project = fakegitlab.FakeProject(PROJECT_ID, PROJECT_NAME,
+        {BRANCH: synthetic.make_files(scenario["files"], scenario["documents"])})
+    with fakegitlab.FakeGitlab([project], scenario["latency"], max_per_page=scenario["page_size"]) as gitlab:
+        connection.send(gitlab.url)
+        # serve until the update is done
+        connection.recv()
+        connection.send(len(gitlab.requests))
+
+def update(connection, url: str, scenario: typing.Dict) -> None:
+    baseline_rss = max_rss()
+    recorded = metrics.enable()
+    start = time.perf_counter()
+    project_id, _ = deployversioner.resolve_project_id(url, "token", PROJECT_NAME, None)
+    gitlab_request = deployversioner.GitlabRequest(url, "token", project_id, BRANCH)
+    proposed_commits, changed_image_tags = deployversioner.change_image_tag(gitlab_request, "services",
+        "master-2", scenario["max_concurrency"], fetch_strategy=scenario["fetch_strategy"],
+        execution=scenario["execution"])
+    deployversioner.commit_changes(gitlab_request, proposed_commits, "master-2", changed_image_tags)
+    wall_seconds = time.perf_counter() - start
+    metrics.disable()
+    deployversioner.close_clients()
+    deployversioner.close_transform_pool()
+    http = recorded.to_json()["http"]
+    connection.send({"wall_seconds": wall_seconds, "files_changed": len(proposed_commits),
+        "requests_by_phase": {phase: stats["requests"] for phase, stats in http.items()},
+        "received_bytes": sum(stats["received_bytes"] for stats in http.values()),
+        "sent_bytes": sum(stats["sent_bytes"] for stats in http.values()),
+        "peak_rss_bytes": max_rss(), "baseline_rss_bytes": baseline_rss})
+
+def run_scenario(context, scenario: typing.Dict) -> typing.Dict:
+    server_connection, server_child = context.Pipe()
+    server = context.Process(target=serve, args=(server_child, scenario), daemon=True)
+    server.start()
+    try:
+        url = server_connection.recv()
+        client_connection, client_child = context.Pipe()
+        client = context.Process(target=update, args=(client_child, url, scenario))
+        client.start()
+        try:
+            result = client_connection.recv()
+        except EOFError:
+            raise RuntimeError("update of {} failed".format(scenario_name(scenario)))
+        client.join()
+        server_connection.send("done")
+        result["requests"] = server_connection.recv()
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+    return result
+
+def run(args: argparse.Namespace) -> typing.Dict:
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for files, documents, latency, page_size, fetch_strategy, execution in itertools.product(args.files,
+            args.documents, args.latency, args.page_size, args.fetch_strategy, args.execution):
+        scenario = {"files": files, "documents": documents, "latency": latency, "page_size": page_size,
+            "fetch_strategy": fetch_strategy, "execution": execution, "max_concurrency": args.max_concurrency}
+        runs = [run_scenario(context, scenario) for _ in range(args.repeat)]
+        # the fastest run is the least disturbed by anything else on the machine
+        best = min(runs, key=lambda r: r["wall_seconds"])
+        result = dict(scenario, name=scenario_name(scenario), **best)
+        result["wall_seconds_all"] = [r["wall_seconds"] for r in runs]
+        print("{name}: {wall_seconds:.3f}s, {requests} requests, {peak_rss_bytes} bytes peak rss".format(
+            **result), file=sys.stderr)
+        results.append(result)
+    return {"started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": git_commit(), "python": platform.python_version(), "results": results}
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old: typing.Dict, new: typing.Dict, threshold: float) -> bool:
+    r"""print the change of every scenario in both runs and return whether none got slower than threshold"""
+    old_results = {r["name"]: r for r in old["results"]}
+    ok = True
+    for result in new["results"]:
+        previous = old_results.get(result["name"])
+        if previous is None:
+            continue
+        ratio = result["wall_seconds"] / previous["wall_seconds"] if previous["wall_seconds"] else 1.0
+        regressed = ratio > threshold
+        ok = ok and not regressed
+        print("{}: wall time {:.3f}s -> {:.3f}s ({:+.0%}), requests {} -> {}, peak rss {} -> {}{}".format(
+            result["name"], previous["wall_seconds"], result["wall_seconds"], ratio - 1,
+            previous["requests"], result["requests"], previous["peak_rss_bytes"], result["peak_rss_bytes"],
+            " REGRESSED" if regressed else ""))
+    return ok
+
+def positive_int(value: str) -> int:
+    return deployversioner.positive_int(value)
+
+def setup_args(argv: typing.Optional[typing.List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--files", type=positive_int, nargs="+", default=[10, 100, 1000],
+        help="numbers of manifests in the synthetic repository (default: %(default)s)")
+    parser.add_argument("--documents", type=positive_int, nargs="+", default=[3],
+        help="numbers of yaml documents per manifest (default: %(default)s)")
+    parser.add_argument("--latency", type=float, nargs="+", default=[0.0, 0.02],
+        help="seconds added to every request by the fake gitlab (default: %(default)s)")
+    parser.add_argument("--page-size", type=positive_int, nargs="+", default=[100],
+        help="largest page of the tree served (default: %(default)s)")
+    parser.add_argument("--fetch-strategy", choices=deployversioner.FETCH_STRATEGIES, nargs="+",
+        default=["rest"], help="fetch strategies to run (default: %(default)s)")
+    parser.add_argument("--execution", choices=deployversioner.EXECUTION_MODES, nargs="+",
+        default=[deployversioner.DEFAULT_EXECUTION], help="execution modes to run (default: %(default)s)")
+    parser.add_argument("--max-concurrency", type=positive_int, default=deployversioner.DEFAULT_MAX_CONCURRENCY,
+        help="number of files to fetch and rewrite in parallel (default: %(default)s)")
+    parser.add_argument("--repeat", type=positive_int, default=3,
+        help="runs of every scenario, the fastest is reported (default: %(default)s)")
+    parser.add_argument("-o", "--output",
+        help="file to write the results to (default: stdout)")
+    parser.add_argument("--compare", metavar="RESULTS",
+        help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+        help="ratio of wall times counted as a regression by --compare (default: %(default)s)")
+    return parser.parse_args(argv)
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    args = setup_args(argv)
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as fp:
+            old = json.load(fp)
+        if not compare(old, results, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+r"""synthetic deploy repositories for the benchmarks"""
+
+import random
+import typing
+
+IMAGE = "docker-io.dbc.dk/bench-service"
+
+DEPLOYMENT = """apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: {name}
+  labels:
+    app: {name}
+spec:
+  replicas: 2
+  selector:
+    matchLabels:
+      app: {name}
+  template:
+    metadata:
+      labels:
+        app: {name}
+    spec:
+      containers:
+      - name: {name}
+        image: {image}:{tag}
+        ports:
+        - containerPort: 8080
+        env:
+        - name: JAVA_MAX_HEAP_SIZE
+          value: 2G
+        resources:
+          limits:
+            memory: 3Gi
+"""
+
+STATEFUL_SET = """apiVersion: apps/v1
+kind: StatefulSet
+metadata:
+  name: {name}
+spec:
+  serviceName: {name}
+  replicas: 3
+  selector:
+    matchLabels:
+      app: {name}
+  template:
+    metadata:
+      labels:
+        app: {name}
+    spec:
+      containers:
+      - name: {name}
+        image: {image}:{tag}
+        volumeMounts:
+        - name: data
+          mountPath: /data
+  volumeClaimTemplates:
+  - metadata:
+      name: data
+    spec:
+      accessModes: ["ReadWriteOnce"]
+      resources:
+        requests:
+          storage: 10Gi
+"""
+
+CRON_JOB = """apiVersion: batch/v1
+kind: CronJob
+metadata:
+  name: {name}
+spec:
+  schedule: "*/15 * * * *"
+  jobTemplate:
+    spec:
+      template:
+        spec:
+          restartPolicy: OnFailure
+          containers:
+          - name: {name}
+            image: {image}:{tag}
+            args: ["--once"]
+"""
+
+JOB = """apiVersion: batch/v1
+kind: Job
+metadata:
+  name: {name}
+spec:
+  template:
+    spec:
+      restartPolicy: Never
+      containers:
+      - name: {name}
+        image: {image}:{tag}
+"""
+
+SERVICE = """apiVersion: v1
+kind: Service
+metadata:
+  name: {name}
+spec:
+  selector:
+    app: {name}
+  ports:
+  - port: 80
+    targetPort: 8080
+"""
+
+CONFIG_MAP = """apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: {name}
+data:
+  application.properties: |
+    server.port=8080
+    image={image}:{tag}
+"""
+
+WORKLOADS = [DEPLOYMENT, STATEFUL_SET, CRON_JOB, JOB]
+OTHERS = [SERVICE, CONFIG_MAP]
+
+def make_file(number: int, documents: int, tag: str, rng: random.Random) -> str:
+    r"""return a manifest of documents of mixed kinds, at least one of them a workload using IMAGE"""
+    parts = []
+    for n in range(documents):
+        name = "service{}-{}".format(number, n)
+        template = rng.choice(WORKLOADS) if n == 0 else rng.choice(WORKLOADS + OTHERS)
+        parts.append(template.format(name=name, image=IMAGE, tag=tag))
+    return "---\n".join(parts)
+
+def make_files(files: int, documents: int, tag: str = "master-1",
+        seed: int = 0) -> typing.Dict[str, str]:
+    r"""return the path and contents of the files of a synthetic deploy repository.
+
+    Besides files manifests, the repository has a readme and a script like
+    real deploy repositories, which are listed but never rewritten.
+    """
+    rng = random.Random(seed)
+    result = {"services/service{:05d}.yml".format(n): make_file(n, documents, tag, rng) for n in range(files)}
+    result["services/README.md"] = "# services\n"
+    result["services/deploy.sh"] = "#!/bin/sh\nkubectl apply -f .\n"
+    return result
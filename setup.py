@@ -14,6 +14,7 @@ setup(name="deployversioner",
     install_requires=["pyyaml", "requests", "urllib3>=1.26"],
     entry_points=
         {"console_scripts": [
-            "set-new-version = deployversioner.deployversioner:main"
+            "set-new-version = deployversioner.deployversioner:main",
+            "deployversioner = deployversioner.cli:main"
         ]}
     )
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import logging
+import typing
+
+import yaml
+
+from deployversioner import cache
+from deployversioner import deployversioner
+
+logger = logging.getLogger(__name__)
+
+BatchItem = collections.namedtuple("BatchItem", ["project", "branch", "path", "tag"])
+
+BatchResult = collections.namedtuple("BatchResult", ["item", "outcome", "message", "files"])
+
+COMMITTED = "committed"
+UNCHANGED = "unchanged"
+DRY_RUN = "dry-run"
+ERROR = "error"
+
+# number of projects updated at the same time
+DEFAULT_MAX_PARALLEL_PROJECTS = 4
+
+def read_manifest(stream: typing.IO, default_branch: str = "staging") -> typing.List[BatchItem]:
+    r"""read the updates of a batch from a yaml or json list.
+
+    Every update is a mapping with a project, a path and a tag, and
+    optionally a branch, e.g.
+
+        - project: metascrum/rrflow-deploy
+          path: services/rrflow.yml
+          tag: master-9
+          branch: prod
+    """
+    try:
+        updates = yaml.safe_load(stream)
+    except yaml.YAMLError as e:
+        raise deployversioner.VersionerError("unable to read batch manifest: {}".format(e))
+    return parse_updates(updates, default_branch)
+
+def parse_updates(updates: typing.Any, default_branch: str = "staging") -> typing.List[BatchItem]:
+    r"""return the items of a list of updates as read by read_manifest"""
+    if not isinstance(updates, list):
+        raise deployversioner.VersionerError("batch manifest must be a list of updates")
+    items = []
+    for n, update in enumerate(updates):
+        if not isinstance(update, dict) or any(k not in update for k in ["project", "path", "tag"]):
+            raise deployversioner.VersionerError(
+                "update {} of batch manifest must have a project, a path and a tag".format(n + 1))
+        items.append(BatchItem(str(update["project"]), str(update.get("branch", default_branch)),
+            str(update["path"]), str(update["tag"])))
+    return items
+
+def group_items(items: typing.List[BatchItem]) -> typing.Dict[typing.Tuple[str, str], typing.List[BatchItem]]:
+    r"""group items by project and branch, keeping the order of the items"""
+    groups: typing.Dict[typing.Tuple[str, str], typing.List[BatchItem]] = collections.OrderedDict()
+    for item in items:
+        groups.setdefault((item.project, item.branch), []).append(item)
+    return groups
+
+def run_item(gitlab_request: deployversioner.GitlabRequest, item: BatchItem, max_concurrency: int,
+        blob_cache: typing.Optional[cache.BlobCache], dry_run: bool, fetch_strategy: str,
+        graphql_batch_size: int, archive_threshold: int,
+        execution: str = deployversioner.DEFAULT_EXECUTION) -> BatchResult:
+    try:
+        proposed_commits, changed_image_tags = deployversioner.change_image_tag(gitlab_request,
+            item.path, item.tag, max_concurrency, blob_cache, fetch_strategy, graphql_batch_size,
+            archive_threshold, execution)
+        files = [c["file_path"] for c in proposed_commits]
+        if dry_run:
+            if len(proposed_commits) == 0:
+                return BatchResult(item, UNCHANGED, "no changes found.", [])
+            return BatchResult(item, DRY_RUN, "", files)
+        deployversioner.commit_changes(gitlab_request, proposed_commits, item.tag, changed_image_tags)
+        return BatchResult(item, COMMITTED, "", files)
+    except deployversioner.VersionUnchangedException as e:
+        return BatchResult(item, UNCHANGED, str(e), [])
+    except deployversioner.VersionerProjectNotFound:
+        raise
+    except (deployversioner.VersionerError, yaml.YAMLError) as e:
+        return BatchResult(item, ERROR, str(e), [])
+
+def run_group(gitlab_url: str, api_token: str, items: typing.List[BatchItem], max_concurrency: int,
+        blob_cache: typing.Optional[cache.BlobCache],
+        project_id_cache: typing.Optional[cache.ProjectIdCache], dry_run: bool, fetch_strategy: str,
+        graphql_batch_size: int, archive_threshold: int,
+        execution: str = deployversioner.DEFAULT_EXECUTION) -> typing.List[BatchResult]:
+    r"""update the items of one project and branch one after another.
+
+    They are not updated in parallel since every commit moves the branch
+    the next one is made on.
+    """
+    project, branch = items[0].project, items[0].branch
+    def run(project_id: int) -> typing.List[BatchResult]:
+        gitlab_request = deployversioner.GitlabRequest(gitlab_url, api_token, project_id, branch)
+        return [run_item(gitlab_request, item, max_concurrency, blob_cache, dry_run, fetch_strategy,
+            graphql_batch_size, archive_threshold, execution) for item in items]
+    try:
+        return deployversioner.run_with_project_id(gitlab_url, api_token, project,
+            project_id_cache, run)
+    except deployversioner.VersionerError as e:
+        return [BatchResult(item, ERROR, str(e), []) for item in items]
+
+def format_merged_commit_message(bumps: typing.List[typing.Tuple[str, typing.Set[str]]]) -> str:
+    r"""return the message of a commit made of bumps of tags, each a new tag and the tags it replaced"""
+    tags = list(collections.OrderedDict((tag, None) for tag, _ in bumps))
+    if len(tags) == 1:
+        return deployversioner.format_commit_message(tags[0], set().union(*[old for _, old in bumps]))
+    lines = ["Bump docker tag from {} to {}".format(old, tag) for tag, old_tags in bumps for old in sorted(old_tags)]
+    return "Bump docker tags to {}\n\n{}".format(", ".join(tags), "\n".join(lines))
+
+def run_merged_group(gitlab_url: str, api_token: str, items: typing.List[BatchItem],
+        max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        project_id_cache: typing.Optional[cache.ProjectIdCache] = None,
+        dry_run: bool = False, fetch_strategy: str = "rest",
+        graphql_batch_size: int = deployversioner.DEFAULT_GRAPHQL_BATCH_SIZE,
+        archive_threshold: int = deployversioner.DEFAULT_ARCHIVE_THRESHOLD,
+        execution: str = deployversioner.DEFAULT_EXECUTION) -> typing.List[BatchResult]:
+    r"""apply the items of one project and branch as a single commit.
+
+    The changes of the items are merged in order, so a file changed by
+    several items gets the tag of the last of them.
+    """
+    project, branch = items[0].project, items[0].branch
+    def run(project_id: int) -> typing.List[BatchResult]:
+        gitlab_request = deployversioner.GitlabRequest(gitlab_url, api_token, project_id, branch)
+        changes: typing.Dict[str, typing.Dict] = collections.OrderedDict()
+        bumps = []
+        results: typing.List[typing.Optional[BatchResult]] = []
+        files: typing.List[typing.List[str]] = []
+        for item in items:
+            try:
+                proposed_commits, changed_image_tags = deployversioner.change_image_tag(gitlab_request,
+                    item.path, item.tag, max_concurrency, blob_cache, fetch_strategy, graphql_batch_size,
+                    archive_threshold, execution)
+            except deployversioner.VersionUnchangedException as e:
+                results.append(BatchResult(item, UNCHANGED, str(e), []))
+                files.append([])
+                continue
+            except deployversioner.VersionerProjectNotFound:
+                raise
+            except (deployversioner.VersionerError, yaml.YAMLError) as e:
+                results.append(BatchResult(item, ERROR, str(e), []))
+                files.append([])
+                continue
+            for proposed_commit in proposed_commits:
+                changes.pop(proposed_commit["file_path"], None)
+                changes[proposed_commit["file_path"]] = dict(proposed_commit, tag=item.tag)
+            if changed_image_tags:
+                bumps.append((item.tag, changed_image_tags))
+            results.append(None)
+            files.append([c["file_path"] for c in proposed_commits])
+        def result(item: BatchItem, item_files: typing.List[str], outcome: str, message: str = "") -> BatchResult:
+            # files changed by a later item are reported with that item
+            item_files = [f for f in item_files if changes[f]["tag"] == item.tag]
+            if not item_files:
+                return BatchResult(item, UNCHANGED, "no changes found.", [])
+            return BatchResult(item, outcome, message, item_files)
+        if not changes:
+            return [r or BatchResult(item, UNCHANGED, "no changes found.", [])
+                for item, r in zip(items, results)]
+        if dry_run:
+            return [r or result(item, f, DRY_RUN) for item, r, f in zip(items, results, files)]
+        try:
+            deployversioner.commit_changes(gitlab_request, list(changes.values()), bumps[-1][0],
+                set(), commit_message=format_merged_commit_message(bumps))
+        except deployversioner.VersionUnchangedException as e:
+            return [r or BatchResult(item, UNCHANGED, str(e), []) for item, r in zip(items, results)]
+        except deployversioner.VersionerError as e:
+            return [r or result(item, f, ERROR, str(e)) for item, r, f in zip(items, results, files)]
+        return [r or result(item, f, COMMITTED) for item, r, f in zip(items, results, files)]
+    try:
+        return deployversioner.run_with_project_id(gitlab_url, api_token, project,
+            project_id_cache, run)
+    except deployversioner.VersionerError as e:
+        return [BatchResult(item, ERROR, str(e), []) for item in items]
+
+def run_batch(gitlab_url: str, api_token: str, items: typing.List[BatchItem],
+        max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY,
+        max_parallel_projects: int = DEFAULT_MAX_PARALLEL_PROJECTS,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        project_id_cache: typing.Optional[cache.ProjectIdCache] = None,
+        dry_run: bool = False, fetch_strategy: str = "rest",
+        graphql_batch_size: int = deployversioner.DEFAULT_GRAPHQL_BATCH_SIZE,
+        archive_threshold: int = deployversioner.DEFAULT_ARCHIVE_THRESHOLD,
+        execution: str = deployversioner.DEFAULT_EXECUTION) -> typing.List[BatchResult]:
+    r"""apply every update in items and return their results in the same order.
+
+    Updates are grouped by project and branch. The groups are run in
+    parallel and share one connection pool, project lookups and caches.
+    """
+    # every project fetches files in parallel, so the pool is sized for all of them
+    deployversioner.get_client(gitlab_url, api_token, max_concurrency * max_parallel_projects)
+    groups = group_items(items)
+    results: typing.Dict[BatchItem, typing.List[BatchResult]] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel_projects) as executor:
+        futures = {key: executor.submit(run_group, gitlab_url, api_token, group, max_concurrency,
+            blob_cache, project_id_cache, dry_run, fetch_strategy, graphql_batch_size, archive_threshold,
+            execution) for key, group in groups.items()}
+        for key, future in futures.items():
+            for result in future.result():
+                logger.info("%s %s %s: %s", result.item.project, result.item.branch,
+                    result.item.path, result.outcome)
+                results.setdefault(result.item, []).append(result)
+    # the same update can appear more than once in the manifest
+    return [results[item].pop(0) for item in items]
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+import threading
+import time
+import typing
+
+# 256 MiB
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+def default_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME",
+        os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "deployversioner")
+
+def write_atomically(path: str, data: bytes) -> None:
+    r"""write data to path so readers never see a partially written file"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+class BlobCache:
+    r"""on-disk cache of file contents keyed by the sha of their git blob.
+
+    Since a blob sha is the hash of the contents, an entry never goes stale
+    and can be shared between branches and projects. Besides the raw
+    contents an entry holds the image references found in the file, so a
+    cached file doesn't have to be parsed again. The least recently used
+    entries are removed when the cache grows beyond max_size bytes.
+
+    :param directory to keep the cache in, blobs are stored in its blobs subdirectory
+    :param max_size in bytes of all cached entries
+    """
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = os.path.join(directory, "blobs")
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size: typing.Optional[int] = None
+
+    def path(self, blob_id: str) -> str:
+        return os.path.join(self.directory, blob_id[:2], "{}.json".format(blob_id))
+
+    def __contains__(self, blob_id: str) -> bool:
+        return os.path.exists(self.path(blob_id))
+
+    def get(self, blob_id: str) -> typing.Optional[typing.Tuple[str, typing.Optional[typing.List]]]:
+        r"""return the contents and image references of blob_id or None if it isn't cached.
+
+        The references are None if they were never stored for the blob.
+        """
+        path = self.path(blob_id)
+        try:
+            with open(path, "rb") as fp:
+                entry = json.loads(fp.read().decode("utf8"))
+            # the modification time is the last use for the eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry["content"], entry["references"]
+
+    def put(self, blob_id: str, content: str, references: typing.Optional[typing.List] = None) -> None:
+        data = json.dumps({"content": content, "references": references}).encode("utf8")
+        path = self.path(blob_id)
+        with self._lock:
+            size = self.size()
+            try:
+                size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            write_atomically(path, data)
+            self._size = size + len(data)
+            if self._size > self.max_size:
+                self.evict()
+
+    def size(self) -> int:
+        if self._size is None:
+            self._size = sum(size for _, _, size in self.entries())
+        return self._size
+
+    def entries(self) -> typing.List[typing.Tuple[str, float, int]]:
+        r"""return the path, last use and size of every entry"""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for subdirectory in os.scandir(self.directory):
+            if not subdirectory.is_dir():
+                continue
+            for entry in os.scandir(subdirectory.path):
+                if entry.name.endswith(".json"):
+                    try:
+                        stat = entry.stat()
+                        entries.append((entry.path, stat.st_mtime, stat.st_size))
+                    except FileNotFoundError:
+                        pass
+        return entries
+
+    def evict(self) -> None:
+        r"""remove the least recently used entries until the cache is below max_size.
+
+        Expects the caller to hold the lock.
+        """
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        size = sum(file_size for _, _, file_size in entries)
+        for path, _, file_size in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        self._size = size
+
+# one day
+DEFAULT_PROJECT_ID_TTL = 24 * 60 * 60
+
+class ProjectIdCache:
+    r"""on-disk cache of the numeric ids of gitlab projects by name.
+
+    Entries expire after ttl seconds and should be invalidated by the user
+    of the cache when gitlab no longer knows a cached id, e.g. after the
+    project was moved.
+
+    :param directory to keep the cache in
+    :param ttl in seconds of an entry
+    """
+    def __init__(self, directory: str, ttl: float = DEFAULT_PROJECT_ID_TTL):
+        self.path = os.path.join(directory, "project-ids.json")
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(gitlab_url: str, project_name: str) -> str:
+        return "{} {}".format(gitlab_url, project_name)
+
+    def read(self) -> typing.Dict[str, typing.Dict]:
+        try:
+            with open(self.path, "rb") as fp:
+                return json.loads(fp.read().decode("utf8"))
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, gitlab_url: str, project_name: str) -> typing.Optional[int]:
+        entry = self.read().get(self.key(gitlab_url, project_name))
+        if entry is None or time.time() - entry["resolved_at"] > self.ttl:
+            return None
+        return entry["id"]
+
+    def put(self, gitlab_url: str, project_name: str, project_id: int) -> None:
+        with self._lock:
+            entries = self.read()
+            entries[self.key(gitlab_url, project_name)] = {"id": project_id,
+                "resolved_at": time.time()}
+            write_atomically(self.path, json.dumps(entries).encode("utf8"))
+
+    def invalidate(self, gitlab_url: str, project_name: str) -> None:
+        with self._lock:
+            entries = self.read()
+            if entries.pop(self.key(gitlab_url, project_name), None) is not None:
+                write_atomically(self.path, json.dumps(entries).encode("utf8"))
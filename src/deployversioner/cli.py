@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import sys
+import typing
+
+from deployversioner import batch
+from deployversioner import cache
+from deployversioner import deployversioner
+from deployversioner import index
+from deployversioner import plan
+from deployversioner import promote
+from deployversioner import service
+from deployversioner import yamlbackend
+
+logger = logging.getLogger(__name__)
+
+def add_common_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--gitlab-api-token", default=os.environ.get("GITLAB_API_TOKEN"),
+        help="private token for accessing the gitlab api (default: $GITLAB_API_TOKEN)")
+    parser.add_argument("--gitlab-url", default="https://gitlab.dbc.dk")
+    parser.add_argument("--max-concurrency", type=deployversioner.positive_int,
+        default=deployversioner.DEFAULT_MAX_CONCURRENCY,
+        help="number of files to fetch and rewrite in parallel (default: %(default)s)")
+    parser.add_argument("--fetch-strategy", choices=deployversioner.FETCH_STRATEGIES, default="rest",
+        help="fetch every file with its own rest request, batches of files with graphql, all files "
+             "in one archive or choose between rest and archive by the number of files (default: %(default)s)")
+    parser.add_argument("--graphql-batch-size", type=deployversioner.positive_int,
+        default=deployversioner.DEFAULT_GRAPHQL_BATCH_SIZE,
+        help="number of files fetched per graphql request (default: %(default)s)")
+    parser.add_argument("--archive-threshold", type=deployversioner.positive_int,
+        default=deployversioner.DEFAULT_ARCHIVE_THRESHOLD,
+        help="number of files above which the auto fetch strategy downloads an archive (default: %(default)s)")
+    parser.add_argument("--execution", choices=deployversioner.EXECUTION_MODES,
+        default=deployversioner.DEFAULT_EXECUTION,
+        help="rewrite files one after another, in the threads fetching them or in a pool of "
+             "processes (default: %(default)s)")
+    parser.add_argument("--cache-dir", default=cache.default_cache_dir(),
+        help="directory to cache files and lookups in between runs (default: %(default)s)")
+    parser.add_argument("--cache-max-size", type=deployversioner.positive_int,
+        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="size in MiB the file cache is kept below (default: %(default)s)")
+    parser.add_argument("--project-id-ttl", type=deployversioner.positive_int,
+        default=cache.DEFAULT_PROJECT_ID_TTL,
+        help="seconds to cache the id of a project (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+        help="don't read or write the cache")
+    deployversioner.add_metrics_arguments(parser)
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="print what is being done to stderr")
+
+def get_caches(args: argparse.Namespace) -> typing.Tuple[typing.Optional[cache.BlobCache],
+        typing.Optional[cache.ProjectIdCache]]:
+    if args.no_cache:
+        return None, None
+    return (cache.BlobCache(args.cache_dir, args.cache_max_size * 1024 * 1024),
+        cache.ProjectIdCache(args.cache_dir, args.project_id_ttl))
+
+def print_results(results: typing.List[batch.BatchResult]) -> int:
+    for result in results:
+        print(json.dumps({"project": result.item.project, "branch": result.item.branch,
+            "path": result.item.path, "tag": result.item.tag, "outcome": result.outcome,
+            "message": result.message, "files": result.files}))
+    return 1 if any(r.outcome == batch.ERROR for r in results) else 0
+
+def run_batch(args: argparse.Namespace) -> int:
+    if args.manifest == "-":
+        items = batch.read_manifest(sys.stdin, args.branch)
+    else:
+        with open(args.manifest) as fp:
+            items = batch.read_manifest(fp, args.branch)
+    blob_cache, project_id_cache = get_caches(args)
+    results = batch.run_batch(args.gitlab_url, args.gitlab_api_token, items, args.max_concurrency,
+        args.max_parallel_projects, blob_cache, project_id_cache, args.dry_run, args.fetch_strategy,
+        args.graphql_batch_size, args.archive_threshold, args.execution)
+    return print_results(results)
+
+def run_promote(args: argparse.Namespace) -> int:
+    blob_cache, project_id_cache = get_caches(args)
+    results = promote.run_promotion(args.gitlab_url, args.gitlab_api_token, args.project_name, args.targets,
+        args.image_tag, args.max_concurrency, blob_cache, project_id_cache, args.dry_run, args.fetch_strategy,
+        args.graphql_batch_size, args.archive_threshold, args.execution)
+    return print_results(results)
+
+def index_filename(args: argparse.Namespace) -> typing.Optional[str]:
+    if args.no_cache:
+        return None
+    return index.index_file(args.cache_dir, args.gitlab_url, args.project_name, args.branch)
+
+def run_index(args: argparse.Namespace) -> int:
+    blob_cache, project_id_cache = get_caches(args)
+    def run(project_id: int) -> index.ImageIndex:
+        gitlab_request = deployversioner.GitlabRequest(args.gitlab_url, args.gitlab_api_token,
+            project_id, args.branch)
+        filename = index_filename(args)
+        if args.rebuild:
+            image_index = index.build_index(gitlab_request, args.path, blob_cache, args.max_concurrency)
+            if filename is not None:
+                index.save_index(filename, image_index)
+            return image_index
+        return index.get_index(gitlab_request, args.path, filename, blob_cache, args.max_concurrency)
+    image_index = deployversioner.run_with_project_id(args.gitlab_url, args.gitlab_api_token,
+        args.project_name, project_id_cache, run)
+    print(json.dumps({name: [e._asdict() for e in entries]
+        for name, entries in sorted(image_index.images().items())}, indent=2))
+    return 0
+
+def run_bump(args: argparse.Namespace) -> int:
+    blob_cache, project_id_cache = get_caches(args)
+    filename = index_filename(args)
+    def run(project_id: int) -> None:
+        gitlab_request = deployversioner.GitlabRequest(args.gitlab_url, args.gitlab_api_token,
+            project_id, args.branch)
+        image_index = index.get_index(gitlab_request, args.path, filename, blob_cache, args.max_concurrency)
+        try:
+            proposed_commits, changed_image_tags = index.bump_image(gitlab_request, image_index,
+                args.image, args.image_tag, args.max_concurrency)
+            if args.dry_run:
+                deployversioner.print_proposed_commits(proposed_commits)
+            else:
+                commit = deployversioner.commit_changes(gitlab_request, proposed_commits, args.image_tag,
+                    changed_image_tags, rebase=index.rebase_image)
+                index.record_commit(image_index, proposed_commits, commit)
+        finally:
+            # files found to have changed were indexed again
+            if filename is not None:
+                index.save_index(filename, image_index)
+    deployversioner.run_with_project_id(args.gitlab_url, args.gitlab_api_token, args.project_name,
+        project_id_cache, run)
+    return 0
+
+def run_plan(args: argparse.Namespace) -> int:
+    blob_cache, project_id_cache = get_caches(args)
+    def run(project_id: int) -> plan.Plan:
+        gitlab_request = deployversioner.GitlabRequest(args.gitlab_url, args.gitlab_api_token,
+            project_id, args.branch)
+        return plan.make_plan(gitlab_request, args.deployment_configuration, args.image_tag,
+            args.max_concurrency, blob_cache, args.fetch_strategy, args.graphql_batch_size,
+            args.archive_threshold, args.execution)
+    change_plan = deployversioner.run_with_project_id(args.gitlab_url, args.gitlab_api_token,
+        args.project_name, project_id_cache, run)
+    plan.save_plan(args.plan_file, change_plan)
+    plan.print_plan(change_plan)
+    return 0
+
+def run_apply(args: argparse.Namespace) -> int:
+    change_plan = plan.load_plan(args.plan_file)
+    plan.apply_plan(change_plan.gitlab_request(args.gitlab_api_token), change_plan)
+    return 0
+
+def positive_float(value: str) -> float:
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("{} is not a positive number".format(value))
+    return number
+
+def run_service(args: argparse.Namespace) -> int:
+    blob_cache, project_id_cache = get_caches(args)
+    # connections are kept open between commits
+    deployversioner.get_client(args.gitlab_url, args.gitlab_api_token,
+        args.max_concurrency * args.max_parallel_projects)
+    runner = service.Service(functools.partial(batch.run_merged_group, args.gitlab_url,
+        args.gitlab_api_token, max_concurrency=args.max_concurrency, blob_cache=blob_cache,
+        project_id_cache=project_id_cache, dry_run=args.dry_run, fetch_strategy=args.fetch_strategy,
+        graphql_batch_size=args.graphql_batch_size, archive_threshold=args.archive_threshold,
+        execution=args.execution),
+        args.debounce, args.max_delay, args.max_parallel_projects)
+    handler = service.WebhookHandler(runner, args.branch, args.webhook_secret)
+    try:
+        asyncio.run(service.serve(runner, handler, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.close()
+    return 0
+
+def setup_args(argv: typing.Optional[typing.List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="deployversioner")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    batch_parser = subparsers.add_parser("batch",
+        help="apply many image tag updates, possibly to many projects, in one run")
+    batch_parser.add_argument("manifest",
+        help="yaml or json file with a list of updates, each with a project, path, tag "
+             "and optionally a branch. - reads the manifest from stdin")
+    batch_parser.add_argument("-b", "--branch", default="staging",
+        help="branch of updates that don't name one (default: %(default)s)")
+    batch_parser.add_argument("--max-parallel-projects", type=deployversioner.positive_int,
+        default=batch.DEFAULT_MAX_PARALLEL_PROJECTS,
+        help="number of projects and branches to update at the same time (default: %(default)s)")
+    batch_parser.add_argument("-n", "--dry-run", action="store_true",
+        help="don't commit changes, only report what would be changed")
+    add_common_arguments(batch_parser)
+    batch_parser.set_defaults(run=run_batch)
+
+    promote_parser = subparsers.add_parser("promote",
+        help="set an image tag in several branches and paths of a project, with a commit per branch")
+    promote_parser.add_argument("project_name", metavar="project-name",
+        help="Name of project (including group hierarchy), e.g., metascrum/rrflow-deploy")
+    promote_parser.add_argument("image_tag", metavar="image-tag",
+        help="new tag to commit")
+    promote_parser.add_argument("targets", metavar="branch:path", type=promote.parse_target, nargs="+",
+        help="branch and file or dir to change, e.g. prod:services/rrflow.yml. an empty path changes "
+             "the whole branch")
+    promote_parser.add_argument("-n", "--dry-run", action="store_true",
+        help="don't commit changes, only report what would be changed")
+    add_common_arguments(promote_parser)
+    promote_parser.set_defaults(run=run_promote)
+
+    index_parser = subparsers.add_parser("index",
+        help="index which files use which images in a project, or refresh the index, and print it")
+    index_parser.add_argument("project_name", metavar="project-name",
+        help="Name of project (including group hierarchy), e.g., metascrum/rrflow-deploy")
+    index_parser.add_argument("-b", "--branch", default="staging")
+    index_parser.add_argument("--path", default="",
+        help="directory to index (default: the whole branch)")
+    index_parser.add_argument("--rebuild", action="store_true",
+        help="scan every file instead of refreshing a stored index with the files changed since")
+    add_common_arguments(index_parser)
+    index_parser.set_defaults(run=run_index)
+
+    bump_parser = subparsers.add_parser("bump",
+        help="set the tag of an image by name in the files that use it according to the index")
+    bump_parser.add_argument("project_name", metavar="project-name",
+        help="Name of project (including group hierarchy), e.g., metascrum/rrflow-deploy")
+    bump_parser.add_argument("image",
+        help="name of the image without tag, e.g. docker-io.dbc.dk/rrflow")
+    bump_parser.add_argument("image_tag", metavar="image-tag",
+        help="new tag to commit")
+    bump_parser.add_argument("-b", "--branch", default="staging")
+    bump_parser.add_argument("--path", default="",
+        help="directory the index covers (default: the whole branch)")
+    bump_parser.add_argument("-n", "--dry-run", action="store_true",
+        help="don't commit changes, print them to stdout")
+    add_common_arguments(bump_parser)
+    bump_parser.set_defaults(run=run_bump)
+
+    plan_parser = subparsers.add_parser("plan",
+        help="write the changes of an image tag update to a plan file without committing them")
+    plan_parser.add_argument("project_name", metavar="project-name",
+        help="Name of project (including group hierarchy), e.g., metascrum/rrflow-deploy")
+    plan_parser.add_argument("deployment_configuration", metavar="deployment-configuration",
+        help="filename or dir of deployment configuration to change")
+    plan_parser.add_argument("image_tag", metavar="image-tag",
+        help="new tag to commit")
+    plan_parser.add_argument("plan_file", metavar="plan-file",
+        help="file to write the plan to, gzip compressed if it ends with .gz")
+    plan_parser.add_argument("-b", "--branch", default="staging")
+    add_common_arguments(plan_parser)
+    plan_parser.set_defaults(run=run_plan)
+
+    apply_parser = subparsers.add_parser("apply",
+        help="commit a plan file if the files it changes haven't changed since it was made")
+    apply_parser.add_argument("plan_file", metavar="plan-file",
+        help="plan written by the plan command")
+    add_common_arguments(apply_parser)
+    apply_parser.set_defaults(run=run_apply)
+
+    serve_parser = subparsers.add_parser("serve",
+        help="receive image tag updates over http and commit bursts of them together")
+    serve_parser.add_argument("--host", default="127.0.0.1",
+        help="address to listen on (default: %(default)s)")
+    serve_parser.add_argument("--port", type=int, default=8080,
+        help="port to listen on (default: %(default)s)")
+    serve_parser.add_argument("--debounce", type=positive_float, default=service.DEFAULT_DEBOUNCE,
+        help="seconds to wait for more updates to a project and branch before committing "
+             "(default: %(default)s)")
+    serve_parser.add_argument("--max-delay", type=positive_float, default=service.DEFAULT_MAX_DELAY,
+        help="seconds an update waits at most while more updates keep arriving (default: %(default)s)")
+    serve_parser.add_argument("--webhook-secret", default=os.environ.get("DEPLOYVERSIONER_WEBHOOK_SECRET"),
+        help="token webhooks must send in X-Gitlab-Token (default: $DEPLOYVERSIONER_WEBHOOK_SECRET)")
+    serve_parser.add_argument("-b", "--branch", default="staging",
+        help="branch of updates that don't name one (default: %(default)s)")
+    serve_parser.add_argument("--max-parallel-projects", type=deployversioner.positive_int,
+        default=batch.DEFAULT_MAX_PARALLEL_PROJECTS,
+        help="number of projects and branches to commit to at the same time (default: %(default)s)")
+    serve_parser.add_argument("-n", "--dry-run", action="store_true",
+        help="don't commit changes, only log what would be changed")
+    add_common_arguments(serve_parser)
+    serve_parser.set_defaults(run=run_service)
+
+    args = parser.parse_args(argv)
+    if not args.gitlab_api_token:
+        parser.error("a gitlab api token is needed, use --gitlab-api-token or set GITLAB_API_TOKEN")
+    return args
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    args = setup_args(argv)
+    logging.basicConfig(format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+    logger.info("using %s yaml backend", yamlbackend.default_backend().name)
+    deployversioner.start_metrics(args)
+    try:
+        sys.exit(args.run(args))
+    except deployversioner.VersionUnchangedException as e:
+        print(e)
+    except deployversioner.VersionerError as e:
+        print("caught unexpected error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        deployversioner.finish_metrics(args)
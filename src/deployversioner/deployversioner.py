@@ -2,19 +2,55 @@
 
 import argparse
 import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import json
+import logging
+import multiprocessing
+import os
+import random
+import re
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import typing
 import urllib.parse
+import zlib
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import yaml
 
+from deployversioner import cache
+from deployversioner import gitbackend
+from deployversioner import metrics
+from deployversioner import ratelimit
+from deployversioner import yamlbackend
+
+logger = logging.getLogger(__name__)
+
 GitlabRequest = collections.namedtuple("GitlabRequest", ["url", "api_token",
     "project_id", "branch"])
 
+# number of files fetched and rewritten in parallel by change_image_tag
+DEFAULT_MAX_CONCURRENCY = 8
+
+# rest fetches every file with its own request, graphql fetches a batch of
+# files in one request and archive downloads all files as one tarball. auto
+# uses archive when there are more than archive_threshold files and rest
+# otherwise
+FETCH_STRATEGIES = ["rest", "graphql", "archive", "auto"]
+DEFAULT_GRAPHQL_BATCH_SIZE = 50
+DEFAULT_ARCHIVE_THRESHOLD = 50
+
+# times a request gitlab rate limits is sent again
+RATE_LIMIT_RETRIES = 5
+
 class VersionerError(Exception):
     pass
 
@@ -26,42 +62,341 @@ class VersionUnchangedException(Exception):
 class VersionerFileNotFound(VersionerError):
     pass
 
-def get_file_contents(gitlab_request: GitlabRequest, filename: str) -> str:
-    url = gitlab_request.url
+class VersionerProjectNotFound(VersionerError):
+    pass
+
+class GitlabRetry(Retry):
+    r"""retry policy shared by all requests against gitlab.
+
+    Reads are retried on server errors and read errors. Commits are never
+    retried here, as POST isn't an allowed method: resending the same
+    payload can't fix a conflict and retrying on a server error or a
+    connection dropped after the commit was sent could make the same commit
+    twice. Conflicts are handled by commit_changes instead and rate limiting
+    by GitlabClient.
+    """
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if status_code == 400:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        if metrics.current is not None:
+            metrics.current.record_retry(method or "", url or "")
+        return super().increment(method, url, *args, **kwargs)
+
+def normalize_url(url: str) -> str:
     if url[:4] != "http":
         url = "https://{}".format(url)
-    headers = {"private-token": gitlab_request.api_token}
-    url = "{}/api/v4/projects/{}/repository/files/{}/raw?ref={}".format(url,
-        gitlab_request.project_id, urllib.parse.quote(filename, safe=""), gitlab_request.branch)
+    return url.rstrip("/")
+
+class GitlabClient:
+    r"""keep-alive connection pool for one gitlab instance and api token.
+
+    :param url of the gitlab instance, with or without scheme
+    :param api_token private token for accessing the gitlab api
+    :param max_concurrency number of connections kept open to gitlab
+
+    Every request waits for the rate limiter shared by all clients of the
+    gitlab instance, and a request gitlab rate limits is sent again once
+    the limiter lets it through.
+    """
+    def __init__(self, url: str, api_token: str, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        self.url = normalize_url(url)
+        self.api_token = api_token
+        self.max_concurrency = max_concurrency
+        self.limiter = ratelimit.get_limiter(self.url, max_concurrency)
+        self.session = requests.Session()
+        # Retry-After is left to the rate limiter, which pauses every request rather than one
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency,
+            max_retries=GitlabRetry(total=3,
+                status_forcelist=[500, 502, 503, 504],
+                allowed_methods=["GET", "HEAD"],
+                backoff_factor=2, respect_retry_after_header=False))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # graphql queries are posted but only read, so they are retried like reads
+        self.session.mount(self.graphql_url(), HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency,
+            max_retries=Retry(total=3,
+                status_forcelist=[500, 502, 503, 504],
+                allowed_methods=["POST"],
+                backoff_factor=2, respect_retry_after_header=False)))
+        # set to False when gitlab doesn't have the graphql api for blobs, so later requests go straight to rest
+        self.graphql_available = True
+        # whether commits are sent gzip compressed, set to False if gitlab refuses them
+        self.compress_commits = False
+
+    def graphql_url(self) -> str:
+        return "{}/api/graphql".format(self.url)
+
+    def api_url(self, path: str) -> str:
+        return "{}/api/v4/{}".format(self.url, path)
+
+    def headers(self, extra: typing.Optional[typing.Dict[str, str]] = None) -> typing.Dict[str, str]:
+        headers = {"private-token": self.api_token}
+        if extra is not None:
+            headers.update(extra)
+        return headers
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        send = getattr(self.session, method.lower())
+        headers = self.headers(kwargs.pop("headers", None))
+        request_class = ratelimit.request_class(method, url)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            started = self.limiter.acquire()
+            response = None
+            try:
+                response = send(url, headers=headers, **kwargs)
+            finally:
+                retry_after = self.limiter.release(started, response, request_class)
+            if metrics.current is not None:
+                record_response(method, url, response, kwargs)
+            if retry_after is None or attempt == RATE_LIMIT_RETRIES:
+                return response
+            logger.info("rate limited by gitlab, retrying %s %s in %.1f seconds", method, url, retry_after)
+            if metrics.current is not None:
+                metrics.current.record_retry(method, url)
+            response.close()
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+def record_response(method: str, url: str, response: requests.Response, kwargs: typing.Dict) -> None:
+    r"""add a response to the metrics, the body of a streamed response is counted when it is read"""
+    body = kwargs.get("data")
+    if body is None and kwargs.get("json") is not None:
+        body = json.dumps(kwargs["json"])
+    if isinstance(body, (str, bytes)) or body is None:
+        sent = len(body.encode("utf8") if isinstance(body, str) else body or b"")
+    else:
+        # streamed bodies count what they have sent
+        sent = getattr(body, "size", 0)
+    received = 0 if kwargs.get("stream") else len(response.content)
+    metrics.current.record_response(method, url, response.status_code, response.elapsed.total_seconds(),
+        received, sent)
+
+def raise_for_status(response: requests.Response) -> None:
+    r"""like response.raise_for_status but raises VersionerProjectNotFound if gitlab doesn't know the project"""
+    if response.status_code == 404 and "Project Not Found" in response.text:
+        raise VersionerProjectNotFound("project not found at {}".format(response.url))
+    response.raise_for_status()
+
+_clients: typing.Dict[typing.Tuple[str, str], GitlabClient] = {}
+_clients_lock = threading.Lock()
+
+def get_client(url: str, api_token: str, max_concurrency: typing.Optional[int] = None) -> GitlabClient:
+    r"""return the shared client for url and api_token, creating it if needed.
+
+    If max_concurrency is given and larger than the pool of the existing
+    client, the client is replaced by one with a larger pool.
+    """
+    key = (normalize_url(url), api_token)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None or (max_concurrency is not None and client.max_concurrency < max_concurrency):
+            if client is not None:
+                client.close()
+            client = GitlabClient(url, api_token, max_concurrency or DEFAULT_MAX_CONCURRENCY)
+            _clients[key] = client
+        return client
+
+def close_clients() -> None:
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+    ratelimit.reset_limiters()
+
+# a file as of a commit, last_commit_id is the last commit which changed it
+FileRevision = collections.namedtuple("FileRevision", ["content", "blob_id", "last_commit_id"])
+
+def file_url(client: GitlabClient, gitlab_request: GitlabRequest, filename: str, suffix: str = "") -> str:
+    return client.api_url("projects/{}/repository/files/{}{}?ref={}".format(
+        gitlab_request.project_id, urllib.parse.quote(filename, safe=""), suffix, gitlab_request.branch))
+
+def get_file(gitlab_request: GitlabRequest, filename: str) -> FileRevision:
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        return response.text
-    except requests.exceptions.HTTPError as e:
+        response = client.get(file_url(client, gitlab_request, filename, "/raw"))
+        raise_for_status(response)
+        return FileRevision(response.text, response.headers.get("X-Gitlab-Blob-Id"),
+            response.headers.get("X-Gitlab-Last-Commit-Id"))
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
         raise VersionerError("unable to get contents of {}: {}".format(
             filename, e))
 
+def get_file_contents(gitlab_request: GitlabRequest, filename: str) -> str:
+    return get_file(gitlab_request, filename).content
+
+def get_file_revision(gitlab_request: GitlabRequest, filename: str) -> FileRevision:
+    r"""return the blob and last commit of filename without its contents"""
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
+    try:
+        response = client.head(file_url(client, gitlab_request, filename))
+        raise_for_status(response)
+        return FileRevision(None, response.headers.get("X-Gitlab-Blob-Id"),
+            response.headers.get("X-Gitlab-Last-Commit-Id"))
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
+        raise VersionerError("unable to get revision of {}: {}".format(
+            filename, e))
+
+def get_branch_head(gitlab_request: GitlabRequest) -> str:
+    r"""return the id of the last commit of the branch of gitlab_request"""
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
+    url = client.api_url("projects/{}/repository/branches/{}".format(
+        gitlab_request.project_id, urllib.parse.quote(gitlab_request.branch, safe="")))
+    try:
+        response = client.get(url)
+        raise_for_status(response)
+        return response.json()["commit"]["id"]
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
+        raise VersionerError("unable to get branch {}: {}".format(gitlab_request.branch, e))
+
+class GraphqlUnavailable(VersionerError):
+    pass
+
+GRAPHQL_BLOBS_QUERY = """query($ids: [ID!], $ref: String!, $paths: [String!]!) {
+  projects(ids: $ids) {
+    nodes { repository { blobs(ref: $ref, paths: $paths) { nodes { path rawBlob } } } }
+  }
+}"""
+
+def get_files_contents_graphql(gitlab_request: GitlabRequest, filenames: typing.List[str]) -> typing.Dict[str, str]:
+    r"""fetch the contents of filenames in a single graphql request.
+
+    Returns the contents by filename of the files gitlab returned, which is
+    none of them if graphql isn't available or the request failed. The caller
+    is expected to fetch missing files over rest. Graphql is only given up
+    on for later requests if gitlab doesn't have it, i.e. the endpoint is
+    missing or the query is refused for a field of a gitlab from before
+    the blobs field.
+    """
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
+    if not client.graphql_available:
+        return {}
+    variables = {"ids": ["gid://gitlab/Project/{}".format(gitlab_request.project_id)],
+        "ref": gitlab_request.branch, "paths": filenames}
+    try:
+        response = client.post(client.graphql_url(),
+            headers={"Authorization": "Bearer {}".format(gitlab_request.api_token)},
+            json={"query": GRAPHQL_BLOBS_QUERY, "variables": variables})
+        if response.status_code == 404:
+            raise GraphqlUnavailable("{} not found".format(client.graphql_url()))
+        response.raise_for_status()
+        js = response.json()
+        if js.get("errors"):
+            if any(is_missing_field_error(e) for e in js["errors"]):
+                raise GraphqlUnavailable("graphql query refused: {}".format(js["errors"]))
+            raise VersionerError("graphql query failed: {}".format(js["errors"]))
+        contents = {}
+        for project in js["data"]["projects"]["nodes"]:
+            for blob in project["repository"]["blobs"]["nodes"]:
+                if blob["rawBlob"] is not None:
+                    contents[blob["path"]] = blob["rawBlob"]
+        return contents
+    except GraphqlUnavailable as e:
+        logger.warning("graphql isn't available, falling back to rest: %s", e)
+        client.graphql_available = False
+        return {}
+    except (requests.exceptions.RequestException, VersionerError, ValueError, KeyError, TypeError) as e:
+        logger.warning("unable to fetch files with graphql, falling back to rest for these files: %s", e)
+        return {}
+
+def is_missing_field_error(error: typing.Any) -> bool:
+    r"""whether a graphql error is gitlab not knowing a field of GRAPHQL_BLOBS_QUERY"""
+    message = str(error.get("message", "")) if isinstance(error, dict) else str(error)
+    return "doesn't exist" in message and any("'{}'".format(field) in message
+        for field in ["blobs", "rawBlob", "repository"])
+
 def get_project_number(gitlab_get_projects_url: str, project_name:str, token:str) -> int:
-    url = "{}/{}".format( gitlab_get_projects_url, urllib.parse.quote(project_name, safe='') )
+    client = get_client(gitlab_get_projects_url.split("/api/v4")[0], token)
+    url = "{}/{}".format( normalize_url(gitlab_get_projects_url), urllib.parse.quote(project_name, safe='') )
     try:
-        response = requests.get(url, headers={"private-token": token})
+        response = client.get(url)
         response.raise_for_status()
         js = response.json()
         if "id" in js:
             return js["id"]
         raise VersionerError(f"No id found in response for url {url}: {js}")
-    except requests.exceptions.HTTPError as e:
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
         raise VersionerError("unable to get contents of {}: {}".format( url, e))
 
+WORKLOAD_KINDS = ["Deployment", "StatefulSet", "CronJob", "Job"]
+
+# valid docker tags can always be written as plain yaml scalars
+DOCKER_TAG_PATTERN = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.-]{0,127}")
+
+class InPlaceRewriteNotPossible(Exception):
+    pass
+
+class ManifestSkipped(VersionUnchangedException):
+    pass
+
+# these only look at the text, so they find a kind or image in block and
+# flow style, as json or in a comment. a file is only skipped when none of
+# the matches could need a change, so a match too many is harmless.
+WORKLOAD_KIND_PATTERN = re.compile(r"""\bkind["']?\s*:\s*(?:!!?\w+\s+)?["']?(?:{})\b""".format(
+    "|".join(WORKLOAD_KINDS)))
+IMAGE_VALUE_PATTERN = re.compile(r"""\bimage["']?\s*:\s*["']?([^\s"',}#]*)""")
+
+def prescan_needs_rewrite(file_contents: str, new_image_tag: str) -> bool:
+    r"""tell from the text alone whether file_contents could need a new image tag.
+
+    Returns False if there are no workloads in the file or if every image
+    already has new_image_tag, so the file doesn't have to be parsed.
+    """
+    if WORKLOAD_KIND_PATTERN.search(file_contents) is None:
+        return False
+    images = IMAGE_VALUE_PATTERN.findall(file_contents)
+    suffix = ":{}".format(new_image_tag)
+    return len(images) == 0 or not all(image.endswith(suffix) for image in images)
+
 def set_image_tag(gitlab_request: GitlabRequest, filename: str,
         new_image_tag: str) -> typing.Tuple[typing.Any, set]:
     file_contents = get_file_contents(gitlab_request, filename)
-    docs = [d for d in yaml.safe_load_all(file_contents) if d is not None]
+    with metrics.file(filename):
+        return rewrite_image_tags(file_contents, new_image_tag)
+
+def rewrite_image_tags(file_contents: str, new_image_tag: str,
+        backend: typing.Optional[yamlbackend.YamlBackend] = None) -> typing.Tuple[str, set]:
+    r"""set the tag of the container image of every workload in file_contents.
+
+    Only the image values are replaced in the original text, so comments,
+    key order and formatting are kept. Documents which can't safely be
+    edited in place are handled by loading and dumping all of them instead.
+
+    :param backend to parse and dump yaml with, the fastest available if None
+    :return the new file contents and the set of image tags that were replaced
+    """
+    if not prescan_needs_rewrite(file_contents, new_image_tag):
+        raise ManifestSkipped("no workloads or all images are already tagged {}".format(new_image_tag))
+    if backend is None:
+        backend = yamlbackend.default_backend()
+    try:
+        return rewrite_image_tags_in_place(file_contents, new_image_tag, backend)
+    except InPlaceRewriteNotPossible:
+        return rewrite_image_tags_by_dump(file_contents, new_image_tag, backend)
+
+def rewrite_image_tags_by_dump(file_contents: str, new_image_tag: str,
+        backend: typing.Optional[yamlbackend.YamlBackend] = None) -> typing.Tuple[str, set]:
+    if backend is None:
+        backend = yamlbackend.default_backend()
+    docs = [d for d in backend.load_all(file_contents) if d is not None]
     changed=False
     changed_image_tags = set()
     for doc in docs:
         # added guard for None type as the script would otherwise fail on services with --- seperators
-        if "kind" in doc and doc["kind"] in ["Deployment", "StatefulSet", "CronJob", "Job"]:
+        if "kind" in doc and doc["kind"] in WORKLOAD_KINDS:
             try:
                 if doc["kind"] == 'CronJob':
                     containers = doc["spec"]["jobTemplate"]["spec"]["template"]["spec"]["containers"]
@@ -82,7 +417,112 @@ def set_image_tag(gitlab_request: GitlabRequest, filename: str,
     if not changed:
         raise VersionUnchangedException(
             "new image tag matches old, nothing to do")
-    return yaml.dump_all(docs), changed_image_tags
+    return backend.dump_all(docs), changed_image_tags
+
+ImageReference = collections.namedtuple("ImageReference", ["document", "path",
+    "image", "start", "style"])
+
+def rewrite_image_tags_in_place(file_contents: str, new_image_tag: str,
+        backend: typing.Optional[yamlbackend.YamlBackend] = None) -> typing.Tuple[str, set]:
+    r"""replace image tags directly in file_contents using the marks of the parsed nodes.
+
+    Raises InPlaceRewriteNotPossible for anything but the plain layout of
+    a workload, e.g. anchors, escaped or multi-line image values or
+    missing keys, so the caller can fall back to rewriting the whole file.
+    """
+    if DOCKER_TAG_PATTERN.fullmatch(new_image_tag) is None:
+        raise InPlaceRewriteNotPossible("tag needs quoting: {}".format(new_image_tag))
+    return apply_image_tag(file_contents, find_image_references(file_contents, backend),
+        new_image_tag)
+
+def find_image_references(file_contents: str,
+        backend: typing.Optional[yamlbackend.YamlBackend] = None) -> typing.List[ImageReference]:
+    r"""return where the container image of every workload is written in file_contents.
+
+    Raises InPlaceRewriteNotPossible if an image can't be edited in place.
+    """
+    if backend is None:
+        backend = yamlbackend.default_backend()
+    line_starts = [0] + [m.end() for m in re.finditer("\n", file_contents)]
+    references = []
+    for document, doc in enumerate(backend.compose_all(file_contents)):
+        if not isinstance(doc, yaml.MappingNode):
+            continue
+        kind = mapping_value(doc, "kind")
+        if not isinstance(kind, yaml.ScalarNode) or kind.value not in WORKLOAD_KINDS:
+            continue
+        if kind.value == "CronJob":
+            containers_path = ["spec", "jobTemplate", "spec", "template", "spec", "containers"]
+        else:
+            containers_path = ["spec", "template", "spec", "containers"]
+        containers = node_at_path(doc, containers_path)
+        if not isinstance(containers, yaml.SequenceNode):
+            raise InPlaceRewriteNotPossible("containers is not a list")
+        if len(containers.value) > 1:
+            raise VersionerError(
+                "too many container templates in the deployment")
+        if len(containers.value) == 0:
+            raise InPlaceRewriteNotPossible("no containers")
+        image = node_at_path(containers.value[0], ["image"])
+        if not isinstance(image, yaml.ScalarNode):
+            raise InPlaceRewriteNotPossible("image is not a scalar")
+        parse_image(image.value)
+        start = line_starts[image.start_mark.line] + image.start_mark.column
+        old_text = quote_scalar(image.value, image.style)
+        if file_contents[start:start + len(old_text)] != old_text:
+            raise InPlaceRewriteNotPossible("image at line {} doesn't match its text".format(
+                image.start_mark.line + 1))
+        references.append(ImageReference(document, "{}[0].image".format(".".join(containers_path)),
+            image.value, start, image.style or None))
+    return references
+
+def apply_image_tag(file_contents: str, references: typing.List[ImageReference],
+        new_image_tag: str) -> typing.Tuple[str, set]:
+    r"""replace the tags of the images at references in file_contents with new_image_tag"""
+    parts = []
+    position = 0
+    changed_image_tags = set()
+    for reference in sorted(references, key=lambda r: r.start):
+        imagename, image_tag = parse_image(reference.image)
+        if image_tag == new_image_tag:
+            continue
+        old_text = quote_scalar(reference.image, reference.style)
+        parts.append(file_contents[position:reference.start])
+        parts.append(quote_scalar("{}:{}".format(imagename, new_image_tag), reference.style))
+        position = reference.start + len(old_text)
+        changed_image_tags.add(image_tag)
+    if not changed_image_tags:
+        raise VersionUnchangedException(
+            "new image tag matches old, nothing to do")
+    parts.append(file_contents[position:])
+    return "".join(parts), changed_image_tags
+
+def mapping_value(node: yaml.Node, key: str) -> typing.Optional[yaml.Node]:
+    if not isinstance(node, yaml.MappingNode):
+        return None
+    for key_node, value_node in node.value:
+        if isinstance(key_node, yaml.ScalarNode) and key_node.value == key:
+            return value_node
+    return None
+
+def node_at_path(node: yaml.Node, path: typing.List[str]) -> yaml.Node:
+    for key in path:
+        value = mapping_value(node, key)
+        if value is None:
+            raise InPlaceRewriteNotPossible("no {} in {}".format(key, node.start_mark))
+        node = value
+    return node
+
+def quote_scalar(value: str, style: typing.Optional[str]) -> str:
+    r"""return how value is written in yaml in the given scalar style, for single line values"""
+    # the pure python loader marks plain scalars with None and libyaml with ""
+    if not style:
+        return value
+    if style == "'":
+        return "'{}'".format(value.replace("'", "''"))
+    if style == '"' and '"' not in value and "\\" not in value:
+        return '"{}"'.format(value)
+    raise InPlaceRewriteNotPossible("unsupported scalar style {}".format(style))
 
 def parse_image(image: str) -> typing.List[str]:
     parts = image.split(":")
@@ -91,103 +531,754 @@ def parse_image(image: str) -> typing.List[str]:
     return parts
 
 
-def get_content(gitlab_request: GitlabRequest, file: typing.Dict, image_tag: str, dir: str) -> typing.Dict:
-    if dir not in file['path'] or not file['type'] == 'blob' or (
-            not file['path'].endswith('.yml') and not file['path'].endswith('.yaml')):
-        return {"commit_blob": {}, "changed_image_tags": set()}
+def in_path(file_path: str, dir: str) -> bool:
+    r"""whether file_path is dir or below it, so prod doesn't match prod-old/app.yml"""
+    return dir == "" or file_path == dir or file_path.startswith(dir.rstrip("/") + "/")
+
+def is_manifest_path(file_path: str) -> bool:
+    return file_path.endswith('.yml') or file_path.endswith('.yaml')
 
-    commit_blob = {}
+def is_manifest(file: typing.Dict, dir: str) -> bool:
+    return file['type'] == 'blob' and is_manifest_path(file['path']) and in_path(file['path'], dir)
+
+def cacheable_image_references(file_contents: str) -> typing.Optional[typing.List[ImageReference]]:
+    r"""return the image references of file_contents or None if they can't be used for an in place rewrite"""
+    if WORKLOAD_KIND_PATTERN.search(file_contents) is None:
+        return []
     try:
-        commit_blob['content'], changed_tags = set_image_tag(gitlab_request, file['path'], image_tag)
-        commit_blob['action'] = 'update'
-        commit_blob['file_path'] = file['path']
-    except VersionUnchangedException as e:
+        return find_image_references(file_contents)
+    except InPlaceRewriteNotPossible:
+        return None
+
+# a file of the tree ready to be rewritten. references are the image
+# references from the blob cache if cached is True, last_commit_id the last
+# commit changing the contents if known
+FetchedBlob = collections.namedtuple("FetchedBlob", ["file", "content", "references", "cached", "last_commit_id"])
+
+def fetch_blob(gitlab_request: GitlabRequest, file: typing.Dict,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        file_contents: typing.Optional[str] = None) -> FetchedBlob:
+    r"""return a tree entry from blob_cache or fetched from gitlab.
+
+    A file fetched over rest comes with the last commit changing it, so its
+    change can be committed without looking it up again.
+
+    :param file_contents of the entry if they have already been fetched
+    """
+    if blob_cache is not None:
+        cached = blob_cache.get(file['id'])
+        if cached is not None:
+            return FetchedBlob(file, cached[0], cached[1], True, None)
+    if file_contents is not None:
+        return FetchedBlob(file, file_contents, None, False, None)
+    revision = get_file(gitlab_request, file['path'])
+    if revision.blob_id is not None and revision.blob_id != file['id']:
+        # changed since the tree was listed, the contents are those of the newer blob
+        file = dict(file, id=revision.blob_id)
+    return FetchedBlob(file, revision.content, None, False, revision.last_commit_id)
+
+def transform_blob(blob: FetchedBlob, image_tag: str,
+        find_references: bool = False) -> typing.Tuple[typing.Dict, typing.Optional[typing.List]]:
+    r"""rewrite the image tags of a fetched blob, the cpu bound part of get_content.
+
+    Only the arguments are used, so this can run in another process. Cached
+    image references are applied without parsing the file. The time of the
+    rewrite is returned as seconds of the result rather than recorded, so
+    it isn't lost in another process; see record_rewrite.
+
+    :param find_references whether to find the image references of an uncached blob for the blob cache
+    :return the result of get_content and the image references of the blob
+    """
+    file = blob.file
+    references = blob.references
+    # whether the file was parsed, rather than ruled out by the pre-scan or rewritten from cached references
+    parsed = False
+    start = time.perf_counter()
+    try:
+        if find_references and not blob.cached:
+            if not prescan_needs_rewrite(blob.content, image_tag):
+                # a file without workloads has no references, those of a tagged workload are left to a
+                # run that needs them
+                if WORKLOAD_KIND_PATTERN.search(blob.content) is None:
+                    references = []
+                raise ManifestSkipped("no workloads or all images are already tagged {}".format(image_tag))
+            parsed = True
+            references = cacheable_image_references(blob.content)
+        if not (blob.cached or find_references) or references is None or \
+                DOCKER_TAG_PATTERN.fullmatch(image_tag) is None:
+            # rewrite_image_tags parses the file unless its pre-scan rules it out
+            parsed = parsed or prescan_needs_rewrite(blob.content, image_tag)
+            content, changed_tags = rewrite_image_tags(blob.content, image_tag)
+        else:
+            try:
+                content, changed_tags = apply_image_tag(blob.content,
+                    [ImageReference(*r) for r in references], image_tag)
+            except VersionUnchangedException as e:
+                if not blob.cached:
+                    raise
+                raise ManifestSkipped(str(e))
+    except VersionUnchangedException:
+        return {"commit_blob": {}, "changed_image_tags": set(), "parsed": parsed,
+            "seconds": time.perf_counter() - start}, references
+    seconds = time.perf_counter() - start
+    # the blob the change is based on, for detecting conflicting commits, and the tags replaced in it
+    commit_blob = {"content": content, "action": "update", "file_path": file['path'], "blob_id": file['id'],
+        "changed_image_tags": sorted(changed_tags)}
+    if blob.last_commit_id is not None:
+        commit_blob["last_commit_id"] = blob.last_commit_id
+    return {"commit_blob": commit_blob, "changed_image_tags": changed_tags, "parsed": parsed,
+        "seconds": seconds}, references
+
+def record_rewrite(blob: FetchedBlob, result: typing.Dict) -> None:
+    r"""add the time transform_blob took for blob to the metrics, in the process they are recorded in"""
+    metrics.record_file(blob.file['path'], result["seconds"])
+
+def transform_blobs(blobs: typing.List[FetchedBlob], image_tag: str,
+        find_references: bool = False) -> typing.List[typing.Tuple[typing.Dict, typing.Optional[typing.List]]]:
+    return [transform_blob(blob, image_tag, find_references) for blob in blobs]
+
+def get_content(gitlab_request: GitlabRequest, file: typing.Dict, image_tag: str, dir: str,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        file_contents: typing.Optional[str] = None) -> typing.Dict:
+    r"""fetch and rewrite a tree entry, using blob_cache to skip downloading and parsing it.
+
+    The contents and image references of a file are cached under the sha of
+    its blob, so a file that is unchanged since an earlier run is rewritten
+    from the cache without any request and without being parsed.
+
+    :param file_contents of the entry if they have already been fetched
+    """
+    if not is_manifest(file, dir):
         return {"commit_blob": {}, "changed_image_tags": set()}
-    return {"commit_blob": commit_blob, "changed_image_tags": changed_tags}
+    blob = fetch_blob(gitlab_request, file, blob_cache, file_contents)
+    result, references = transform_blob(blob, image_tag, blob_cache is not None)
+    record_rewrite(blob, result)
+    if blob_cache is not None and not blob.cached:
+        blob_cache.put(file['id'], blob.content, references)
+    return result
+
+def fetch_blobs(gitlab_request: GitlabRequest, files: typing.List[typing.Dict],
+        blob_cache: typing.Optional[cache.BlobCache] = None, fetch_strategy: str = "rest") -> typing.List[FetchedBlob]:
+    r"""fetch_blob for a batch of tree entries.
+
+    With the graphql fetch strategy the entries which aren't in blob_cache
+    are fetched in one request. Entries graphql didn't return are fetched
+    one by one over rest.
+    """
+    contents: typing.Dict[str, str] = {}
+    if fetch_strategy == "graphql":
+        uncached = [f['path'] for f in files if blob_cache is None or f['id'] not in blob_cache]
+        if uncached:
+            contents = get_files_contents_graphql(gitlab_request, uncached)
+    return [fetch_blob(gitlab_request, f, blob_cache, contents.get(f['path'])) for f in files]
+
+# execution of the rewrites by change_image_tag: serial fetches and rewrites
+# one file after another, thread rewrites files in the threads fetching them
+# and process rewrites them in a pool of processes, outside of the gil
+EXECUTION_MODES = ["serial", "thread", "process"]
+DEFAULT_EXECUTION = "thread"
+# files fetched or waiting to be rewritten per fetching thread, beyond which
+# listing and fetching waits for the rewrites to catch up
+PIPELINE_DEPTH = 4
+
+class SerialExecutor(concurrent.futures.Executor):
+    r"""executor running every function right away in the submitting thread"""
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+_transform_pool: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+_transform_pool_lock = threading.Lock()
 
-def fetch_page_and_append(api_token, url, page_number, old_value):
-    r"""fetch a page from url and return a new value of old_value + fetched data.
+def get_transform_pool() -> concurrent.futures.ProcessPoolExecutor:
+    r"""return the shared pool of processes rewriting files, starting it if needed"""
+    global _transform_pool
+    with _transform_pool_lock:
+        if _transform_pool is None:
+            # spawned workers don't inherit the locks of threads fetching files
+            _transform_pool = concurrent.futures.ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn"))
+        return _transform_pool
 
-    Expects page to be a JSON array and appends the fetched page to the old_value fetch
+def close_transform_pool() -> None:
+    global _transform_pool
+    with _transform_pool_lock:
+        if _transform_pool is not None:
+            _transform_pool.shutdown()
+            _transform_pool = None
 
-    :param api_token to the gitlab api
-    :param url without any paging arguments
-    :param page_number
-    :param old_value previous array that this page is added to.
+@contextlib.contextmanager
+def open_executors(execution: str, max_concurrency: int) -> typing.Iterator[
+        typing.Tuple[concurrent.futures.Executor, concurrent.futures.Executor]]:
+    r"""yield the executors fetching and rewriting files for an execution mode"""
+    if execution == "serial":
+        executor = SerialExecutor()
+        yield executor, executor
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        yield executor, get_transform_pool() if execution == "process" else executor
+
+class RewritePipeline:
+    r"""fetch tree entries on io_executor and rewrite them on transform_executor as they arrive.
+
+    At most max_pending fetches are running or waiting to be rewritten, so
+    submitting blocks while the rewrites are behind instead of piling up
+    fetched files in memory. Every submission returns a future of its
+    get_content results, so the caller decides the order of the results.
+
+    :param blob_cache to store fetched blobs and their image references in, in this process
+    :param spool to keep the rewritten contents in, they are kept in memory if None
     """
-    response = requests.get(f"{url}&per_page=100&page={page_number}", headers={"private-token": api_token})
-    response.raise_for_status()
-    current_page = response.json()
-    new_value = old_value + current_page
-    if len(current_page) == 100:
-        return new_value, True
-    else:
-        return new_value, False
+    def __init__(self, image_tag: str, blob_cache: typing.Optional[cache.BlobCache],
+            io_executor: concurrent.futures.Executor, transform_executor: concurrent.futures.Executor,
+            max_pending: int, spool: typing.Optional["ContentSpool"] = None):
+        self.image_tag = image_tag
+        self.blob_cache = blob_cache
+        self.spool = spool
+        self.io_executor = io_executor
+        self.transform_executor = transform_executor
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.fetches: typing.List[concurrent.futures.Future] = []
 
-def change_image_tag(gitlab_request: GitlabRequest, file_object: str, image_tag: str) -> typing.Tuple[typing.Any, set]:
-    url = gitlab_request.url
-    if url[:4] != "http":
-        url = "https://{}".format(url)
-    path = "/".join(file_object.split("/")[:-1])
-    url = f"{url}/api/v4/projects/{gitlab_request.project_id}/repository/tree/?ref={gitlab_request.branch}&recursive=True&path={path}"
-    page_number = 1
+    def submit(self, fetch: typing.Callable[..., typing.List[FetchedBlob]], *args) -> concurrent.futures.Future:
+        r"""fetch a list of blobs with fetch(*args) on io_executor and rewrite them"""
+        self.slots.acquire()
+        result: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            fetched = self.io_executor.submit(fetch, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.fetches.append(fetched)
+        fetched.add_done_callback(functools.partial(self.fetched, result))
+        return result
+
+    def submit_fetched(self, blobs: typing.List[FetchedBlob]) -> concurrent.futures.Future:
+        fetched: concurrent.futures.Future = concurrent.futures.Future()
+        fetched.set_result(blobs)
+        self.slots.acquire()
+        result: concurrent.futures.Future = concurrent.futures.Future()
+        self.fetched(result, fetched)
+        return result
+
+    def fetched(self, result: concurrent.futures.Future, fetched: concurrent.futures.Future) -> None:
+        # callbacks swallow exceptions, so every one must end up in result
+        try:
+            blobs = fetched.result()
+            transformed = self.transform_executor.submit(transform_blobs, blobs, self.image_tag,
+                self.blob_cache is not None)
+        except BaseException as e:
+            self.finish(result, exception=e)
+            return
+        transformed.add_done_callback(functools.partial(self.transformed, result, blobs))
+
+    def transformed(self, result: concurrent.futures.Future, blobs: typing.List[FetchedBlob],
+            transformed: concurrent.futures.Future) -> None:
+        try:
+            results = []
+            for blob, (content, references) in zip(blobs, transformed.result()):
+                record_rewrite(blob, content)
+                if self.blob_cache is not None and not blob.cached:
+                    self.blob_cache.put(blob.file['id'], blob.content, references)
+                if self.spool is not None and content["commit_blob"]:
+                    content["commit_blob"] = self.spool.add(content["commit_blob"])
+                results.append(content)
+        except BaseException as e:
+            self.finish(result, exception=e)
+            return
+        self.finish(result, results)
+
+    def finish(self, result: concurrent.futures.Future, results: typing.Optional[typing.List[typing.Dict]] = None,
+            exception: typing.Optional[BaseException] = None) -> None:
+        self.slots.release()
+        if exception is not None:
+            result.set_exception(exception)
+        else:
+            result.set_result(results)
+
+    def cancel(self) -> None:
+        for fetched in self.fetches:
+            fetched.cancel()
+
+def iter_archive_files(gitlab_request: GitlabRequest, path: str) -> typing.Iterator[typing.Tuple[str, str, typing.Optional[str]]]:
+    r"""yield the path, contents and commit sha of the files below path as they are read from an archive of the branch.
+
+    The archive is streamed through tarfile without being stored. All files
+    come from the same commit, which git archive records in the global pax
+    header of the tarball.
+    """
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
+    url = client.api_url("projects/{}/repository/archive.tar.gz?sha={}".format(
+        gitlab_request.project_id, urllib.parse.quote(gitlab_request.branch, safe="")))
+    if path:
+        url = "{}&path={}".format(url, urllib.parse.quote(path, safe=""))
+    response = client.get(url, stream=True)
     try:
-        (file_tree, more_to_fetch) = fetch_page_and_append(gitlab_request.api_token, url, page_number, [])
-        while more_to_fetch:
-            page_number += 1
-            (file_tree, more_to_fetch) = fetch_page_and_append(gitlab_request.api_token, url, page_number, file_tree)
+        raise_for_status(response)
+        response.raw.decode_content = True
+        with tarfile.open(fileobj=response.raw, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # the files are inside a directory named after the project and commit
+                file_path = member.name.split("/", 1)[-1]
+                data = tar.extractfile(member).read()
+                try:
+                    contents = data.decode("utf8")
+                except UnicodeDecodeError:
+                    continue
+                yield file_path, contents, tar.pax_headers.get("comment")
+    except tarfile.TarError as e:
+        raise VersionerError("unable to read archive of {}: {}".format(path, e))
+    finally:
+        if metrics.current is not None:
+            metrics.current.record_bytes("GET", url, response.raw.tell())
+        response.close()
+
+def git_blob_sha(contents: str) -> str:
+    data = contents.encode("utf8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+def submit_archive_blobs(gitlab_request: GitlabRequest, files: typing.List[typing.Dict], path: str,
+        blob_cache: typing.Optional[cache.BlobCache], pipeline: RewritePipeline) -> typing.List[concurrent.futures.Future]:
+    r"""download an archive of path and submit files to pipeline as they come out of it.
+
+    Returns a future per file in the order of files. Files which are cached
+    aren't read from the archive and files missing from the archive, e.g.
+    since they were deleted after the tree was listed, are fetched over rest.
+    """
+    uncached = {f['path']: f for f in files if blob_cache is None or f['id'] not in blob_cache}
+    futures: typing.Dict[str, concurrent.futures.Future] = {}
+    commit_id = None
+    if uncached:
+        for file_path, contents, commit_id in iter_archive_files(gitlab_request, path):
+            file = uncached.get(file_path)
+            # a file changed after the tree was listed is fetched over rest,
+            # so cached contents always match their blob sha
+            if file is not None and git_blob_sha(contents) == file['id']:
+                # the commit of the archive isn't the last commit of the file, which is looked up to commit it
+                futures[file_path] = pipeline.submit_fetched([FetchedBlob(file, contents, None, False, None)])
+        logger.info("read %d files from archive of commit %s", len(futures), commit_id)
+    return [futures[f['path']] if f['path'] in futures else
+        pipeline.submit(fetch_blobs, gitlab_request, [f], blob_cache)
+        for f in files]
+
+TREE_PAGE_SIZE = 100
+
+def fetch_tree_page(client: GitlabClient, url: str) -> typing.Tuple[typing.List[typing.Dict], requests.Response]:
+    # only the requests are timed, the entries are consumed while the tree is listed
+    with metrics.phase("tree"):
+        response = client.get(url)
+        raise_for_status(response)
+        return response.json(), response
+
+def iter_tree(gitlab_request: GitlabRequest, path: str,
+        executor: typing.Optional[concurrent.futures.Executor] = None) -> typing.Iterator[typing.Dict]:
+    r"""yield the entries of the repository tree below path as pages arrive.
+
+    When gitlab reports the number of pages in X-Total-Pages the remaining
+    pages are fetched concurrently on executor, but yielded in order. Gitlab
+    leaves out the total for very large trees, in which case the listing
+    continues with keyset pagination, one page after another.
+
+    :param gitlab_request
+    :param path of the directory to list recursively, "" for the whole repository
+    :param executor to fetch pages on, pages are fetched one at a time if None
+    """
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
+    url = client.api_url(f"projects/{gitlab_request.project_id}/repository/tree/?ref={gitlab_request.branch}"
+        f"&recursive=True&path={urllib.parse.quote(path, safe='')}&per_page={TREE_PAGE_SIZE}")
+    page, response = fetch_tree_page(client, f"{url}&page=1")
+    yield from page
+    total_pages = response.headers.get("X-Total-Pages")
+    if total_pages:
+        page_urls = [f"{url}&page={n}" for n in range(2, int(total_pages) + 1)]
+        if executor is None:
+            pages = map(lambda u: fetch_tree_page(client, u)[0], page_urls)
+        else:
+            futures = [executor.submit(fetch_tree_page, client, u) for u in page_urls]
+            pages = (f.result()[0] for f in futures)
+        for page in pages:
+            yield from page
+        return
+    while len(page) == TREE_PAGE_SIZE:
+        next_link = response.links.get("next", {}).get("url")
+        if next_link is None or "pagination=keyset" not in next_link:
+            next_link = f"{url}&pagination=keyset&page_token={urllib.parse.quote(page[-1]['id'], safe='')}"
+        page, response = fetch_tree_page(client, next_link)
+        yield from page
+
+def iter_target_tree(gitlab_request: GitlabRequest, file_object: str,
+        executor: typing.Optional[concurrent.futures.Executor] = None) -> typing.Iterator[typing.Dict]:
+    r"""yield the tree entries below file_object if it is a directory, else the entries of its parent.
+
+    A directory is listed by itself rather than with everything else in its
+    parent. Only if it doesn't list as a directory, e.g. since it is a file,
+    the parent is listed instead.
+    """
+    if file_object:
+        entries = iter_tree(gitlab_request, file_object, executor)
+        try:
+            first = next(entries, None)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            first = None
+        if first is not None:
+            yield first
+            yield from entries
+            return
+    yield from iter_tree(gitlab_request, "/".join(file_object.split("/")[:-1]), executor)
 
+def change_single_file(gitlab_request: GitlabRequest, file_object: str, image_tag: str,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        spool: typing.Optional["ContentSpool"] = None) -> typing.Optional[typing.Tuple[typing.List[typing.Dict], set]]:
+    r"""change_image_tag for a single file, without listing the tree.
 
-        if not file_object=="" and file_object not in [n["path"] for n in file_tree]:
-            raise VersionerFileNotFound("File or dir {} not found".format(file_object))
-        changes = [changes for changes in
-                            [get_content(gitlab_request, n, image_tag, file_object) for n in file_tree]
-                            if not changes["commit_blob"]=={}]
+    The blob of the file is looked up with a HEAD request, so a cached file
+    isn't downloaded. The change is pinned to the last commit of the file
+    it was read at. Returns None if gitlab has no file file_object.
+    """
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
+    try:
+        response = client.head(file_url(client, gitlab_request, file_object))
+        if response.status_code == 404:
+            # a directory, a missing file or a missing project, which listing the tree tells apart
+            return None
+        response.raise_for_status()
+        blob_id = response.headers.get("X-Gitlab-Blob-Id")
+        last_commit_id = response.headers.get("X-Gitlab-Last-Commit-Id")
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
+        raise VersionerError("unable to get revision of {}: {}".format(file_object, e))
+    cached = blob_cache.get(blob_id) if blob_cache is not None and blob_id is not None else None
+    if cached is not None:
+        blob = FetchedBlob({"id": blob_id, "path": file_object, "type": "blob"}, cached[0], cached[1], True,
+            last_commit_id)
+    else:
+        # the blob and commit of the contents, which may be newer than the HEAD request
+        revision = get_file(gitlab_request, file_object)
+        blob = FetchedBlob({"id": revision.blob_id, "path": file_object, "type": "blob"}, revision.content,
+            None, False, revision.last_commit_id)
+    result, references = transform_blob(blob, image_tag, blob_cache is not None)
+    record_rewrite(blob, result)
+    if blob_cache is not None and not blob.cached and blob.file["id"] is not None:
+        blob_cache.put(blob.file["id"], blob.content, references)
+    commit_blob = result["commit_blob"]
+    if not commit_blob:
+        return [], set()
+    if spool is not None:
+        commit_blob = spool.add(commit_blob)
+    return [commit_blob], result["changed_image_tags"]
+
+@metrics.timed("change")
+def change_image_tag(gitlab_request: GitlabRequest, file_object: str, image_tag: str,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        fetch_strategy: str = "rest",
+        graphql_batch_size: int = DEFAULT_GRAPHQL_BATCH_SIZE,
+        archive_threshold: int = DEFAULT_ARCHIVE_THRESHOLD,
+        execution: str = DEFAULT_EXECUTION,
+        spool: typing.Optional["ContentSpool"] = None) -> typing.Tuple[typing.Any, set]:
+    if fetch_strategy not in FETCH_STRATEGIES:
+        raise VersionerError("unknown fetch strategy {}".format(fetch_strategy))
+    if execution not in EXECUTION_MODES:
+        raise VersionerError("unknown execution {}".format(execution))
+    get_client(gitlab_request.url, gitlab_request.api_token, max_concurrency)
+    if file_object and is_manifest_path(file_object):
+        changes = change_single_file(gitlab_request, file_object, image_tag, blob_cache, spool)
+        if changes is not None:
+            return changes
+    batch_size = graphql_batch_size if fetch_strategy == "graphql" else 1
+    try:
+        # files are fetched and rewritten while the rest of the tree is listed,
+        # except when they might be read from an archive, which needs the
+        # full listing to know which files to read
+        with open_executors(execution, max_concurrency) as (io_executor, transform_executor):
+            pipeline = RewritePipeline(image_tag, blob_cache, io_executor, transform_executor,
+                max_concurrency * PIPELINE_DEPTH, spool)
+            found = False
+            futures = []
+            batch: typing.List[typing.Dict] = []
+            archive_candidates: typing.List[typing.Dict] = []
+            for n in iter_target_tree(gitlab_request, file_object, io_executor):
+                found = found or in_path(n["path"], file_object)
+                if is_manifest(n, file_object):
+                    if fetch_strategy in ["archive", "auto"]:
+                        archive_candidates.append(n)
+                        continue
+                    batch.append(n)
+                    if len(batch) >= batch_size:
+                        futures.append(pipeline.submit(fetch_blobs, gitlab_request, batch, blob_cache,
+                            fetch_strategy))
+                        batch = []
+            if batch:
+                futures.append(pipeline.submit(fetch_blobs, gitlab_request, batch, blob_cache, fetch_strategy))
+            if not file_object=="" and not found:
+                pipeline.cancel()
+                raise VersionerFileNotFound("File or dir {} not found".format(file_object))
+            if fetch_strategy == "archive" or len(archive_candidates) > archive_threshold:
+                futures.extend(submit_archive_blobs(gitlab_request, archive_candidates, file_object, blob_cache,
+                    pipeline))
+            else:
+                futures.extend(pipeline.submit(fetch_blobs, gitlab_request, [n], blob_cache)
+                    for n in archive_candidates)
+            # results are collected in the order of the tree listing and the
+            # first error from a worker, e.g. a VersionerError, is re-raised
+            results = [r for f in futures for r in f.result()]
+            changes = [changes for changes in results
+                                if not changes["commit_blob"]=={}]
+        parsed = len([r for r in results if r["parsed"]])
+        logger.info("parsed %d manifests, skipped %d by pre-scan or with cached image references",
+            parsed, len(results) - parsed)
         proposed_commits = []
         changed_image_tags: set = set()
         for change in changes:
             proposed_commits.append(change["commit_blob"])
             changed_image_tags.update(change["changed_image_tags"])
         return proposed_commits, changed_image_tags
-    except requests.exceptions.HTTPError as e:
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError,
+            requests.exceptions.ChunkedEncodingError) as e:
         raise VersionerError("unable to get contents of dir: {}: {}".format(
             file_object, e))
 
 
+# bytes of rewritten contents kept in memory by set-new-version before the
+# rest is spilled to temporary files
+DEFAULT_SPILL_THRESHOLD = 64 * 1024 * 1024
+
+class ContentSpool:
+    r"""keep rewritten contents in memory up to threshold bytes and in temporary files beyond that.
+
+    A spilled proposed commit has a content_file instead of its content,
+    read_content reads either. The files are removed when the spool is
+    closed, so it has to stay open until the changes are committed.
+    """
+    def __init__(self, threshold: int = DEFAULT_SPILL_THRESHOLD):
+        self.threshold = threshold
+        self.size = 0
+        self.spilled = 0
+        self.directory: typing.Optional[tempfile.TemporaryDirectory] = None
+        self._lock = threading.Lock()
+
+    def add(self, proposed_commit: typing.Dict) -> typing.Dict:
+        r"""return proposed_commit, with its content moved to a file if the spool is full"""
+        # characters, not bytes, to avoid encoding every file just to count it
+        size = len(proposed_commit["content"])
+        with self._lock:
+            if self.size + size <= self.threshold:
+                self.size += size
+                return proposed_commit
+            if self.directory is None:
+                self.directory = tempfile.TemporaryDirectory(prefix="deployversioner-")
+            self.spilled += 1
+            path = os.path.join(self.directory.name, "{}.yml".format(self.spilled))
+        with open(path, "w", encoding="utf8") as fp:
+            fp.write(proposed_commit["content"])
+        spilled = {k: v for k, v in proposed_commit.items() if k != "content"}
+        spilled["content_file"] = path
+        return spilled
+
+    def close(self) -> None:
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+
+    def __enter__(self) -> "ContentSpool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def read_content(proposed_commit: typing.Dict) -> str:
+    r"""return the new content of a proposed commit, which may have been spilled to a file"""
+    if "content" in proposed_commit:
+        return proposed_commit["content"]
+    with open(proposed_commit["content_file"], encoding="utf8") as fp:
+        return fp.read()
+
+class CommitBody:
+    r"""json body of a commit, serialised one action at a time while it is sent.
+
+    requests sends an iterable body with chunked transfer encoding, so the
+    whole payload never is in memory at once and spilled contents are read
+    back one file at a time. Every iteration produces the whole body again.
+
+    :param compress with gzip, which needs a Content-Encoding header
+    """
+    def __init__(self, branch: str, commit_message: str, proposed_commits: typing.List[typing.Dict],
+            compress: bool = False):
+        self.branch = branch
+        self.commit_message = commit_message
+        self.proposed_commits = proposed_commits
+        self.compress = compress
+        # bytes produced by the last iteration
+        self.size = 0
+
+    def actions(self) -> typing.Iterator[typing.Dict]:
+        for proposed_commit in self.proposed_commits:
+            action = {"action": "update", "file_path": proposed_commit["file_path"],
+                "content": read_content(proposed_commit)}
+            if proposed_commit.get("last_commit_id") is not None:
+                action["last_commit_id"] = proposed_commit["last_commit_id"]
+            yield action
+
+    def chunks(self) -> typing.Iterator[bytes]:
+        head = json.dumps({"branch": self.branch, "commit_message": self.commit_message})
+        yield '{}, "actions": ['.format(head[:-1]).encode("utf8")
+        for n, action in enumerate(self.actions()):
+            yield "{}{}".format(", " if n > 0 else "", json.dumps(action)).encode("utf8")
+        yield b"]}"
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        self.size = 0
+        compressor = zlib.compressobj(wbits=31) if self.compress else None
+        for chunk in self.chunks():
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            # an empty chunk would end a chunked body
+            if chunk:
+                self.size += len(chunk)
+                yield chunk
+        if compressor is not None:
+            chunk = compressor.flush()
+            self.size += len(chunk)
+            yield chunk
+
 def format_commit_message(tag: str, changed_image_tags: typing.Set[str]):
     lines = ["Bump docker tag from {} to {}".format(existing_image_tag, tag) for existing_image_tag in
             changed_image_tags]
     return "Bump docker tag to {}\n\n{}".format(tag, "\n".join(lines))
 
-def commit_changes(gitlab_request: GitlabRequest, proposed_commits: dict, tag:str, changed_image_tags: typing.Set[str]):
+# attempts at committing before giving up on conflicting commits
+DEFAULT_COMMIT_ATTEMPTS = 4
+# upper bound in seconds of the random delay before the first retry of a
+# commit, doubled on every attempt so competing pipelines spread out
+COMMIT_RETRY_JITTER = 0.25
+
+def rebase_content(content: str, proposed_commit: typing.Dict, tag: str) -> typing.Tuple[str, set]:
+    r"""rewrite the current contents of the file of a proposed commit made by change_image_tag"""
+    # a merged commit can set different tags in different files
+    return rewrite_image_tags(content, proposed_commit.get("tag", tag))
+
+def pin_proposed_commits(gitlab_request: GitlabRequest, proposed_commits: typing.List[typing.Dict],
+        tag: str, repin: bool = True, rebase: typing.Callable[[str, typing.Dict, str], typing.Tuple[str, set]]
+        = rebase_content) -> typing.Tuple[typing.List[typing.Dict], typing.Set[str], int]:
+    r"""set the last_commit_id of every proposed commit from the current branch.
+
+    With repin False only the commits without a last_commit_id, e.g. of
+    files read from the blob cache, are looked up. A file whose blob is still the one the change was based on is pinned to
+    the last commit that changed it, so gitlab rejects the commit if the
+    file changes before it is made. A file which has changed since is
+    fetched again and the tag is rewritten in its new contents with
+    rebase(content, proposed_commit, tag); it is dropped if it already has
+    the tag.
+
+    Returns the pinned commits, the image tags replaced in rebased files and
+    the number of rebased files.
+    """
+    def pin(proposed_commit: typing.Dict) -> typing.Tuple[typing.Optional[typing.Dict], set, bool]:
+        if not repin and proposed_commit.get("last_commit_id") is not None:
+            return proposed_commit, set(), False
+        with metrics.http_phase("commit"):
+            return pin_file(proposed_commit)
+    def pin_file(proposed_commit: typing.Dict) -> typing.Tuple[typing.Optional[typing.Dict], set, bool]:
+        revision = get_file_revision(gitlab_request, proposed_commit["file_path"])
+        if revision.blob_id == proposed_commit.get("blob_id"):
+            return dict(proposed_commit, last_commit_id=revision.last_commit_id), set(), False
+        revision = get_file(gitlab_request, proposed_commit["file_path"])
+        logger.info("rebasing %s on %s", proposed_commit["file_path"], revision.last_commit_id)
+        try:
+            content, changed_tags = rebase(revision.content, proposed_commit, tag)
+        except VersionUnchangedException:
+            return None, set(), True
+        return dict(proposed_commit, content=content, blob_id=revision.blob_id,
+            last_commit_id=revision.last_commit_id, changed_image_tags=sorted(changed_tags)), changed_tags, True
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=client.max_concurrency) as executor:
+        results = list(executor.map(pin, proposed_commits))
+    changed_image_tags: typing.Set[str] = set()
+    for _, changed_tags, _ in results:
+        changed_image_tags.update(changed_tags)
+    return ([c for c, _, _ in results if c is not None], changed_image_tags,
+        len([r for r in results if r[2]]))
+
+def post_commit(client: GitlabClient, url: str, body: CommitBody) -> requests.Response:
+    r"""post a commit, uncompressed from now on if gitlab refuses a compressed one.
+
+    A gitlab or proxy that can't decode the body may answer 400 rather than
+    415, like gitlab answers a conflict. A commit refused with 400 is sent
+    again uncompressed and compression is only kept if that is refused too.
+    """
+    headers = {"Content-Type": "application/json"}
+    if not body.compress:
+        return client.post(url, headers=headers, data=body)
+    response = client.post(url, headers=dict(headers, **{"Content-Encoding": "gzip"}), data=body)
+    if response.status_code not in (400, 415):
+        return response
+    body.compress = False
+    uncompressed = client.post(url, headers=headers, data=body)
+    body.compress = True
+    if response.status_code == 415 or uncompressed.status_code != 400:
+        logger.warning("gitlab refused a compressed commit, sending commits uncompressed")
+        client.compress_commits = False
+        body.compress = False
+    return uncompressed
+
+@metrics.timed("commit")
+def commit_changes(gitlab_request: GitlabRequest, proposed_commits: dict, tag:str, changed_image_tags: typing.Set[str],
+        max_attempts: int = DEFAULT_COMMIT_ATTEMPTS, commit_message: typing.Optional[str] = None,
+        rebase: typing.Callable[[str, typing.Dict, str], typing.Tuple[str, set]] = rebase_content):
+    r"""commit proposed_commits to the branch of gitlab_request.
+
+    Every file is pinned to the commit its change is based on, which is only
+    looked up for the files it isn't known for since they were fetched. If
+    gitlab rejects the commit because a file has been changed in the
+    meantime, e.g. by a parallel pipeline, every file is looked up again and
+    only the changed ones are fetched again and rewritten before retrying
+    after a short random delay.
+
+    :param commit_message to use instead of one made from tag and changed_image_tags
+    :param rebase to rewrite changed files with, see pin_proposed_commits
+    :return the commit as returned by gitlab
+    """
     if len(proposed_commits)==0:
         raise VersionUnchangedException("no changes found.")
-    commit_blob={"branch": gitlab_request.branch, "commit_message": format_commit_message(tag, changed_image_tags), "actions":[]}
-    for proposed_commit in proposed_commits:
-        commit_blob["actions"].append({"action": "update", "file_path": proposed_commit["file_path"], "content": proposed_commit["content"]})
-    url = gitlab_request.url
-    if url[:4] != "http":
-        url = "https://{}".format(url)
-    headers = {"private-token": gitlab_request.api_token, "Content-Type": "application/json"}
-    url = "{}/api/v4/projects/{}/repository/commits?ref={}".format(url,
+    client = get_client(gitlab_request.url, gitlab_request.api_token)
+    url = client.api_url("projects/{}/repository/commits?ref={}".format(
         gitlab_request.project_id,
-        gitlab_request.branch)
-    try:
-        session = requests.Session()
-        # Normally status 400 means that you shouldn't retry the request but in this case it seems to work
-        adapter = HTTPAdapter(max_retries=Retry(total=3,
-            status_forcelist=[400], allowed_methods=["POST"],
-            backoff_factor=2))
-        session.mount("http://", adapter)
-        session.mount("https://", adapter)
-        response = session.post(url, headers=headers, data=json.dumps(commit_blob))
-        response.raise_for_status()
-        js = response.json()
-        if js["status"] is not None:
-            raise VersionerError(f"Unable to do commit with data {commit_blob}. Status from {url} is {js}")
-    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
-        raise VersionerError("unable to do commit to repository at: {}  with docker-tag:{}\n {}".format(
-            url, tag, e))
+        gitlab_request.branch))
+    changed_image_tags = set(changed_image_tags)
+    for attempt in range(max_attempts):
+        proposed_commits, rebased_tags, rebased = pin_proposed_commits(gitlab_request, proposed_commits, tag,
+            attempt > 0, rebase)
+        changed_image_tags.update(rebased_tags)
+        if len(proposed_commits) == 0:
+            raise VersionUnchangedException("no changes found.")
+        if attempt > 0 and rebased == 0:
+            # the commit wasn't rejected because of a conflict
+            break
+        body = CommitBody(gitlab_request.branch, commit_message or format_commit_message(tag, changed_image_tags),
+            proposed_commits, client.compress_commits)
+        try:
+            response = post_commit(client, url, body)
+            if response.status_code == 400 and attempt + 1 < max_attempts:
+                logger.info("commit to %s was rejected: %s", gitlab_request.branch, response.text)
+                time.sleep(random.uniform(0, COMMIT_RETRY_JITTER * 2 ** attempt))
+                continue
+            raise_for_status(response)
+            js = response.json()
+            if js["status"] is not None:
+                raise VersionerError(f"Unable to do commit of {len(proposed_commits)} files. Status from {url} is {js}")
+            return js
+        except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
+            raise VersionerError("unable to do commit to repository at: {}  with docker-tag:{}\n {}".format(
+                url, tag, e))
+    raise VersionerError("unable to do commit to repository at: {}  with docker-tag:{}\n {}".format(
+        url, tag, response.text))
 
 def setup_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -205,30 +1296,172 @@ def setup_args() -> argparse.Namespace:
     parser.add_argument("--gitlab-url", default="https://gitlab.dbc.dk")
     parser.add_argument("-n", "--dry-run", action="store_true",
         help="don't commit changes, print them to stdout")
+    parser.add_argument("--max-concurrency", type=positive_int,
+        default=DEFAULT_MAX_CONCURRENCY,
+        help="number of files to fetch and rewrite in parallel (default: %(default)s)")
+    parser.add_argument("--fetch-strategy", choices=FETCH_STRATEGIES, default="rest",
+        help="fetch every file with its own rest request, batches of files with graphql, all files "
+             "in one archive or choose between rest and archive by the number of files (default: %(default)s)")
+    parser.add_argument("--graphql-batch-size", type=positive_int, default=DEFAULT_GRAPHQL_BATCH_SIZE,
+        help="number of files fetched per graphql request (default: %(default)s)")
+    parser.add_argument("--archive-threshold", type=positive_int, default=DEFAULT_ARCHIVE_THRESHOLD,
+        help="number of files above which the auto fetch strategy downloads an archive (default: %(default)s)")
+    parser.add_argument("--execution", choices=EXECUTION_MODES, default=DEFAULT_EXECUTION,
+        help="rewrite files one after another, in the threads fetching them or in a pool of "
+             "processes (default: %(default)s)")
+    parser.add_argument("--spill-threshold", type=positive_int,
+        default=DEFAULT_SPILL_THRESHOLD // (1024 * 1024),
+        help="MiB of rewritten files kept in memory, the rest is kept in temporary files "
+             "until it is committed (default: %(default)s)")
+    parser.add_argument("--gzip-commits", action="store_true",
+        help="send commits gzip compressed, falling back to uncompressed if gitlab refuses them with 400 or 415")
+    parser.add_argument("--backend", choices=["api", "git"], default="api",
+        help="read and commit files with the gitlab api or with a sparse, shallow git "
+             "working copy kept in the cache dir (default: %(default)s)")
+    parser.add_argument("--git-url",
+        help="url of the repository for the git backend (default: the project on gitlab-url)")
+    parser.add_argument("--cache-dir", default=cache.default_cache_dir(),
+        help="directory to cache files and lookups in between runs (default: %(default)s)")
+    parser.add_argument("--cache-max-size", type=positive_int,
+        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="size in MiB the file cache is kept below (default: %(default)s)")
+    parser.add_argument("--project-id", type=int,
+        help="numeric id of the project, skips looking it up by project-name")
+    parser.add_argument("--project-id-ttl", type=positive_int,
+        default=cache.DEFAULT_PROJECT_ID_TTL,
+        help="seconds to cache the id of a project (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+        help="don't read or write the cache")
+    add_metrics_arguments(parser)
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="print what is being done to stderr")
     args = parser.parse_args()
     return args
 
+def add_metrics_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--metrics-json", action="store_true",
+        help="print timings per phase and http requests per phase as json to stderr when done")
+    parser.add_argument("--metrics-textfile", metavar="PATH",
+        help="write the metrics of the run to PATH for the textfile collector of prometheus node exporter")
 
-def main():
-    args = setup_args()
+def start_metrics(args: argparse.Namespace) -> None:
+    if args.metrics_json or args.metrics_textfile:
+        metrics.enable()
+
+def finish_metrics(args: argparse.Namespace) -> None:
+    r"""stop recording metrics and print or write what was recorded"""
+    recorded = metrics.current
+    if recorded is None:
+        return
+    metrics.disable()
+    if args.metrics_json:
+        print(recorded.dumps(), file=sys.stderr)
+    if args.metrics_textfile:
+        try:
+            recorded.write_prometheus(args.metrics_textfile)
+        except OSError as e:
+            logger.warning("unable to write metrics to %s: %s", args.metrics_textfile, e)
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
+@metrics.timed("project_lookup")
+def resolve_project_id(gitlab_url: str, api_token: str, project_name: str,
+        project_id_cache: typing.Optional[cache.ProjectIdCache]) -> typing.Tuple[int, bool]:
+    r"""return the id of project_name and whether it came from project_id_cache"""
+    if project_id_cache is not None:
+        project_id = project_id_cache.get(gitlab_url, project_name)
+        if project_id is not None:
+            logger.info("using cached id %d of project %s", project_id, project_name)
+            return project_id, True
+    project_id = get_project_number("{}/api/v4/projects".format(gitlab_url), project_name, api_token)
+    if project_id_cache is not None:
+        project_id_cache.put(gitlab_url, project_name, project_id)
+    return project_id, False
+
+def run_with_project_id(gitlab_url: str, api_token: str, project_name: str,
+        project_id_cache: typing.Optional[cache.ProjectIdCache],
+        run: typing.Callable[[int], typing.Any]) -> typing.Any:
+    r"""call run with the id of project_name and return its result.
+
+    If run raises VersionerProjectNotFound for an id from project_id_cache,
+    the project has probably been moved since its id was cached, so the id
+    is looked up again and run is called once more.
+    """
+    project_id, from_cache = resolve_project_id(gitlab_url, api_token, project_name, project_id_cache)
     try:
-        project_id = get_project_number("{}/api/v4/projects".format(args.gitlab_url), args.project_name, args.gitlab_api_token)
+        return run(project_id)
+    except VersionerProjectNotFound:
+        if not from_cache:
+            raise
+        logger.info("cached id %d of project %s is no longer valid", project_id, project_name)
+        project_id_cache.invalidate(gitlab_url, project_name)
+        project_id, _ = resolve_project_id(gitlab_url, api_token, project_name, project_id_cache)
+        return run(project_id)
 
-        gitlab_request = GitlabRequest(args.gitlab_url,
-            args.gitlab_api_token, project_id, args.branch)
+def update_deployment(args: argparse.Namespace, project_id: int,
+        blob_cache: typing.Optional[cache.BlobCache]) -> None:
+    gitlab_request = GitlabRequest(args.gitlab_url,
+        args.gitlab_api_token, project_id, args.branch)
 
-        proposed_commits, changed_image_tags = change_image_tag(gitlab_request, args.deployment_configuration, args.image_tag)
+    with ContentSpool(args.spill_threshold * 1024 * 1024) as spool:
+        proposed_commits, changed_image_tags = change_image_tag(gitlab_request, args.deployment_configuration,
+            args.image_tag, args.max_concurrency, blob_cache, args.fetch_strategy, args.graphql_batch_size,
+            args.archive_threshold, args.execution, spool)
 
         if args.dry_run:
-            for proposed_commit in proposed_commits:
-                print("\n\nFile: {}".format(proposed_commit['file_path']))
-                print("=" * (len(proposed_commit['file_path']) + 6))
-                print(proposed_commit['content'])
+            print_proposed_commits(proposed_commits)
         else:
             commit_changes(gitlab_request, proposed_commits, args.image_tag, changed_image_tags)
 
+def print_proposed_commits(proposed_commits: typing.List[typing.Dict]) -> None:
+    for proposed_commit in proposed_commits:
+        print("\n\nFile: {}".format(proposed_commit['file_path']))
+        print("=" * (len(proposed_commit['file_path']) + 6))
+        print(read_content(proposed_commit))
+
+def update_deployment_with_git(args: argparse.Namespace,
+        blob_cache: typing.Optional[cache.BlobCache]) -> None:
+    remote_url = args.git_url or gitbackend.repository_url(args.gitlab_url, args.project_name)
+    with gitbackend.open_working_copy(remote_url, args.gitlab_api_token,
+            None if args.no_cache else args.cache_dir) as working_copy:
+        proposed_commits, changed_image_tags = gitbackend.change_image_tag(working_copy, args.branch,
+            args.deployment_configuration, args.image_tag, blob_cache)
+        if args.dry_run:
+            print_proposed_commits(proposed_commits)
+        else:
+            gitbackend.commit_changes(working_copy, args.branch, proposed_commits, args.image_tag,
+                changed_image_tags)
+
+def main():
+    args = setup_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+    logger.info("using %s yaml backend", yamlbackend.default_backend().name)
+    # size the shared connection pool before anything else uses it
+    get_client(args.gitlab_url, args.gitlab_api_token, args.max_concurrency).compress_commits = args.gzip_commits
+    blob_cache = None
+    project_id_cache = None
+    if not args.no_cache:
+        blob_cache = cache.BlobCache(args.cache_dir, args.cache_max_size * 1024 * 1024)
+        project_id_cache = cache.ProjectIdCache(args.cache_dir, args.project_id_ttl)
+    start_metrics(args)
+    try:
+        if args.backend == "git":
+            update_deployment_with_git(args, blob_cache)
+        elif args.project_id is not None:
+            update_deployment(args, args.project_id, blob_cache)
+        else:
+            run_with_project_id(args.gitlab_url, args.gitlab_api_token, args.project_name,
+                project_id_cache, lambda project_id: update_deployment(args, project_id, blob_cache))
+
     except VersionUnchangedException as e:
         print(e)
     except VersionerError as e:
         print("caught unexpected error: {}".format(e), file=sys.stderr)
         sys.exit(1)
+    finally:
+        finish_metrics(args)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import base64
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import typing
+import urllib.parse
+
+from deployversioner import cache
+from deployversioner import deployversioner
+
+logger = logging.getLogger(__name__)
+
+# committer of the changes unless GIT_AUTHOR_NAME, GIT_COMMITTER_NAME etc. are set
+DEFAULT_AUTHOR_NAME = "deployversioner"
+DEFAULT_AUTHOR_EMAIL = "deployversioner@localhost"
+
+def glob_escape(path: str) -> str:
+    r"""escape path for use as a sparse-checkout pattern"""
+    return re.sub(r"([\\*?\[!#])", r"\\\1", path)
+
+def repository_url(gitlab_url: str, project_name: str) -> str:
+    return "{}/{}.git".format(deployversioner.normalize_url(gitlab_url), project_name)
+
+def mirror_directory(cache_dir: str, remote_url: str) -> str:
+    r"""return the directory the working copy of remote_url is kept in below cache_dir"""
+    return os.path.join(cache_dir, "git", hashlib.sha1(remote_url.encode("utf8")).hexdigest())
+
+class GitWorkingCopy:
+    r"""shallow, sparse working copy of a remote repository kept between runs.
+
+    Only the last commit of a branch is fetched and only the files being
+    changed are checked out. Other blobs aren't downloaded when the remote
+    supports partial clones. Later runs reuse the working copy and
+    only fetch what changed since.
+
+    :param remote_url of the repository, an url or the path of a local repository
+    :param directory to keep the working copy in
+    :param api_token sent as the password of basic auth over http(s), it is
+        passed to git in its environment, never on its command line or in the
+        git config
+    """
+    def __init__(self, remote_url: str, directory: str, api_token: typing.Optional[str] = None):
+        self.remote_url = remote_url
+        self.directory = directory
+        self.api_token = api_token
+
+    def git(self, *args: str, input: typing.Optional[str] = None) -> str:
+        command = ["git", "-c", "user.name={}".format(DEFAULT_AUTHOR_NAME),
+            "-c", "user.email={}".format(DEFAULT_AUTHOR_EMAIL)] + list(args)
+        logger.info("git %s", " ".join(args))
+        try:
+            process = subprocess.run(command, cwd=self.directory, env=self.environment(), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, check=True, input=None if input is None else input.encode("utf8"))
+        except FileNotFoundError:
+            raise deployversioner.VersionerError("git is needed for the git backend")
+        except subprocess.CalledProcessError as e:
+            raise deployversioner.VersionerError("git {} failed: {}".format(args[0],
+                e.stderr.decode("utf8", "replace").strip()))
+        return process.stdout.decode("utf8")
+
+    def environment(self) -> typing.Dict[str, str]:
+        r"""return the environment of git, with the header authenticating with api_token over http(s).
+
+        The header is configured with GIT_CONFIG_COUNT, since the command
+        line of a process can be read by every user of the machine.
+        """
+        env = dict(os.environ)
+        if self.api_token and urllib.parse.urlsplit(self.remote_url).scheme in ["http", "https"]:
+            credentials = base64.b64encode("oauth2:{}".format(self.api_token).encode("utf8")).decode("ascii")
+            # keep any configuration passed to deployversioner the same way
+            count = int(env.get("GIT_CONFIG_COUNT") or 0)
+            env["GIT_CONFIG_KEY_{}".format(count)] = "http.extraHeader"
+            env["GIT_CONFIG_VALUE_{}".format(count)] = "Authorization: Basic {}".format(credentials)
+            env["GIT_CONFIG_COUNT"] = str(count + 1)
+        return env
+
+    @contextlib.contextmanager
+    def lock(self) -> typing.Iterator[None]:
+        r"""keep other processes from using the working copy"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".deployversioner.lock"), "w") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def fetch(self, branch: str) -> str:
+        r"""fetch the last commit of branch and return the ref it was fetched to"""
+        if not os.path.isdir(os.path.join(self.directory, ".git")):
+            self.git("init", "-q")
+            self.git("remote", "add", "origin", self.remote_url)
+            # what git clone --filter=blob:none sets up
+            self.git("config", "remote.origin.promisor", "true")
+            self.git("config", "remote.origin.partialclonefilter", "blob:none")
+        else:
+            self.git("remote", "set-url", "origin", self.remote_url)
+        ref = "refs/remotes/origin/{}".format(branch)
+        self.git("fetch", "-q", "--depth", "1", "--no-tags", "origin",
+            "+refs/heads/{}:{}".format(branch, ref))
+        return ref
+
+    def tree(self, ref: str, path: str) -> typing.List[typing.Dict]:
+        r"""return the entries below path of ref like the gitlab tree api does.
+
+        Listing the tree doesn't need any blobs.
+        """
+        args = ["ls-tree", "-r", "-t", "-z", ref]
+        if path:
+            args += ["--", path + "/"]
+        entries = []
+        for line in self.git(*args).split("\0"):
+            if not line:
+                continue
+            info, file_path = line.split("\t", 1)
+            mode, kind, sha = info.split(" ")
+            entries.append({"id": sha, "name": file_path.split("/")[-1], "type": kind,
+                "path": file_path, "mode": mode})
+        return entries
+
+    def checkout(self, branch: str, ref: str, paths: typing.List[str]) -> None:
+        r"""check out only paths of ref as branch, discarding any local changes"""
+        self.git("sparse-checkout", "set", "--no-cone", "--stdin",
+            input="".join("/{}\n".format(glob_escape(p)) for p in paths))
+        self.git("checkout", "-q", "--force", "-B", branch, ref)
+
+    def read(self, file_path: str) -> str:
+        with open(os.path.join(self.directory, file_path), encoding="utf8") as fp:
+            return fp.read()
+
+    def commit(self, branch: str, proposed_commits: typing.List[typing.Dict], message: str) -> None:
+        r"""commit the contents of proposed_commits and push them to branch"""
+        for proposed_commit in proposed_commits:
+            file_path = os.path.join(self.directory, proposed_commit["file_path"])
+            # files that were read from the cache aren't checked out
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w", encoding="utf8") as fp:
+                fp.write(proposed_commit["content"])
+        self.git("add", "--sparse", "--", *[c["file_path"] for c in proposed_commits])
+        self.git("commit", "-q", "-m", message)
+        self.git("push", "-q", "origin", "HEAD:refs/heads/{}".format(branch))
+
+@contextlib.contextmanager
+def open_working_copy(remote_url: str, api_token: typing.Optional[str],
+        cache_dir: typing.Optional[str]) -> typing.Iterator[GitWorkingCopy]:
+    r"""return a locked working copy of remote_url kept below cache_dir or a temporary one if cache_dir is None"""
+    with contextlib.ExitStack() as stack:
+        if cache_dir is None:
+            directory = stack.enter_context(tempfile.TemporaryDirectory(prefix="deployversioner-"))
+        else:
+            directory = mirror_directory(cache_dir, remote_url)
+        working_copy = GitWorkingCopy(remote_url, directory, api_token)
+        stack.enter_context(working_copy.lock())
+        yield working_copy
+
+def change_image_tag(working_copy: GitWorkingCopy, branch: str, file_object: str, image_tag: str,
+        blob_cache: typing.Optional[cache.BlobCache] = None) -> typing.Tuple[typing.List[typing.Dict], set]:
+    r"""like deployversioner.change_image_tag, with the files read from working_copy.
+
+    Only the manifests which aren't in blob_cache are checked out, so no
+    other blobs are downloaded. Manifests evicted from blob_cache after
+    that are checked out and read as well.
+    """
+    path = "/".join(file_object.split("/")[:-1])
+    ref = working_copy.fetch(branch)
+    entries = working_copy.tree(ref, path)
+    if not file_object == "" and not any(deployversioner.in_path(e["path"], file_object) for e in entries):
+        raise deployversioner.VersionerFileNotFound("File or dir {} not found".format(file_object))
+    manifests = [e for e in entries if deployversioner.is_manifest(e, file_object)]
+    uncached = [e["path"] for e in manifests if blob_cache is None or e["id"] not in blob_cache]
+    working_copy.checkout(branch, ref, uncached)
+    def rewrite(blob: deployversioner.FetchedBlob) -> typing.Dict:
+        result, references = deployversioner.transform_blob(blob, image_tag, blob_cache is not None)
+        deployversioner.record_rewrite(blob, result)
+        if blob_cache is not None and not blob.cached:
+            blob_cache.put(blob.file["id"], blob.content, references)
+        return result
+    def read(entry: typing.Dict) -> deployversioner.FetchedBlob:
+        return deployversioner.FetchedBlob(entry, working_copy.read(entry["path"]), None, False, None)
+    changes: typing.Dict[str, typing.Dict] = {}
+    evicted = []
+    checked_out = set(uncached)
+    for entry in manifests:
+        if entry["path"] in checked_out:
+            changes[entry["path"]] = rewrite(read(entry))
+            continue
+        cached = blob_cache.get(entry["id"]) if blob_cache is not None else None
+        if cached is None:
+            evicted.append(entry)
+            continue
+        changes[entry["path"]] = rewrite(deployversioner.FetchedBlob(entry, cached[0], cached[1], True, None))
+    if evicted:
+        working_copy.checkout(branch, ref, uncached + [e["path"] for e in evicted])
+        for entry in evicted:
+            changes[entry["path"]] = rewrite(read(entry))
+    proposed_commits = []
+    changed_image_tags: set = set()
+    for entry in manifests:
+        change = changes[entry["path"]]
+        if change["commit_blob"]:
+            proposed_commits.append(change["commit_blob"])
+            changed_image_tags.update(change["changed_image_tags"])
+    return proposed_commits, changed_image_tags
+
+def commit_changes(working_copy: GitWorkingCopy, branch: str, proposed_commits: typing.List[typing.Dict],
+        tag: str, changed_image_tags: typing.Set[str]) -> None:
+    r"""like deployversioner.commit_changes, pushing one commit from working_copy"""
+    if len(proposed_commits) == 0:
+        raise deployversioner.VersionUnchangedException("no changes found.")
+    working_copy.commit(branch, proposed_commits,
+        deployversioner.format_commit_message(tag, changed_image_tags))
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import re
+import typing
+
+import requests
+import yaml
+
+from deployversioner import cache
+from deployversioner import deployversioner
+from deployversioner import yamlbackend
+
+logger = logging.getLogger(__name__)
+
+# where an image is used: the file, the index of the yaml document in it,
+# the path of the image in the document, its current tag and the blob the
+# file was indexed at
+IndexEntry = collections.namedtuple("IndexEntry", ["path", "document", "container", "tag", "blob_id"])
+
+POD_SPEC_PATHS = {"CronJob": ["spec", "jobTemplate", "spec", "template", "spec"]}
+DEFAULT_POD_SPEC_PATH = ["spec", "template", "spec"]
+CONTAINER_LISTS = ["initContainers", "containers"]
+
+def find_images(file_contents: str, backend: typing.Optional[yamlbackend.YamlBackend] = None
+        ) -> typing.List[deployversioner.ImageReference]:
+    r"""return every container image of the workloads in file_contents.
+
+    Unlike find_image_references every container is included. The start of
+    an image which can't be rewritten in place is None.
+    """
+    if backend is None:
+        backend = yamlbackend.default_backend()
+    line_starts = [0] + [m.end() for m in re.finditer("\n", file_contents)]
+    references = []
+    for document, doc in enumerate(backend.compose_all(file_contents)):
+        kind = deployversioner.mapping_value(doc, "kind")
+        if not isinstance(kind, yaml.ScalarNode) or kind.value not in deployversioner.WORKLOAD_KINDS:
+            continue
+        pod_spec_path = POD_SPEC_PATHS.get(kind.value, DEFAULT_POD_SPEC_PATH)
+        try:
+            pod_spec = deployversioner.node_at_path(doc, pod_spec_path)
+        except deployversioner.InPlaceRewriteNotPossible:
+            continue
+        for container_list in CONTAINER_LISTS:
+            containers = deployversioner.mapping_value(pod_spec, container_list)
+            if not isinstance(containers, yaml.SequenceNode):
+                continue
+            for n, container in enumerate(containers.value):
+                image = deployversioner.mapping_value(container, "image")
+                if not isinstance(image, yaml.ScalarNode):
+                    continue
+                try:
+                    deployversioner.parse_image(image.value)
+                except deployversioner.VersionerError:
+                    logger.info("not indexing image without tag %s", image.value)
+                    continue
+                start: typing.Optional[int] = line_starts[image.start_mark.line] + image.start_mark.column
+                try:
+                    old_text = deployversioner.quote_scalar(image.value, image.style)
+                    if file_contents[start:start + len(old_text)] != old_text:
+                        start = None
+                except deployversioner.InPlaceRewriteNotPossible:
+                    start = None
+                references.append(deployversioner.ImageReference(document,
+                    "{}.{}[{}].image".format(".".join(pod_spec_path), container_list, n),
+                    image.value, start, image.style or None))
+    return references
+
+def image_name(image: str) -> str:
+    return deployversioner.parse_image(image)[0]
+
+class ImageIndex:
+    r"""reverse index from image names to where they are used in the files of a branch.
+
+    :param path of the directory which was indexed, "" for the whole branch
+    :param commit the index is up to date with, if known
+    """
+    def __init__(self, path: str = "", commit: typing.Optional[str] = None):
+        self.path = path
+        self.commit = commit
+        # file path -> blob id and image references of the file
+        self.files: typing.Dict[str, typing.Tuple[str, typing.List[deployversioner.ImageReference]]] = {}
+        self._images: typing.Optional[typing.Dict[str, typing.List[IndexEntry]]] = None
+
+    def update_file(self, path: str, blob_id: str, references: typing.List[deployversioner.ImageReference]) -> None:
+        self.files[path] = (blob_id, references)
+        self._images = None
+
+    def remove_file(self, path: str) -> None:
+        if self.files.pop(path, None) is not None:
+            self._images = None
+
+    def images(self) -> typing.Dict[str, typing.List[IndexEntry]]:
+        if self._images is None:
+            images: typing.Dict[str, typing.List[IndexEntry]] = {}
+            for path in sorted(self.files):
+                blob_id, references = self.files[path]
+                for reference in references:
+                    name, tag = deployversioner.parse_image(reference.image)
+                    images.setdefault(name, []).append(IndexEntry(path, reference.document,
+                        reference.path, tag, blob_id))
+            self._images = images
+        return self._images
+
+    def lookup(self, name: str) -> typing.List[IndexEntry]:
+        return self.images().get(name, [])
+
+    def to_json(self) -> typing.Dict:
+        return {"path": self.path, "commit": self.commit,
+            "files": {p: {"blob_id": b, "references": [list(r) for r in refs]}
+                for p, (b, refs) in self.files.items()}}
+
+    @classmethod
+    def from_json(cls, data: typing.Dict) -> "ImageIndex":
+        index = cls(data["path"], data["commit"])
+        for path, entry in data["files"].items():
+            index.update_file(path, entry["blob_id"],
+                [deployversioner.ImageReference(*r) for r in entry["references"]])
+        return index
+
+def index_file(cache_dir: str, gitlab_url: str, project_name: str, branch: str) -> str:
+    key = "{} {} {}".format(deployversioner.normalize_url(gitlab_url), project_name, branch)
+    return os.path.join(cache_dir, "indexes", "{}.json".format(hashlib.sha1(key.encode("utf8")).hexdigest()))
+
+def load_index(filename: str) -> typing.Optional[ImageIndex]:
+    try:
+        with open(filename, "rb") as fp:
+            return ImageIndex.from_json(json.loads(fp.read().decode("utf8")))
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+def save_index(filename: str, index: ImageIndex) -> None:
+    cache.write_atomically(filename, json.dumps(index.to_json()).encode("utf8"))
+
+def is_indexed(file: typing.Dict) -> bool:
+    return file['type'] == 'blob' and deployversioner.is_manifest_path(file['path'])
+
+def scan_file(gitlab_request: deployversioner.GitlabRequest, file: typing.Dict,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        file_contents: typing.Optional[str] = None) -> typing.List[deployversioner.ImageReference]:
+    r"""return the image references of a tree entry, which isn't fetched if it's in blob_cache"""
+    if file_contents is None and blob_cache is not None:
+        cached = blob_cache.get(file['id'])
+        if cached is not None:
+            file_contents = cached[0]
+    if file_contents is None:
+        file_contents = deployversioner.get_file_contents(gitlab_request, file['path'])
+        if blob_cache is not None:
+            try:
+                references = deployversioner.cacheable_image_references(file_contents)
+            except (deployversioner.VersionerError, yaml.YAMLError):
+                references = None
+            blob_cache.put(file['id'], file_contents, references)
+    if deployversioner.WORKLOAD_KIND_PATTERN.search(file_contents) is None:
+        return []
+    try:
+        return find_images(file_contents)
+    except yaml.YAMLError as e:
+        logger.warning("not indexing %s: %s", file['path'], e)
+        return []
+
+def build_index(gitlab_request: deployversioner.GitlabRequest, path: str = "",
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY) -> ImageIndex:
+    r"""scan every yaml file below path of the branch of gitlab_request"""
+    deployversioner.get_client(gitlab_request.url, gitlab_request.api_token, max_concurrency)
+    # the tree is listed at a fixed commit so the index is exactly up to date with it
+    head = deployversioner.get_branch_head(gitlab_request)
+    gitlab_request = gitlab_request._replace(branch=head)
+    index = ImageIndex(path, head)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [(n, executor.submit(scan_file, gitlab_request, n, blob_cache))
+                for n in deployversioner.iter_tree(gitlab_request, path, executor) if is_indexed(n)]
+            for file, future in futures:
+                index.update_file(file['path'], file['id'], future.result())
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
+        raise deployversioner.VersionerError("unable to index {}: {}".format(path, e))
+    logger.info("indexed %d files using %d images", len(index.files), len(index.images()))
+    return index
+
+def rewrite_image_by_dump(file_contents: str, name: str, new_image_tag: str,
+        backend: typing.Optional[yamlbackend.YamlBackend] = None) -> typing.Tuple[str, set]:
+    r"""set the tag of every container image called name by loading and dumping file_contents"""
+    if backend is None:
+        backend = yamlbackend.default_backend()
+    docs = [d for d in backend.load_all(file_contents) if d is not None]
+    changed_image_tags = set()
+    for doc in docs:
+        if not isinstance(doc, dict) or doc.get("kind") not in deployversioner.WORKLOAD_KINDS:
+            continue
+        pod_spec = doc
+        for key in POD_SPEC_PATHS.get(doc["kind"], DEFAULT_POD_SPEC_PATH):
+            pod_spec = pod_spec.get(key) if isinstance(pod_spec, dict) else None
+        if not isinstance(pod_spec, dict):
+            continue
+        for container_list in CONTAINER_LISTS:
+            for container in pod_spec.get(container_list) or []:
+                image = container.get("image") if isinstance(container, dict) else None
+                if not isinstance(image, str) or ":" not in image:
+                    continue
+                imagename, image_tag = deployversioner.parse_image(image)
+                if imagename == name and image_tag != new_image_tag:
+                    changed_image_tags.add(image_tag)
+                    container["image"] = "{}:{}".format(imagename, new_image_tag)
+    if not changed_image_tags:
+        raise deployversioner.VersionUnchangedException("new image tag matches old, nothing to do")
+    return backend.dump_all(docs), changed_image_tags
+
+def rewrite_image(file_contents: str, references: typing.List[deployversioner.ImageReference],
+        name: str, new_image_tag: str) -> typing.Tuple[str, set]:
+    r"""set the tag of the images called name at references in file_contents"""
+    references = [r for r in references if image_name(r.image) == name]
+    if any(r.start is None for r in references) or \
+            deployversioner.DOCKER_TAG_PATTERN.fullmatch(new_image_tag) is None:
+        return rewrite_image_by_dump(file_contents, name, new_image_tag)
+    return deployversioner.apply_image_tag(file_contents, references, new_image_tag)
+
+def bump_image(gitlab_request: deployversioner.GitlabRequest, index: ImageIndex, name: str,
+        new_image_tag: str, max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY
+        ) -> typing.Tuple[typing.List[typing.Dict], set]:
+    r"""set the tag of image name in the files which use it according to index.
+
+    Only those files are fetched. A file which has changed since it was
+    indexed is scanned again and the index is updated.
+
+    :return proposed commits and changed image tags like change_image_tag, which are committed
+        with rebase_image as their rebase
+    """
+    paths = sorted({e.path for e in index.lookup(name)})
+    if not paths:
+        raise deployversioner.VersionerError("image {} isn't used in {}".format(name, index.path or "the branch"))
+    def bump(path: str) -> typing.Tuple[typing.Optional[typing.Dict], set, deployversioner.FileRevision,
+            typing.List[deployversioner.ImageReference]]:
+        revision = deployversioner.get_file(gitlab_request, path)
+        blob_id, references = index.files[path]
+        if revision.blob_id != blob_id:
+            references = find_images(revision.content)
+        try:
+            content, changed_image_tags = rewrite_image(revision.content, references, name, new_image_tag)
+        except deployversioner.VersionUnchangedException:
+            return None, set(), revision, references
+        return ({"action": "update", "file_path": path, "content": content, "blob_id": revision.blob_id,
+            "last_commit_id": revision.last_commit_id, "image": name}, changed_image_tags, revision, references)
+    deployversioner.get_client(gitlab_request.url, gitlab_request.api_token, max_concurrency)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        results = list(executor.map(bump, paths))
+    proposed_commits = []
+    changed_image_tags: set = set()
+    for path, (proposed_commit, tags, revision, references) in zip(paths, results):
+        if revision.blob_id != index.files[path][0]:
+            index.update_file(path, revision.blob_id, references)
+        if proposed_commit is not None:
+            proposed_commits.append(proposed_commit)
+            changed_image_tags.update(tags)
+    return proposed_commits, changed_image_tags
+
+def rebase_image(content: str, proposed_commit: typing.Dict, tag: str) -> typing.Tuple[str, set]:
+    r"""rewrite the current contents of the file of a proposed commit made by bump_image"""
+    return rewrite_image(content, find_images(content), proposed_commit["image"], proposed_commit.get("tag", tag))
+
+def record_commit(index: ImageIndex, proposed_commits: typing.List[typing.Dict],
+        commit: typing.Optional[typing.Dict] = None) -> None:
+    r"""update index with the files of a commit that was made.
+
+    :param commit as returned by gitlab, the index is moved to it if it was
+        made directly on top of the commit of the index
+    """
+    for proposed_commit in proposed_commits:
+        index.update_file(proposed_commit["file_path"],
+            deployversioner.git_blob_sha(proposed_commit["content"]), find_images(proposed_commit["content"]))
+    if commit is not None and index.commit is not None and commit.get("parent_ids") == [index.commit]:
+        index.commit = commit["id"]
+
+# number of changed files above which the index is built again instead of
+# refreshing it file by file
+DEFAULT_MAX_COMPARE_CHANGES = 200
+
+def in_index_path(index: ImageIndex, path: typing.Optional[str]) -> bool:
+    return path is not None and deployversioner.in_path(path, index.path) and \
+        deployversioner.is_manifest_path(path)
+
+def compare(gitlab_request: deployversioner.GitlabRequest, from_commit: str, to_commit: str
+        ) -> typing.Optional[typing.List[typing.Dict]]:
+    r"""return the diffs between two commits or None if gitlab couldn't compare them"""
+    client = deployversioner.get_client(gitlab_request.url, gitlab_request.api_token)
+    url = client.api_url("projects/{}/repository/compare?from={}&to={}".format(
+        gitlab_request.project_id, from_commit, to_commit))
+    response = client.get(url)
+    # the old commit is gone, e.g. after a force push
+    if response.status_code == 404 and "Project Not Found" not in response.text:
+        return None
+    deployversioner.raise_for_status(response)
+    result = response.json()
+    if result.get("compare_timeout"):
+        return None
+    return result["diffs"]
+
+def refresh_index(gitlab_request: deployversioner.GitlabRequest, index: ImageIndex,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY,
+        max_changes: int = DEFAULT_MAX_COMPARE_CHANGES) -> ImageIndex:
+    r"""bring index up to date with the branch of gitlab_request.
+
+    Only the yaml files added, changed, renamed or deleted since the commit
+    of the index are looked at. The index is built again if it has no
+    commit, the commits can't be compared or more than max_changes files
+    changed.
+    """
+    if index.commit is None:
+        return build_index(gitlab_request, index.path, blob_cache, max_concurrency)
+    try:
+        head = deployversioner.get_branch_head(gitlab_request)
+        if head == index.commit:
+            return index
+        diffs = compare(gitlab_request, index.commit, head)
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
+        raise deployversioner.VersionerError("unable to compare {} to {}: {}".format(
+            index.commit, gitlab_request.branch, e))
+    if diffs is None or len(diffs) > max_changes:
+        logger.info("rebuilding index, unable to compare %s to %s", index.commit, head)
+        return build_index(gitlab_request, index.path, blob_cache, max_concurrency)
+    changed = []
+    for diff in diffs:
+        if in_index_path(index, diff.get("old_path")) and (diff.get("deleted_file") or diff.get("renamed_file")):
+            index.remove_file(diff["old_path"])
+        if in_index_path(index, diff.get("new_path")) and not diff.get("deleted_file"):
+            changed.append(diff["new_path"])
+    head_request = gitlab_request._replace(branch=head)
+    def scan(path: str) -> typing.Tuple[str, typing.List[deployversioner.ImageReference]]:
+        revision = deployversioner.get_file(head_request, path)
+        return revision.blob_id, scan_file(head_request, {"id": revision.blob_id, "path": path},
+            blob_cache, revision.content)
+    deployversioner.get_client(gitlab_request.url, gitlab_request.api_token, max_concurrency)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for path, (blob_id, references) in zip(changed, executor.map(scan, changed)):
+            index.update_file(path, blob_id, references)
+    logger.info("refreshed %d files of index from %s to %s", len(changed), index.commit, head)
+    index.commit = head
+    return index
+
+def get_index(gitlab_request: deployversioner.GitlabRequest, path: str = "",
+        filename: typing.Optional[str] = None, blob_cache: typing.Optional[cache.BlobCache] = None,
+        max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY) -> ImageIndex:
+    r"""return the up to date index of path, refreshing the one stored in filename if there is one"""
+    index = load_index(filename) if filename is not None else None
+    if index is None or index.path != path:
+        index = build_index(gitlab_request, path, blob_cache, max_concurrency)
+    else:
+        index = refresh_index(gitlab_request, index, blob_cache, max_concurrency)
+    if filename is not None:
+        save_index(filename, index)
+    return index
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import contextlib
+import functools
+import json
+import threading
+import time
+import typing
+import urllib.parse
+
+from deployversioner import cache
+
+# the metrics being recorded, None when recording is disabled. every hook
+# checks this first, so disabled metrics cost a global lookup per call
+current: typing.Optional["Metrics"] = None
+
+_disabled = contextlib.nullcontext()
+
+# phase set by http_phase for the requests of a thread
+_http_phases = threading.local()
+
+def request_phase(method: str, url: str) -> str:
+    r"""return the phase a request to the gitlab api belongs to, as set by http_phase or by its url"""
+    phase = getattr(_http_phases, "name", None)
+    if phase is not None:
+        return phase
+    path = urllib.parse.urlsplit(url).path
+    if path.endswith("/api/graphql") or "/repository/archive" in path or "/repository/files/" in path:
+        return "fetch"
+    if "/repository/tree" in path:
+        return "tree"
+    if "/repository/commits" in path:
+        return "commit"
+    if "/repository/branches/" in path or "/repository/compare" in path:
+        return "index"
+    return "project_lookup"
+
+class HttpStats:
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.received_bytes = 0
+        self.sent_bytes = 0
+        self.retries = 0
+        self.status: typing.Dict[int, int] = {}
+
+    def to_json(self) -> typing.Dict:
+        return {"requests": self.requests, "seconds": self.seconds, "received_bytes": self.received_bytes,
+            "sent_bytes": self.sent_bytes, "retries": self.retries,
+            "status": {str(k): v for k, v in sorted(self.status.items())}}
+
+class Metrics:
+    r"""time spent per phase, http requests per phase and rewrite time per file of a run.
+
+    Phases are timed by wall time. Since the tree is listed while files are
+    fetched and rewritten, the time of the http requests and of the
+    rewrites is summed separately per phase and file.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        # phase -> seconds and number of times it was entered
+        self.phases: typing.Dict[str, typing.List[float]] = {}
+        self.http: typing.Dict[str, HttpStats] = {}
+        # file path -> seconds spent rewriting it
+        self.files: typing.Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                entry = self.phases.setdefault(name, [0.0, 0])
+                entry[0] += elapsed
+                entry[1] += 1
+
+    @contextlib.contextmanager
+    def file(self, path: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_file(path, time.perf_counter() - start)
+
+    def record_file(self, path: str, seconds: float) -> None:
+        with self._lock:
+            self.files[path] = self.files.get(path, 0.0) + seconds
+
+    def record_response(self, method: str, url: str, status_code: int, seconds: float,
+            received_bytes: int, sent_bytes: int) -> None:
+        with self._lock:
+            stats = self.http.setdefault(request_phase(method, url), HttpStats())
+            stats.requests += 1
+            stats.seconds += seconds
+            stats.received_bytes += received_bytes
+            stats.sent_bytes += sent_bytes
+            stats.status[status_code] = stats.status.get(status_code, 0) + 1
+
+    def record_bytes(self, method: str, url: str, received_bytes: int) -> None:
+        with self._lock:
+            self.http.setdefault(request_phase(method, url), HttpStats()).received_bytes += received_bytes
+
+    def record_retry(self, method: str, url: str) -> None:
+        with self._lock:
+            self.http.setdefault(request_phase(method, url), HttpStats()).retries += 1
+
+    def to_json(self) -> typing.Dict:
+        with self._lock:
+            return {"started": self.started, "run_seconds": time.perf_counter() - self._start,
+                "phases": {k: {"seconds": v[0], "count": v[1]} for k, v in sorted(self.phases.items())},
+                "http": {k: v.to_json() for k, v in sorted(self.http.items())},
+                "files": dict(sorted(self.files.items()))}
+
+    def to_prometheus(self) -> str:
+        r"""return the metrics in the text format read by the textfile collector of node exporter"""
+        data = self.to_json()
+        lines = []
+        def metric(name: str, help: str, samples: typing.List[typing.Tuple[typing.Dict[str, str], float]]) -> None:
+            lines.append("# HELP deployversioner_{} {}".format(name, help))
+            lines.append("# TYPE deployversioner_{} gauge".format(name))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(k, v) for k, v in labels.items())
+                lines.append("deployversioner_{}{} {}".format(name,
+                    "{{{}}}".format(label_text) if label_text else "", value))
+        metric("last_run_timestamp_seconds", "Start of the last run.", [({}, data["started"])])
+        metric("run_seconds", "Wall time of the last run.", [({}, data["run_seconds"])])
+        metric("phase_seconds", "Wall time spent in a phase of the last run.",
+            [({"phase": k}, v["seconds"]) for k, v in data["phases"].items()])
+        metric("http_requests", "Http requests of the last run.",
+            [({"phase": k, "status": status}, n) for k, v in data["http"].items() for status, n in v["status"].items()])
+        metric("http_request_seconds", "Time spent waiting for http responses in the last run.",
+            [({"phase": k}, v["seconds"]) for k, v in data["http"].items()])
+        metric("http_received_bytes", "Bytes received over http in the last run.",
+            [({"phase": k}, v["received_bytes"]) for k, v in data["http"].items()])
+        metric("http_sent_bytes", "Bytes sent over http in the last run.",
+            [({"phase": k}, v["sent_bytes"]) for k, v in data["http"].items()])
+        metric("http_retries", "Retried http requests in the last run.",
+            [({"phase": k}, v["retries"]) for k, v in data["http"].items()])
+        metric("files_rewritten", "Files rewritten in the last run.", [({}, len(data["files"]))])
+        metric("file_rewrite_seconds", "Time spent rewriting files in the last run.",
+            [({}, sum(data["files"].values()))])
+        metric("file_rewrite_max_seconds", "Time spent rewriting the slowest file in the last run.",
+            [({}, max(data["files"].values(), default=0))])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        # the collector must never read a partially written file
+        cache.write_atomically(path, self.to_prometheus().encode("utf8"))
+
+    def dumps(self) -> str:
+        return json.dumps(self.to_json())
+
+def enable() -> Metrics:
+    global current
+    current = Metrics()
+    return current
+
+def disable() -> None:
+    global current
+    current = None
+
+def phase(name: str) -> typing.ContextManager:
+    r"""time a phase of the run if metrics are enabled"""
+    if current is None:
+        return _disabled
+    return current.phase(name)
+
+def file(path: str) -> typing.ContextManager:
+    r"""time the rewrite of a file if metrics are enabled"""
+    if current is None:
+        return _disabled
+    return current.file(path)
+
+def record_file(path: str, seconds: float) -> None:
+    r"""add the time of a rewrite of a file which was timed elsewhere, e.g. in another process"""
+    if current is not None:
+        current.record_file(path, seconds)
+
+@contextlib.contextmanager
+def _http_phase(name: str) -> typing.Iterator[None]:
+    previous = getattr(_http_phases, "name", None)
+    _http_phases.name = name
+    try:
+        yield
+    finally:
+        _http_phases.name = previous
+
+def http_phase(name: str) -> typing.ContextManager:
+    r"""count the http requests of this thread as phase name whatever their url, if metrics are enabled"""
+    if current is None:
+        return _disabled
+    return _http_phase(name)
+
+def timed(name: str) -> typing.Callable[[typing.Callable], typing.Callable]:
+    r"""decorator timing every call of a function as phase name if metrics are enabled"""
+    def decorate(function: typing.Callable) -> typing.Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if current is None:
+                return function(*args, **kwargs)
+            with current.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import logging
+import os
+import typing
+
+from deployversioner import cache
+from deployversioner import deployversioner
+from deployversioner import index
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+class Plan:
+    r"""the changes of an image tag update, made without committing them so they can be reviewed.
+
+    Besides the rewritten contents, the plan has the commit of the branch
+    it was made at and the blob and last commit of every file, so it can be
+    committed later without fetching anything again.
+
+    :param head commit of the branch the plan was made at
+    :param files path, blob_id, last_commit_id, changed_image_tags and content of every changed file
+    """
+    def __init__(self, gitlab_url: str, project_id: int, branch: str, path: str, image_tag: str,
+            head: str, changed_image_tags: typing.Iterable[str], files: typing.List[typing.Dict]):
+        self.gitlab_url = gitlab_url
+        self.project_id = project_id
+        self.branch = branch
+        self.path = path
+        self.image_tag = image_tag
+        self.head = head
+        self.changed_image_tags = sorted(changed_image_tags)
+        self.files = files
+
+    def gitlab_request(self, api_token: str) -> deployversioner.GitlabRequest:
+        return deployversioner.GitlabRequest(self.gitlab_url, api_token, self.project_id, self.branch)
+
+    def proposed_commits(self) -> typing.List[typing.Dict]:
+        return [{"action": "update", "file_path": f["path"], "content": f["content"], "blob_id": f["blob_id"],
+            "last_commit_id": f["last_commit_id"], "changed_image_tags": f["changed_image_tags"]}
+            for f in self.files]
+
+    def to_json(self) -> typing.Dict:
+        return {"version": PLAN_VERSION, "gitlab_url": self.gitlab_url, "project_id": self.project_id,
+            "branch": self.branch, "path": self.path, "image_tag": self.image_tag, "head": self.head,
+            "changed_image_tags": self.changed_image_tags, "files": self.files}
+
+    @classmethod
+    def from_json(cls, data: typing.Dict) -> "Plan":
+        if data.get("version") != PLAN_VERSION:
+            raise deployversioner.VersionerError("unsupported plan version {}".format(data.get("version")))
+        return cls(data["gitlab_url"], data["project_id"], data["branch"], data["path"], data["image_tag"],
+            data["head"], data["changed_image_tags"], data["files"])
+
+def make_plan(gitlab_request: deployversioner.GitlabRequest, path: str, image_tag: str,
+        max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY,
+        blob_cache: typing.Optional[cache.BlobCache] = None, fetch_strategy: str = "rest",
+        graphql_batch_size: int = deployversioner.DEFAULT_GRAPHQL_BATCH_SIZE,
+        archive_threshold: int = deployversioner.DEFAULT_ARCHIVE_THRESHOLD,
+        execution: str = deployversioner.DEFAULT_EXECUTION) -> Plan:
+    r"""rewrite the files below path like change_image_tag and return the changes as a plan.
+
+    The head of the branch is read before the files, so any commit made
+    while they are fetched makes the plan out of date rather than being
+    missed. The changed files are pinned to their last commits like a
+    commit would be.
+    """
+    head = deployversioner.get_branch_head(gitlab_request)
+    proposed_commits, changed_image_tags = deployversioner.change_image_tag(gitlab_request, path, image_tag,
+        max_concurrency, blob_cache, fetch_strategy, graphql_batch_size, archive_threshold, execution)
+    if proposed_commits:
+        proposed_commits, rebased_tags, _ = deployversioner.pin_proposed_commits(gitlab_request,
+            proposed_commits, image_tag, repin=False)
+        changed_image_tags = set(changed_image_tags) | rebased_tags
+    files = [{"path": c["file_path"], "blob_id": c["blob_id"], "last_commit_id": c["last_commit_id"],
+        "changed_image_tags": c.get("changed_image_tags", []), "content": c["content"]}
+        for c in proposed_commits]
+    return Plan(gitlab_request.url, gitlab_request.project_id, gitlab_request.branch, path, image_tag, head,
+        changed_image_tags, files)
+
+def save_plan(filename: str, plan: Plan) -> None:
+    r"""write plan to filename, gzip compressed if it ends with .gz"""
+    data = json.dumps(plan.to_json()).encode("utf8")
+    cache.write_atomically(os.path.abspath(filename), gzip.compress(data) if filename.endswith(".gz") else data)
+
+def load_plan(filename: str) -> Plan:
+    try:
+        with (gzip.open if filename.endswith(".gz") else open)(filename, "rb") as fp:
+            return Plan.from_json(json.loads(fp.read().decode("utf8")))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise deployversioner.VersionerError("unable to read plan {}: {}".format(filename, e))
+
+def check_plan(gitlab_request: deployversioner.GitlabRequest, plan: Plan) -> None:
+    r"""raise VersionerError if a file of plan has changed since the plan was made.
+
+    This is a single request if the branch hasn't moved. Otherwise the
+    commits since are compared, so commits to other files don't make the
+    plan out of date.
+    """
+    head = deployversioner.get_branch_head(gitlab_request)
+    if head == plan.head:
+        return
+    diffs = index.compare(gitlab_request, plan.head, head)
+    if diffs is None:
+        raise deployversioner.VersionerError("plan is out of date, {} can't be compared with {}".format(
+            plan.head, head))
+    paths = {f["path"] for f in plan.files}
+    changed = sorted({p for d in diffs for p in (d.get("old_path"), d.get("new_path")) if p in paths})
+    if changed:
+        raise deployversioner.VersionerError("plan is out of date, {} changed since {}".format(
+            ", ".join(changed), plan.head))
+    logger.info("%s has moved from %s to %s without changing the planned files", plan.branch, plan.head, head)
+
+def apply_plan(gitlab_request: deployversioner.GitlabRequest, plan: Plan) -> typing.Dict:
+    r"""commit plan after checking it is still valid and return the commit as returned by gitlab"""
+    if not plan.files:
+        raise deployversioner.VersionUnchangedException("no changes found.")
+    check_plan(gitlab_request, plan)
+    return deployversioner.commit_changes(gitlab_request, plan.proposed_commits(), plan.image_tag,
+        set(plan.changed_image_tags))
+
+def print_plan(plan: Plan) -> None:
+    for f in plan.files:
+        print("{}: {} -> {}".format(f["path"], ", ".join(f["changed_image_tags"]), plan.image_tag))
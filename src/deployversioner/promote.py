@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import logging
+import typing
+
+import requests
+import yaml
+
+from deployversioner import batch
+from deployversioner import cache
+from deployversioner import deployversioner
+
+logger = logging.getLogger(__name__)
+
+def parse_target(value: str) -> typing.Tuple[str, str]:
+    r"""return the branch and path of a target given as branch:path, the path may be empty for the whole branch"""
+    branch, separator, path = value.partition(":")
+    if not separator or not branch:
+        raise argparse.ArgumentTypeError("{} is not a target of the form branch:path".format(value))
+    return branch, path
+
+def list_manifests(gitlab_request: deployversioner.GitlabRequest, path: str,
+        executor: typing.Optional[concurrent.futures.Executor] = None) -> typing.List[typing.Dict]:
+    r"""return the tree entries of the manifests at or below path like change_image_tag finds them"""
+    found = path == ""
+    manifests = []
+    try:
+        for entry in deployversioner.iter_target_tree(gitlab_request, path, executor):
+            found = found or deployversioner.in_path(entry["path"], path)
+            if deployversioner.is_manifest(entry, path):
+                manifests.append(entry)
+    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as e:
+        raise deployversioner.VersionerError("unable to list {} of {}: {}".format(path, gitlab_request.branch, e))
+    if not found:
+        raise deployversioner.VersionerFileNotFound("File or dir {} not found".format(path))
+    return manifests
+
+def submit_unique_blobs(gitlab_requests: typing.List[deployversioner.GitlabRequest], paths: typing.List[str],
+        targets: typing.List[typing.List[typing.Dict]], blob_cache: typing.Optional[cache.BlobCache],
+        fetch_strategy: str, graphql_batch_size: int, archive_threshold: int,
+        pipeline: deployversioner.RewritePipeline) -> typing.Dict[str, concurrent.futures.Future]:
+    r"""fetch and rewrite every distinct blob of the manifests of targets once.
+
+    A blob is fetched from the first target it is found in, with the fetch
+    strategy applied to the blobs each target fetches. Returns a future of
+    the get_content result of every blob by its sha.
+    """
+    futures: typing.Dict[str, concurrent.futures.Future] = {}
+    for gitlab_request, path, manifests in zip(gitlab_requests, paths, targets):
+        files = []
+        for entry in manifests:
+            if entry["id"] not in futures:
+                futures[entry["id"]] = None
+                files.append(entry)
+        if fetch_strategy == "archive" or (fetch_strategy == "auto" and len(files) > archive_threshold):
+            submitted = deployversioner.submit_archive_blobs(gitlab_request, files, path, blob_cache, pipeline)
+        elif fetch_strategy == "graphql":
+            submitted = []
+            for n in range(0, len(files), graphql_batch_size):
+                batch_files = files[n:n + graphql_batch_size]
+                future = pipeline.submit(deployversioner.fetch_blobs, gitlab_request, batch_files, blob_cache,
+                    fetch_strategy)
+                submitted.extend(split_future(future, len(batch_files)))
+        else:
+            submitted = [pipeline.submit(deployversioner.fetch_blobs, gitlab_request, [f], blob_cache)
+                for f in files]
+        for entry, future in zip(files, submitted):
+            futures[entry["id"]] = future
+    return futures
+
+def split_future(future: concurrent.futures.Future, size: int) -> typing.List[concurrent.futures.Future]:
+    r"""return a future of every item of the list future results in"""
+    parts = [concurrent.futures.Future() for _ in range(size)]
+    def done(future: concurrent.futures.Future) -> None:
+        try:
+            results = future.result()
+        except BaseException as e:
+            for part in parts:
+                part.set_exception(e)
+            return
+        for part, result in zip(parts, results):
+            part.set_result([result])
+    future.add_done_callback(done)
+    return parts
+
+def promote(gitlab_url: str, api_token: str, project_id: int, items: typing.List[batch.BatchItem],
+        max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY,
+        blob_cache: typing.Optional[cache.BlobCache] = None, dry_run: bool = False,
+        fetch_strategy: str = "rest", graphql_batch_size: int = deployversioner.DEFAULT_GRAPHQL_BATCH_SIZE,
+        archive_threshold: int = deployversioner.DEFAULT_ARCHIVE_THRESHOLD,
+        execution: str = deployversioner.DEFAULT_EXECUTION) -> typing.List[batch.BatchResult]:
+    r"""set the tag of items, which are all of one project and tag, with a commit per branch.
+
+    The targets are listed in parallel. Branches usually share most of
+    their manifests, so every distinct blob is fetched and rewritten once
+    and its rewrite is used in every branch and path it is found in. The
+    commits to the branches are made in parallel.
+    """
+    tag = items[0].tag
+    gitlab_requests = [deployversioner.GitlabRequest(gitlab_url, api_token, project_id, item.branch)
+        for item in items]
+    results: typing.List[typing.Optional[batch.BatchResult]] = [None] * len(items)
+    deployversioner.get_client(gitlab_url, api_token, max_concurrency)
+    with deployversioner.open_executors(execution, max_concurrency) as (io_executor, transform_executor):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(items), max_concurrency)) as executor:
+            listings = [executor.submit(list_manifests, r, item.path, io_executor)
+                for r, item in zip(gitlab_requests, items)]
+        targets: typing.List[typing.List[typing.Dict]] = []
+        for n, listing in enumerate(listings):
+            try:
+                targets.append(listing.result())
+            except deployversioner.VersionerProjectNotFound:
+                raise
+            except deployversioner.VersionerError as e:
+                results[n] = batch.BatchResult(items[n], batch.ERROR, str(e), [])
+                targets.append([])
+        pipeline = deployversioner.RewritePipeline(tag, blob_cache, io_executor, transform_executor,
+            max_concurrency * deployversioner.PIPELINE_DEPTH)
+        futures = submit_unique_blobs(gitlab_requests, [item.path for item in items], targets, blob_cache,
+            fetch_strategy, graphql_batch_size, archive_threshold, pipeline)
+        rewrites: typing.Dict[str, typing.Dict] = {}
+        failures: typing.Dict[str, str] = {}
+        for blob_id, future in futures.items():
+            try:
+                rewrites[blob_id] = future.result()[0]
+            except (deployversioner.VersionerError, yaml.YAMLError, requests.exceptions.HTTPError,
+                    requests.exceptions.RetryError, requests.exceptions.ChunkedEncodingError) as e:
+                failures[blob_id] = str(e)
+    # the changes of every branch, by file path
+    branches: typing.Dict[str, typing.Dict[str, typing.Dict]] = collections.OrderedDict()
+    files: typing.List[typing.List[str]] = []
+    # the branch every blob was fetched from, the first it is found in
+    fetched_from: typing.Dict[str, str] = {}
+    for item, manifests in zip(items, targets):
+        for entry in manifests:
+            fetched_from.setdefault(entry["id"], item.branch)
+    for n, (item, manifests) in enumerate(zip(items, targets)):
+        failed = ["{}: {}".format(e["path"], failures[e["id"]]) for e in manifests if e["id"] in failures]
+        if failed and results[n] is None:
+            results[n] = batch.BatchResult(item, batch.ERROR, "; ".join(failed), [])
+        changes = branches.setdefault(item.branch, collections.OrderedDict())
+        item_files = []
+        for entry in manifests:
+            rewrite = rewrites.get(entry["id"])
+            if results[n] is None and rewrite is not None and rewrite["commit_blob"]:
+                commit_blob = dict(rewrite["commit_blob"], file_path=entry["path"])
+                # the last commit of a blob is of the branch it was fetched from
+                if fetched_from[entry["id"]] != item.branch:
+                    commit_blob.pop("last_commit_id", None)
+                changes[entry["path"]] = commit_blob
+                item_files.append(entry["path"])
+        files.append(item_files)
+    def commit(branch: str, changes: typing.Dict[str, typing.Dict]) -> typing.Tuple[str, str]:
+        if not changes:
+            return batch.UNCHANGED, "no changes found."
+        if dry_run:
+            return batch.DRY_RUN, ""
+        gitlab_request = deployversioner.GitlabRequest(gitlab_url, api_token, project_id, branch)
+        changed_image_tags = {t for c in changes.values() for t in c.get("changed_image_tags", [])}
+        try:
+            deployversioner.commit_changes(gitlab_request, list(changes.values()), tag, changed_image_tags)
+        except deployversioner.VersionUnchangedException as e:
+            return batch.UNCHANGED, str(e)
+        except deployversioner.VersionerError as e:
+            return batch.ERROR, str(e)
+        return batch.COMMITTED, ""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(branches)) as executor:
+        commits = {branch: executor.submit(commit, branch, changes) for branch, changes in branches.items()}
+        outcomes = {branch: future.result() for branch, future in commits.items()}
+    for n, (item, item_files) in enumerate(zip(items, files)):
+        if results[n] is not None:
+            continue
+        outcome, message = outcomes[item.branch]
+        if not item_files:
+            results[n] = batch.BatchResult(item, batch.UNCHANGED, "no changes found.", [])
+        else:
+            results[n] = batch.BatchResult(item, outcome, message, item_files)
+    return results
+
+def run_promotion(gitlab_url: str, api_token: str, project: str, targets: typing.List[typing.Tuple[str, str]],
+        tag: str, max_concurrency: int = deployversioner.DEFAULT_MAX_CONCURRENCY,
+        blob_cache: typing.Optional[cache.BlobCache] = None,
+        project_id_cache: typing.Optional[cache.ProjectIdCache] = None,
+        dry_run: bool = False, fetch_strategy: str = "rest",
+        graphql_batch_size: int = deployversioner.DEFAULT_GRAPHQL_BATCH_SIZE,
+        archive_threshold: int = deployversioner.DEFAULT_ARCHIVE_THRESHOLD,
+        execution: str = deployversioner.DEFAULT_EXECUTION) -> typing.List[batch.BatchResult]:
+    r"""promote tag to the branch and path of every target of project, looking the project up once"""
+    items = [batch.BatchItem(project, branch, path, tag) for branch, path in targets]
+    try:
+        return deployversioner.run_with_project_id(gitlab_url, api_token, project, project_id_cache,
+            lambda project_id: promote(gitlab_url, api_token, project_id, items, max_concurrency, blob_cache,
+                dry_run, fetch_strategy, graphql_batch_size, archive_threshold, execution))
+    except deployversioner.VersionerError as e:
+        return [batch.BatchResult(item, batch.ERROR, str(e), []) for item in items]
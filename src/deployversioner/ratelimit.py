@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import email.utils
+import threading
+import time
+import typing
+import urllib.parse
+
+import requests
+
+# bounds of the number of requests a limiter lets run at a time
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+
+# a request slower than LATENCY_FACTOR times the fastest one of its class
+# seen, plus LATENCY_SLACK seconds, is taken as a sign of an overloaded gitlab
+LATENCY_FACTOR = 4
+LATENCY_SLACK = 0.1
+
+# seconds to wait after a 429 without Retry-After, doubled for every one in a row
+DEFAULT_BACKOFF = 1.0
+# longest pause honoured, so a bogus header can't hang a pipeline
+MAX_PAUSE = 300.0
+
+def header_seconds(headers: typing.Mapping[str, str], name: str) -> typing.Optional[float]:
+    r"""return the number of seconds or the http date in header name as seconds from now"""
+    value = headers.get(name)
+    if not isinstance(value, str):
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def header_int(headers: typing.Mapping[str, str], name: str) -> typing.Optional[int]:
+    value = headers.get(name)
+    if not isinstance(value, str):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def request_class(method: str, url: str) -> str:
+    r"""return the method and endpoint of a request, e.g. GET repository/tree, whose latencies are comparable"""
+    path = urllib.parse.urlsplit(url).path
+    if "/repository/" in path:
+        endpoint = "repository/" + path.split("/repository/", 1)[1].split("/", 1)[0]
+    elif path.endswith("/graphql"):
+        endpoint = "graphql"
+    else:
+        endpoint = "projects"
+    return "{} {}".format(method, endpoint)
+
+class RateLimiter:
+    r"""AIMD scheduler of the requests against one gitlab instance.
+
+    The number of requests let through at a time grows by one for every
+    limit requests that succeed and is halved when gitlab rate limits a
+    request, fails or gets much slower than it has been. Latencies are only
+    compared within a class of requests, since e.g. a graphql query or an
+    archive is always much slower than listing a tree. Only one decrease
+    is made per round of requests, so the requests in flight failing
+    together don't drain the limit to the minimum.
+
+    Retry-After and an exhausted RateLimit-Remaining pause all requests
+    until gitlab takes them again, rather than every thread retrying on
+    its own.
+
+    :param limit number of requests let through at a time to begin with
+    :param clock monotonic clock in seconds, for testing
+    """
+    def __init__(self, limit: int = 8, min_limit: int = MIN_CONCURRENCY,
+            max_limit: int = MAX_CONCURRENCY, clock: typing.Callable[[], float] = time.monotonic):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.backoff = DEFAULT_BACKOFF
+        # request class -> fastest request of the class seen
+        self.min_latencies: typing.Dict[str, float] = {}
+        self.decreased_at = float("-inf")
+        self.clock = clock
+        self._condition = threading.Condition()
+
+    def acquire(self) -> float:
+        r"""wait for a slot and return the time the request was let through, to pass to release"""
+        with self._condition:
+            while True:
+                wait = self.paused_until - self.clock()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+            return self.clock()
+
+    def release(self, started: float, response: typing.Optional[requests.Response],
+            request_class: str = "") -> typing.Optional[float]:
+        r"""account for a finished request and return the seconds until it can be retried if it was rate limited
+
+        :param started as returned by acquire
+        :param response of the request, None if it failed without one
+        :param request_class of the request, as returned by request_class
+        """
+        with self._condition:
+            self.in_flight -= 1
+            now = self.clock()
+            status = response.status_code if response is not None else None
+            retry_after = None
+            if status == 429:
+                retry_after = header_seconds(response.headers, "Retry-After")
+                if retry_after is None:
+                    retry_after = self.backoff
+                    self.backoff = min(self.backoff * 2, MAX_PAUSE)
+                self.pause(now, retry_after)
+                self.decrease(started, now)
+            elif status is None or status >= 500:
+                self.decrease(started, now)
+            else:
+                self.backoff = DEFAULT_BACKOFF
+                elapsed = now - started
+                min_latency = min(self.min_latencies.get(request_class, elapsed), elapsed)
+                self.min_latencies[request_class] = min_latency
+                if elapsed > LATENCY_FACTOR * min_latency + LATENCY_SLACK:
+                    self.decrease(started, now)
+                else:
+                    self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+            if response is not None:
+                self.read_budget(response.headers, now)
+            self._condition.notify_all()
+            return retry_after
+
+    def read_budget(self, headers: typing.Mapping[str, str], now: float) -> None:
+        r"""keep within the requests gitlab says are left, pausing until the reset if none are"""
+        remaining = header_int(headers, "RateLimit-Remaining")
+        if remaining is None:
+            return
+        if remaining <= 0:
+            reset = header_int(headers, "RateLimit-Reset")
+            self.pause(now, reset - time.time() if reset is not None else self.backoff)
+        elif remaining < self.limit:
+            self.limit = float(max(remaining, self.min_limit))
+
+    def pause(self, now: float, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, now + min(max(seconds, 0.0), MAX_PAUSE))
+
+    def decrease(self, started: float, now: float) -> None:
+        # requests started before the last decrease were sent at the old limit
+        if started < self.decreased_at:
+            return
+        self.limit = max(self.limit / 2, float(self.min_limit))
+        self.decreased_at = now
+
+_limiters: typing.Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(url: str, limit: int = 8) -> RateLimiter:
+    r"""return the limiter shared by every client of the gitlab instance at url in this process"""
+    with _limiters_lock:
+        limiter = _limiters.get(url)
+        if limiter is None:
+            limiter = RateLimiter(limit)
+            _limiters[url] = limiter
+        return limiter
+
+def reset_limiters() -> None:
+    with _limiters_lock:
+        _limiters.clear()
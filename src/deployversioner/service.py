@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import asyncio
+import concurrent.futures
+import hmac
+import http
+import json
+import logging
+import typing
+
+from deployversioner import batch
+from deployversioner import deployversioner
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait for more events for a project and branch before committing
+DEFAULT_DEBOUNCE = 5.0
+# seconds an event waits at most, even if more events keep arriving
+DEFAULT_MAX_DELAY = 30.0
+# bytes of the largest request body accepted
+MAX_BODY_SIZE = 1024 * 1024
+
+class Service:
+    r"""collect image tag updates and commit them per project and branch.
+
+    Updates for the same project and branch arriving within debounce seconds
+    of each other are merged into one commit by run, which is called in a
+    thread with the items of one project and branch. Commits to the same
+    project and branch are made one after another.
+
+    :param run function applying a list of items as one commit, e.g. batch.run_merged_group
+    :param debounce in seconds to wait for more updates
+    :param max_delay in seconds an update waits at most
+    :param max_parallel_projects number of projects and branches committed to at the same time
+    """
+    def __init__(self, run: typing.Callable[[typing.List[batch.BatchItem]], typing.List[batch.BatchResult]],
+            debounce: float = DEFAULT_DEBOUNCE, max_delay: float = DEFAULT_MAX_DELAY,
+            max_parallel_projects: int = batch.DEFAULT_MAX_PARALLEL_PROJECTS):
+        self.run = run
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel_projects)
+        self.pending: typing.Dict[typing.Tuple[str, str], typing.List[batch.BatchItem]] = {}
+        self.first_update: typing.Dict[typing.Tuple[str, str], float] = {}
+        self.timers: typing.Dict[typing.Tuple[str, str], asyncio.TimerHandle] = {}
+        self.locks: typing.Dict[typing.Tuple[str, str], asyncio.Lock] = {}
+        self.flushes: typing.Set[asyncio.Future] = set()
+
+    def submit(self, items: typing.List[batch.BatchItem]) -> None:
+        loop = asyncio.get_running_loop()
+        for key, group in batch.group_items(items).items():
+            self.pending.setdefault(key, []).extend(group)
+            first = self.first_update.setdefault(key, loop.time())
+            timer = self.timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+            delay = max(0, min(self.debounce, first + self.max_delay - loop.time()))
+            self.timers[key] = loop.call_later(delay, self.start_flush, key)
+
+    def start_flush(self, key: typing.Tuple[str, str]) -> None:
+        future = asyncio.ensure_future(self.flush(key))
+        self.flushes.add(future)
+        future.add_done_callback(self.flushes.discard)
+
+    async def flush(self, key: typing.Tuple[str, str]) -> None:
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self.first_update.pop(key, None)
+        items = self.pending.pop(key, [])
+        if not items:
+            return
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            logger.info("committing %d updates to %s %s", len(items), *key)
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(self.executor, self.run, items)
+            except Exception as e:
+                logger.exception("unable to commit updates to %s %s", *key)
+                results = [batch.BatchResult(item, batch.ERROR, str(e), []) for item in items]
+        for result in results:
+            logger.info("%s %s %s %s: %s %s", result.item.project, result.item.branch,
+                result.item.path, result.item.tag, result.outcome, result.message)
+
+    async def drain(self) -> None:
+        r"""commit all pending updates now and wait for every commit to be made"""
+        for key in list(self.pending):
+            self.start_flush(key)
+        while self.flushes:
+            await asyncio.gather(*list(self.flushes))
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+class WebhookHandler:
+    r"""minimal http/1.1 endpoint receiving image published events.
+
+    POST /events takes one update or a list of updates like a batch manifest,
+    e.g. {"project": "metascrum/rrflow-deploy", "path": "services/rrflow.yml",
+    "tag": "master-9"}. GET /health reports the number of pending updates.
+
+    :param secret expected in the X-Gitlab-Token header if not None
+    """
+    def __init__(self, service: Service, default_branch: str = "staging",
+            secret: typing.Optional[str] = None):
+        self.service = service
+        self.default_branch = default_branch
+        self.secret = secret
+
+    async def __call__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            status, body = await self.handle(reader)
+        except (asyncio.IncompleteReadError, ValueError) as e:
+            status, body = http.HTTPStatus.BAD_REQUEST, {"message": "malformed request: {}".format(e)}
+        data = json.dumps(body).encode("utf8")
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+            "Connection: close\r\n\r\n".format(status.value, status.phrase, len(data)).encode("ascii") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def handle(self, reader: asyncio.StreamReader) -> typing.Tuple[http.HTTPStatus, typing.Any]:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise ValueError("invalid request line")
+        method, path, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            return http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"message": "request body is too large"}
+        body = await reader.readexactly(length)
+        if path == "/health" and method == "GET":
+            return http.HTTPStatus.OK, {"pending": sum(len(i) for i in self.service.pending.values())}
+        if path != "/events":
+            return http.HTTPStatus.NOT_FOUND, {"message": "404 Not Found"}
+        if method != "POST":
+            return http.HTTPStatus.METHOD_NOT_ALLOWED, {"message": "use POST"}
+        if self.secret is not None and not hmac.compare_digest(
+                headers.get("x-gitlab-token", "").encode("utf8"), self.secret.encode("utf8")):
+            return http.HTTPStatus.UNAUTHORIZED, {"message": "invalid token"}
+        try:
+            updates = json.loads(body.decode("utf8"))
+            items = batch.parse_updates(updates if isinstance(updates, list) else [updates],
+                self.default_branch)
+        except (ValueError, deployversioner.VersionerError) as e:
+            return http.HTTPStatus.BAD_REQUEST, {"message": str(e)}
+        self.service.submit(items)
+        return http.HTTPStatus.ACCEPTED, {"queued": len(items)}
+
+async def serve(service: Service, handler: WebhookHandler, host: str, port: int,
+        started: typing.Optional[typing.Callable[[asyncio.AbstractServer], None]] = None) -> None:
+    r"""serve webhooks until cancelled, then commit the pending updates"""
+    server = await asyncio.start_server(handler, host, port)
+    for sock in server.sockets:
+        logger.info("listening on %s", sock.getsockname())
+    if started is not None:
+        started(server)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.drain()
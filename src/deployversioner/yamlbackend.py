@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import typing
+
+import yaml
+
+class YamlBackend:
+    r"""the loader and dumper used to parse and write deployment configurations.
+
+    All backends are safe loaders and produce the same nodes, documents and
+    output, they only differ in speed.
+
+    :param name shown in verbose output
+    :param loader class for composing and loading documents
+    :param dumper class for dumping documents
+    """
+    def __init__(self, name: str, loader: typing.Any, dumper: typing.Any):
+        self.name = name
+        self.loader = loader
+        self.dumper = dumper
+
+    def compose_all(self, stream: str) -> typing.Iterator[yaml.Node]:
+        return yaml.compose_all(stream, Loader=self.loader)
+
+    def load_all(self, stream: str) -> typing.Iterator[typing.Any]:
+        return yaml.load_all(stream, Loader=self.loader)
+
+    def dump_all(self, docs: typing.List[typing.Any]) -> str:
+        return yaml.dump_all(docs, Dumper=self.dumper)
+
+    def __repr__(self) -> str:
+        return "YamlBackend({})".format(self.name)
+
+PURE_PYTHON = YamlBackend("pure-python", yaml.SafeLoader, yaml.SafeDumper)
+
+# only available when pyyaml is built against libyaml
+LIBYAML: typing.Optional[YamlBackend] = None
+if getattr(yaml, "__with_libyaml__", False):
+    LIBYAML = YamlBackend("libyaml", yaml.CSafeLoader, yaml.CSafeDumper)
+
+def available_backends() -> typing.List[YamlBackend]:
+    return [b for b in [LIBYAML, PURE_PYTHON] if b is not None]
+
+def default_backend() -> YamlBackend:
+    r"""return the libyaml backend if it is available and the pure python one otherwise"""
+    return available_backends()[0]
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import tarfile
+import threading
+import time
+import typing
+import unittest
+import urllib.parse
+
+import deployversioner.deployversioner
+
+PROJECT_ID = 103
+PROJECT_NAME = "metascrum/rrflow-deploy"
+
+DEPLOYMENT = """apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: {}
+spec:
+  template:
+    spec:
+      containers:
+      - image: {}
+"""
+
+def deployment(name: str, tag: str, image: str = "docker-image") -> str:
+    r"""return a manifest with one deployment of name running image:tag"""
+    return DEPLOYMENT.format(name, "{}:{}".format(image, tag))
+
+def deployments(count: int, tag: typing.Union[str, typing.Callable[[int], str]] = "master-01",
+        directory: str = "env") -> typing.Dict[str, str]:
+    r"""return count manifests directory/file<n>.yml of deployments service<n>, tag may be a function of n"""
+    return {"{}/file{}.yml".format(directory, n): deployment("service{}".format(n), tag(n) if callable(tag) else tag)
+        for n in range(count)}
+
+def blob_sha(content: str) -> str:
+    data = content.encode("utf8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+class FakeProject:
+    def __init__(self, project_id: int, name: str, branches: typing.Dict[str, typing.Dict[str, str]]):
+        self.id = project_id
+        self.name = name
+        # branch name -> file path -> contents
+        self.branches = branches
+        self.commits: typing.List[typing.Dict] = []
+        # (branch name, file path) -> id of the last commit changing the file
+        self.last_commit_ids: typing.Dict[typing.Tuple[str, str], str] = {}
+        # branch name -> id and files of every commit, starting with an initial commit
+        self.history = {branch: [("0" * 40, dict(files))] for branch, files in branches.items()}
+
+    def head(self, branch: str) -> str:
+        return self.history[branch][-1][0]
+
+    def snapshot(self, ref: str) -> typing.Optional[typing.Dict[str, str]]:
+        r"""return the files of a branch or commit"""
+        if ref in self.history:
+            return self.history[ref][-1][1]
+        for commits in self.history.values():
+            for commit_id, files in commits:
+                if commit_id == ref:
+                    return files
+        return None
+
+    def last_commit_id(self, branch: str, file_path: str) -> str:
+        return self.last_commit_ids.get((branch, file_path), "0" * 40)
+
+    def push(self, branch: str, files: typing.Dict[str, str], message: str = "update",
+            commit: typing.Optional[typing.Dict] = None) -> str:
+        r"""commit files to branch like another user of gitlab would and return the commit id.
+
+        A file with None as contents is deleted.
+
+        :param commit as posted to the commits api, recorded instead of one made up from files
+        """
+        if commit is None:
+            commit = {"branch": branch, "commit_message": message,
+                "actions": [{"action": "update", "file_path": p, "content": c} for p, c in files.items()]}
+        self.commits.append(commit)
+        commit_id = "{:040x}".format(len(self.commits))
+        for file_path, content in files.items():
+            if content is None:
+                del self.branches[branch][file_path]
+            else:
+                self.branches[branch][file_path] = content
+            self.last_commit_ids[(branch, file_path)] = commit_id
+        self.history[branch].append((commit_id, dict(self.branches[branch])))
+        return commit_id
+
+def make_project(files: typing.Dict[str, str], branch: str = "staging",
+        **other_branches: typing.Dict[str, str]) -> "FakeProject":
+    r"""return the project tests update, with files in branch and other_branches by name"""
+    return FakeProject(PROJECT_ID, PROJECT_NAME, dict({branch: files}, **other_branches))
+
+class GitlabTestCase(unittest.TestCase):
+    r"""test case for tests sending requests to gitlab, closing the shared clients after every test"""
+    def tearDown(self):
+        deployversioner.deployversioner.close_clients()
+
+    def gitlab_request(self, gitlab: "FakeGitlab",
+            branch: str = "staging") -> deployversioner.deployversioner.GitlabRequest:
+        return deployversioner.deployversioner.GitlabRequest(gitlab.url, "token", PROJECT_ID, branch)
+
+class FakeGitlab:
+    r"""in-process http server implementing the parts of the gitlab api deployversioner uses.
+
+    :param projects to serve
+    :param latency in seconds added to every request
+    :param graphql whether the graphql endpoint is available
+    :param max_per_page largest page of the tree served, like the limit of a gitlab instance
+    :param accept_gzip whether gzip compressed request bodies are read or refused
+    :param gzip_refused_status the status gzip compressed request bodies are refused with
+
+    before_commit can be set to a function called with the project before a
+    commit is made, e.g. to make a conflicting commit. throttled can be set
+    to a number of requests to refuse with 429 and retry_after.
+    graphql_errors can be set to the messages of errors to answer the next
+    graphql queries with, one per query.
+    """
+    def __init__(self, projects: typing.List[FakeProject], latency: float = 0,
+            graphql: bool = True, max_per_page: int = 100, accept_gzip: bool = True,
+            gzip_refused_status: int = 415):
+        self.projects = {p.id: p for p in projects}
+        self.latency = latency
+        self.graphql = graphql
+        self.max_per_page = max_per_page
+        self.accept_gzip = accept_gzip
+        self.gzip_refused_status = gzip_refused_status
+        # method, path and headers of every request with a body
+        self.bodies: typing.List[typing.Tuple[str, str, typing.Dict[str, str]]] = []
+        self.before_commit: typing.Optional[typing.Callable[[FakeProject], None]] = None
+        self.throttled = 0
+        self.retry_after = "0"
+        self.graphql_errors: typing.List[str] = []
+        self.requests: typing.List[typing.Tuple[str, str]] = []
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), make_handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def __enter__(self) -> "FakeGitlab":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def project(self, id_or_name: str) -> typing.Optional[FakeProject]:
+        for project in self.projects.values():
+            if id_or_name in (str(project.id), project.name):
+                return project
+        return None
+
+    def requests_to(self, path_part: str) -> typing.List[typing.Tuple[str, str]]:
+        return [r for r in self.requests if path_part in r[1]]
+
+def make_handler(gitlab: FakeGitlab):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status: int, body: typing.Union[str, bytes, typing.Any],
+                headers: typing.Optional[typing.Dict[str, str]] = None) -> None:
+            if isinstance(body, str):
+                data = body.encode("utf8")
+                content_type = "text/plain; charset=utf-8"
+            elif isinstance(body, bytes):
+                data = body
+                content_type = "application/octet-stream"
+            else:
+                data = json.dumps(body).encode("utf8")
+                content_type = "application/json"
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+
+        def read_body(self) -> bytes:
+            with gitlab.lock:
+                gitlab.bodies.append((self.command, self.path, dict(self.headers)))
+            if self.headers.get("Transfer-Encoding") == "chunked":
+                chunks = []
+                while True:
+                    length = int(self.rfile.readline().split(b";")[0], 16)
+                    chunks.append(self.rfile.read(length))
+                    self.rfile.readline()
+                    if length == 0:
+                        break
+                data = b"".join(chunks)
+            else:
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+            return data
+
+        def handle_request(self) -> None:
+            with gitlab.lock:
+                gitlab.requests.append((self.command, self.path))
+                throttled = gitlab.throttled > 0
+                gitlab.throttled -= throttled
+            if gitlab.latency:
+                time.sleep(gitlab.latency)
+            if throttled:
+                if self.command == "POST":
+                    self.read_body()
+                return self.send(429, {"message": "Retry later"}, {"Retry-After": gitlab.retry_after})
+            url = urllib.parse.urlsplit(self.path)
+            # paths are matched on their encoded form, like gitlab does
+            parts = url.path.split("/")
+            query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+            if url.path == "/api/graphql":
+                return self.graphql()
+            if parts[:4] != ["", "api", "v4", "projects"] or len(parts) < 5:
+                return self.send(404, {"message": "404 Not Found"})
+            project = gitlab.project(urllib.parse.unquote(parts[4]))
+            if project is None:
+                return self.send(404, {"message": "404 Project Not Found"})
+            rest = parts[5:]
+            if rest == []:
+                return self.send(200, {"id": project.id, "path_with_namespace": project.name})
+            if rest[:2] == ["repository", "tree"]:
+                return self.tree(project, query)
+            if rest[:2] == ["repository", "branches"] and len(rest) == 3:
+                return self.branch_info(project, urllib.parse.unquote(rest[2]))
+            if rest == ["repository", "compare"]:
+                return self.compare(project, query)
+            if rest == ["repository", "archive.tar.gz"]:
+                return self.archive(project, query)
+            if rest[:2] == ["repository", "files"] and len(rest) >= 3:
+                return self.file(project, urllib.parse.unquote(rest[2]), rest[3:], query)
+            if rest == ["repository", "commits"] and self.command == "POST":
+                return self.commit(project)
+            return self.send(404, {"message": "404 Not Found"})
+
+        def branch(self, project: FakeProject, ref: str) -> typing.Optional[typing.Dict[str, str]]:
+            return project.snapshot(ref)
+
+        def tree(self, project: FakeProject, query: typing.Dict[str, str]) -> None:
+            files = self.branch(project, query.get("ref", ""))
+            if files is None:
+                return self.send(404, {"message": "404 Tree Not Found"})
+            path = query.get("path", "").strip("/")
+            entries = []
+            directories = set()
+            for file_path in sorted(files):
+                if path and not file_path.startswith(path + "/"):
+                    continue
+                components = file_path.split("/")
+                for n in range(1, len(components)):
+                    directory = "/".join(components[:n])
+                    if directory not in directories and (not path or directory.startswith(path + "/")):
+                        directories.add(directory)
+                        entries.append({"id": blob_sha(directory), "name": components[n - 1],
+                            "type": "tree", "path": directory, "mode": "040000"})
+                entries.append({"id": blob_sha(files[file_path]), "name": components[-1],
+                    "type": "blob", "path": file_path, "mode": "100644"})
+            if path and not entries:
+                return self.send(404, {"message": "404 Tree Not Found"})
+            per_page = min(int(query.get("per_page", 20)), gitlab.max_per_page)
+            page = int(query.get("page", 1))
+            total_pages = max(1, (len(entries) + per_page - 1) // per_page)
+            self.send(200, entries[(page - 1) * per_page:page * per_page],
+                {"X-Total-Pages": str(total_pages), "X-Page": str(page)})
+
+        def file(self, project: FakeProject, file_path: str, rest: typing.List[str],
+                query: typing.Dict[str, str]) -> None:
+            files = self.branch(project, query.get("ref", ""))
+            if files is None or file_path not in files:
+                return self.send(404, {"message": "404 File Not Found"})
+            content = files[file_path]
+            headers = {"X-Gitlab-Blob-Id": blob_sha(content), "X-Gitlab-File-Path": file_path}
+            if query["ref"] in project.branches:
+                headers["X-Gitlab-Last-Commit-Id"] = project.last_commit_id(query["ref"], file_path)
+            if rest == ["raw"]:
+                return self.send(200, content, headers)
+            return self.send(200, {"file_path": file_path, "blob_id": blob_sha(content)}, headers)
+
+        def branch_info(self, project: FakeProject, branch: str) -> None:
+            if branch not in project.branches:
+                return self.send(404, {"message": "404 Branch Not Found"})
+            self.send(200, {"name": branch, "commit": {"id": project.head(branch)}})
+
+        def compare(self, project: FakeProject, query: typing.Dict[str, str]) -> None:
+            old, new = project.snapshot(query.get("from", "")), project.snapshot(query.get("to", ""))
+            if old is None or new is None:
+                return self.send(404, {"message": "404 Not Found"})
+            diffs = []
+            for file_path in sorted(set(old) | set(new)):
+                if old.get(file_path) != new.get(file_path):
+                    diffs.append({"old_path": file_path, "new_path": file_path,
+                        "new_file": file_path not in old, "deleted_file": file_path not in new,
+                        "renamed_file": False, "diff": ""})
+            self.send(200, {"commit": {"id": project.head(query["to"]) if query["to"] in project.history
+                else query["to"]}, "diffs": diffs, "compare_timeout": False, "compare_same_ref": old is new})
+
+        def archive(self, project: FakeProject, query: typing.Dict[str, str]) -> None:
+            files = self.branch(project, query.get("sha", ""))
+            if files is None:
+                return self.send(404, {"message": "404 File Not Found"})
+            path = query.get("path", "").strip("/")
+            sha = project.head(query["sha"])
+            prefix = "{}-{}-{}".format(project.name.rsplit("/", 1)[-1], query["sha"], sha)
+            buffer = io.BytesIO()
+            # like git archive, the commit is recorded in the global pax header
+            with tarfile.open(fileobj=buffer, mode="w:gz", format=tarfile.PAX_FORMAT,
+                    pax_headers={"comment": sha}) as tar:
+                for file_path in sorted(files):
+                    if path and not file_path.startswith(path + "/"):
+                        continue
+                    data = files[file_path].encode("utf8")
+                    info = tarfile.TarInfo("{}/{}".format(prefix, file_path))
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            self.send(200, buffer.getvalue())
+
+        def commit(self, project: FakeProject) -> None:
+            if self.headers.get("Content-Encoding") == "gzip" and not gitlab.accept_gzip:
+                # the body has to be read for the connection to be reused
+                self.read_body()
+                return self.send(gitlab.gzip_refused_status, {"message": "{} {}".format(
+                    gitlab.gzip_refused_status, http.HTTPStatus(gitlab.gzip_refused_status).phrase)})
+            commit = json.loads(self.read_body().decode("utf8"))
+            hook, gitlab.before_commit = gitlab.before_commit, None
+            if hook is not None:
+                hook(project)
+            files = self.branch(project, commit["branch"])
+            if files is None:
+                return self.send(400, {"message": "You can only create or edit files when you are on a branch"})
+            for action in commit["actions"]:
+                if action["file_path"] not in files:
+                    return self.send(400, {"message": "A file with this name doesn't exist"})
+                if "last_commit_id" in action and action["last_commit_id"] != project.last_commit_id(
+                        commit["branch"], action["file_path"]):
+                    return self.send(400, {"message": "You are attempting to update a file that has "
+                        "changed since you started editing it."})
+            commit_id = project.push(commit["branch"], {a["file_path"]: a["content"] for a in commit["actions"]},
+                commit["commit_message"], commit)
+            self.send(201, {"id": commit_id, "title": commit["commit_message"], "status": None,
+                "parent_ids": [project.history[commit["branch"]][-2][0]]})
+
+        def graphql(self) -> None:
+            if not gitlab.graphql:
+                return self.send(404, {"message": "404 Not Found"})
+            request = json.loads(self.read_body().decode("utf8"))
+            with gitlab.lock:
+                error = gitlab.graphql_errors.pop(0) if gitlab.graphql_errors else None
+            if error is not None:
+                return self.send(200, {"errors": [{"message": error}]})
+            variables = request.get("variables", {})
+            nodes = []
+            for gid in variables.get("ids", []):
+                project = gitlab.project(gid.rsplit("/", 1)[-1])
+                if project is None:
+                    continue
+                files = self.branch(project, variables.get("ref", "")) or {}
+                blobs = [{"path": p, "rawBlob": files[p]} for p in variables.get("paths", []) if p in files]
+                nodes.append({"repository": {"blobs": {"nodes": blobs}}})
+            self.send(200, {"data": {"projects": {"nodes": nodes}}})
+
+        def do_GET(self):
+            self.handle_request()
+
+        def do_HEAD(self):
+            self.handle_request()
+
+        def do_POST(self):
+            self.handle_request()
+
+    return Handler
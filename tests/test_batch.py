@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import unittest
+import unittest.mock
+
+import requests
+
+import deployversioner.batch
+import deployversioner.cli
+import deployversioner.deployversioner
+
+from fakegitlab import GitlabTestCase, deployment
+
+MANIFEST = """
+- project: metascrum/rrflow-deploy
+  path: files/file1.yml
+  tag: TAG-2
+- {project: metascrum/other-deploy, path: files/file1.yml, tag: TAG-2, branch: prod}
+- project: metascrum/rrflow-deploy
+  path: files/file2.yml
+  tag: master-02
+- project: metascrum/rrflow-deploy
+  path: files/file3.yml
+  tag: TAG-2
+"""
+
+class TestBatch(GitlabTestCase):
+    def test_read_manifest(self):
+        items = deployversioner.batch.read_manifest(io.StringIO(MANIFEST))
+        self.assertEqual(items[0], deployversioner.batch.BatchItem("metascrum/rrflow-deploy",
+            "staging", "files/file1.yml", "TAG-2"))
+        self.assertEqual(items[1].branch, "prod")
+        items = deployversioner.batch.read_manifest(io.StringIO(
+            json.dumps([{"project": "p", "path": "f.yml", "tag": 12}])), "prod")
+        self.assertEqual(items, [deployversioner.batch.BatchItem("p", "prod", "f.yml", "12")])
+        with self.assertRaises(deployversioner.deployversioner.VersionerError):
+            deployversioner.batch.read_manifest(io.StringIO("- {project: p, path: f.yml}"))
+
+    def test_group_items(self):
+        items = deployversioner.batch.read_manifest(io.StringIO(MANIFEST))
+        groups = deployversioner.batch.group_items(items)
+        self.assertEqual(list(groups.keys()), [("metascrum/rrflow-deploy", "staging"),
+            ("metascrum/other-deploy", "prod")])
+        self.assertEqual([i.path for i in groups[("metascrum/rrflow-deploy", "staging")]],
+            ["files/file1.yml", "files/file2.yml", "files/file3.yml"])
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_run_batch_reports_an_outcome_per_item(self, mock_requests_session):
+        mock_requests_session.return_value.get.side_effect = get_fake_gitlab()
+        mock_requests_session.return_value.head.side_effect = get_fake_gitlab()
+        mock_requests_session.return_value.post.return_value = get_mock_response(
+            json.dumps({"status": None}))
+        items = deployversioner.batch.read_manifest(io.StringIO(MANIFEST))
+        results = deployversioner.batch.run_batch("gitlab.url", "token", items)
+        self.assertEqual([r.item for r in results], items)
+        self.assertEqual([r.outcome for r in results], ["committed", "committed", "unchanged", "error"])
+        self.assertEqual(results[0].files, ["files/file1.yml"])
+        # one lookup per project and a single pool for everything
+        lookups = [c for c in mock_requests_session.return_value.get.call_args_list
+            if "/projects/metascrum" in c[0][0]]
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(mock_requests_session.call_count, 1)
+        self.assertEqual(mock_requests_session.return_value.post.call_count, 2)
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_batch_command_prints_json_lines(self, mock_requests_session):
+        mock_requests_session.return_value.get.side_effect = get_fake_gitlab()
+        mock_requests_session.return_value.head.side_effect = get_fake_gitlab()
+        argv = ["batch", "-", "--gitlab-api-token", "token", "--gitlab-url", "gitlab.url",
+            "--no-cache", "--dry-run"]
+        with unittest.mock.patch("sys.stdin", io.StringIO(MANIFEST)), \
+                unittest.mock.patch("sys.stdout", new_callable=io.StringIO) as stdout, \
+                self.assertRaises(SystemExit) as exit:
+            deployversioner.cli.main(argv)
+        self.assertEqual(exit.exception.code, 1)
+        lines = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([line["outcome"] for line in lines], ["dry-run", "dry-run", "unchanged", "error"])
+        self.assertEqual(mock_requests_session.return_value.post.call_count, 0)
+
+def get_fake_gitlab():
+    files = {"file1.yml": deployment("service", "master-01"),
+        "file2.yml": deployment("service", "master-02")}
+    def side_effect(url, *args, **kwargs):
+        if "/projects/metascrum%2Frrflow-deploy" in url:
+            return get_mock_response(json.dumps({"id": 103}))
+        if "/projects/metascrum%2Fother-deploy" in url:
+            return get_mock_response(json.dumps({"id": 104}))
+        if "/repository/tree/" in url:
+            return get_mock_response(json.dumps([{"id": name, "name": name, "type": "blob",
+                "path": "files/{}".format(name)} for name in files]
+                + [{"id": "files", "name": "files", "type": "tree", "path": "files"}]))
+        for name, content in files.items():
+            if name in url:
+                return get_mock_response(content)
+        return get_mock_response(json.dumps({"message": "404 File Not Found"}), 404)
+    return side_effect
+
+def get_mock_response(content, status_code=200):
+    mock_response = unittest.mock.Mock(requests.Response)
+    mock_response.status_code = status_code
+    mock_response.url = "https://gitlab.url"
+    mock_response.headers = requests.structures.CaseInsensitiveDict()
+    mock_response.links = {}
+    mock_response.content = content.encode("utf8")
+    mock_response.text = content
+    mock_response.json = lambda: json.loads(mock_response.text)
+    return mock_response
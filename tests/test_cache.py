@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import deployversioner.cache
+
+class TestBlobCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_put_and_get(self):
+        blob_cache = deployversioner.cache.BlobCache(self.tmp_dir.name)
+        self.assertIsNone(blob_cache.get("a240c0e70890a799d51a8aee556808d98e689a36"))
+        blob_cache.put("a240c0e70890a799d51a8aee556808d98e689a36", "kind: Deployment\n",
+            [[0, "spec.template.spec.containers[0].image", "docker-image:master-01", 80, None]])
+        content, references = blob_cache.get("a240c0e70890a799d51a8aee556808d98e689a36")
+        self.assertEqual(content, "kind: Deployment\n")
+        self.assertEqual(references,
+            [[0, "spec.template.spec.containers[0].image", "docker-image:master-01", 80, None]])
+        # a new cache object on the same directory sees the entry
+        other_cache = deployversioner.cache.BlobCache(self.tmp_dir.name)
+        self.assertEqual(other_cache.get("a240c0e70890a799d51a8aee556808d98e689a36")[0],
+            "kind: Deployment\n")
+
+    def test_least_recently_used_entries_are_evicted(self):
+        blob_cache = deployversioner.cache.BlobCache(self.tmp_dir.name)
+        for n, blob_id in enumerate(["aa01", "bb02", "cc03"]):
+            blob_cache.put(blob_id, "x" * 100)
+            os.utime(blob_cache.path(blob_id), (n, n))
+        entry_size = os.path.getsize(blob_cache.path("aa01"))
+        # using the oldest entry makes the second oldest the one to go
+        blob_cache.get("aa01")
+        blob_cache.max_size = 3 * entry_size
+        blob_cache.put("dd04", "x" * 100)
+        self.assertIsNone(blob_cache.get("bb02"))
+        for blob_id in ["aa01", "cc03", "dd04"]:
+            self.assertIsNotNone(blob_cache.get(blob_id))
+        self.assertEqual(blob_cache.size(), 3 * entry_size)
+
+class TestProjectIdCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_entries_expire(self):
+        project_id_cache = deployversioner.cache.ProjectIdCache(self.tmp_dir.name, ttl=60)
+        with unittest.mock.patch("time.time", return_value=1000):
+            project_id_cache.put("https://gitlab.url", "metascrum/rrflow-deploy", 103)
+        with unittest.mock.patch("time.time", return_value=1059):
+            self.assertEqual(project_id_cache.get("https://gitlab.url", "metascrum/rrflow-deploy"), 103)
+            self.assertIsNone(project_id_cache.get("https://gitlab.url", "metascrum/other-deploy"))
+        with unittest.mock.patch("time.time", return_value=1061):
+            self.assertIsNone(project_id_cache.get("https://gitlab.url", "metascrum/rrflow-deploy"))
+
+    def test_invalidate(self):
+        project_id_cache = deployversioner.cache.ProjectIdCache(self.tmp_dir.name)
+        project_id_cache.put("https://gitlab.url", "metascrum/rrflow-deploy", 103)
+        project_id_cache.put("https://gitlab.url", "metascrum/other-deploy", 104)
+        project_id_cache.invalidate("https://gitlab.url", "metascrum/rrflow-deploy")
+        self.assertIsNone(project_id_cache.get("https://gitlab.url", "metascrum/rrflow-deploy"))
+        self.assertEqual(project_id_cache.get("https://gitlab.url", "metascrum/other-deploy"), 104)
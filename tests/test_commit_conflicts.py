@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import tempfile
+
+import deployversioner.cache
+import deployversioner.deployversioner
+
+from fakegitlab import FakeGitlab, GitlabTestCase, deployment, deployments, make_project
+
+def get_project():
+    return make_project(deployments(3))
+
+class TestCommitConflicts(GitlabTestCase):
+    def update(self, gitlab, tag, change_files=None, blob_cache=None):
+        r"""update env to tag, with change_files applied before the commit is made"""
+        gitlab_request = self.gitlab_request(gitlab)
+        proposed_commits, changed_image_tags = deployversioner.deployversioner.change_image_tag(
+            gitlab_request, "env", tag, blob_cache=blob_cache)
+        if change_files is not None:
+            change_files()
+        deployversioner.deployversioner.commit_changes(gitlab_request, proposed_commits, tag,
+            changed_image_tags)
+
+    def test_commit_is_pinned_to_the_fetched_files(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            self.update(gitlab, "TAG-2")
+            self.update(gitlab, "TAG-3")
+        self.assertEqual(len(project.commits), 2)
+        self.assertEqual({a["last_commit_id"] for a in project.commits[1]["actions"]},
+            {"{:040x}".format(1)})
+        self.assertEqual(project.branches["staging"]["env/file0.yml"], deployment("service0", "TAG-3"))
+        # the last commits come with the fetched files
+        self.assertEqual(len(gitlab.requests_to("/raw")), 6)
+        self.assertEqual([r for r in gitlab.requests if r[0] == "HEAD"], [])
+
+    def test_only_files_read_from_the_cache_are_looked_up(self):
+        project = get_project()
+        with tempfile.TemporaryDirectory() as cache_dir, FakeGitlab([project]) as gitlab:
+            blob_cache = deployversioner.cache.BlobCache(cache_dir)
+            deployversioner.deployversioner.change_image_tag(self.gitlab_request(gitlab), "env/file0.yml",
+                "TAG-2", blob_cache=blob_cache)
+            gitlab.requests.clear()
+            self.update(gitlab, "TAG-2", blob_cache=blob_cache)
+            self.assertEqual(len(gitlab.requests_to("/raw")), 2)
+            self.assertEqual([path for method, path in gitlab.requests if method == "HEAD"],
+                ["/api/v4/projects/103/repository/files/env%2Ffile0.yml?ref=staging"])
+        self.assertEqual(project.branches["staging"], deployments(3, "TAG-2"))
+
+    def test_files_changed_after_fetching_are_rebased(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            self.update(gitlab, "TAG-2", lambda: project.push("staging", {
+                "env/file1.yml": deployment("service1-renamed", "master-05")}))
+            # only the changed file is fetched again
+            self.assertEqual(len(gitlab.requests_to("/raw")), 4)
+        self.assertEqual(len(project.commits), 2)
+        self.assertEqual(project.branches["staging"]["env/file1.yml"],
+            deployment("service1-renamed", "TAG-2"))
+        self.assertIn("Bump docker tag from master-05 to TAG-2", project.commits[1]["commit_message"])
+
+    def test_rejected_commit_is_rebased_and_retried(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            # a parallel pipeline commits between pinning and committing
+            gitlab.before_commit = lambda p: p.push("staging", {
+                "env/file2.yml": deployment("service2", "master-07")})
+            self.update(gitlab, "TAG-2")
+            self.assertEqual(len(gitlab.requests_to("/repository/commits")), 2)
+        self.assertEqual(len(project.commits), 2)
+        self.assertEqual(project.branches["staging"], deployments(3, "TAG-2"))
+
+    def test_files_already_updated_by_someone_else_are_dropped(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            with self.assertRaises(deployversioner.deployversioner.VersionUnchangedException):
+                self.update(gitlab, "TAG-2", lambda: project.push("staging",
+                    deployments(3, "TAG-2")))
+        self.assertEqual(len(project.commits), 1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import os
+
+import deployversioner.deployversioner
+
+from fakegitlab import FakeGitlab, GitlabTestCase, make_project
+
+DEPLOYMENT = """apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: {}
+  annotations:
+    description: "læsesal \\"{}\\""
+spec:
+  template:
+    spec:
+      containers:
+      - image: docker-image:{}
+"""
+
+def get_project():
+    return make_project({
+        "env/file{}.yml".format(n): DEPLOYMENT.format("service{}".format(n), n, "master-01") for n in range(4)})
+
+class TestCommitPayload(GitlabTestCase):
+    def update(self, gitlab, spool=None):
+        gitlab_request = self.gitlab_request(gitlab)
+        proposed_commits, changed_image_tags = deployversioner.deployversioner.change_image_tag(
+            gitlab_request, "env", "TAG-2", spool=spool)
+        deployversioner.deployversioner.commit_changes(gitlab_request, proposed_commits, "TAG-2",
+            changed_image_tags)
+        return proposed_commits
+
+    def assert_updated(self, project):
+        for n in range(4):
+            self.assertEqual(project.branches["staging"]["env/file{}.yml".format(n)],
+                DEPLOYMENT.format("service{}".format(n), n, "TAG-2"))
+
+    def test_commit_is_streamed(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            self.update(gitlab)
+        _, _, headers = gitlab.bodies[-1]
+        self.assertEqual(headers["Transfer-Encoding"], "chunked")
+        self.assertNotIn("Content-Encoding", headers)
+        self.assert_updated(project)
+
+    def test_body_is_the_same_on_every_iteration(self):
+        body = deployversioner.deployversioner.CommitBody("staging", "Bump \"tag\"", [
+            {"file_path": "a.yml", "content": "ø: 1\n", "last_commit_id": "abc"},
+            {"file_path": "b.yml", "content": "b: 2\n"}])
+        data = b"".join(body)
+        self.assertEqual(b"".join(body), data)
+        self.assertEqual(body.size, len(data))
+        self.assertEqual(json.loads(data), {"branch": "staging", "commit_message": "Bump \"tag\"", "actions": [
+            {"action": "update", "file_path": "a.yml", "content": "ø: 1\n", "last_commit_id": "abc"},
+            {"action": "update", "file_path": "b.yml", "content": "b: 2\n"}]})
+        body.compress = True
+        self.assertEqual(gzip.decompress(b"".join(body)), data)
+
+    def test_contents_beyond_threshold_are_spilled(self):
+        project = get_project()
+        size = len(DEPLOYMENT.format("service0", 0, "TAG-2"))
+        with FakeGitlab([project]) as gitlab, \
+                deployversioner.deployversioner.ContentSpool(2 * size) as spool:
+            proposed_commits = self.update(gitlab, spool)
+            spilled = [c["content_file"] for c in proposed_commits if "content_file" in c]
+            self.assertEqual(len(spilled), 2)
+            self.assertTrue(all(os.path.exists(f) for f in spilled))
+        self.assertFalse(any(os.path.exists(f) for f in spilled))
+        self.assert_updated(project)
+
+    def test_compressed_commits(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            deployversioner.deployversioner.get_client(gitlab.url, "token").compress_commits = True
+            self.update(gitlab)
+        self.assertEqual(gitlab.bodies[-1][2]["Content-Encoding"], "gzip")
+        self.assert_updated(project)
+
+    def test_refused_compression_falls_back(self):
+        for status in [415, 400]:
+            with self.subTest(status=status):
+                project = get_project()
+                with FakeGitlab([project], accept_gzip=False, gzip_refused_status=status) as gitlab:
+                    client = deployversioner.deployversioner.get_client(gitlab.url, "token")
+                    client.compress_commits = True
+                    self.update(gitlab)
+                self.assertEqual([headers.get("Content-Encoding") for _, _, headers in gitlab.bodies],
+                    ["gzip", None])
+                self.assertFalse(client.compress_commits)
+                self.assert_updated(project)
+
+    def test_conflict_keeps_compression(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            client = deployversioner.deployversioner.get_client(gitlab.url, "token")
+            client.compress_commits = True
+            gitlab.before_commit = lambda p: p.push("staging", {
+                "env/file1.yml": DEPLOYMENT.format("service1", 1, "master-02")})
+            self.update(gitlab)
+        # the conflict is refused compressed and uncompressed, the retry is compressed again
+        self.assertEqual([headers.get("Content-Encoding") for _, _, headers in gitlab.bodies],
+            ["gzip", None, "gzip"])
+        self.assertTrue(client.compress_commits)
+        self.assert_updated(project)
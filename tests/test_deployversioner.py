@@ -2,24 +2,35 @@
 
 import typing
 
+import concurrent.futures
 import io
 import json
 import os
 import unittest.mock
 import pathlib
 import sys
+import tempfile
+import time
+import urllib.parse
 
 import requests
+import urllib3
 import yaml
 
+import deployversioner.cache
 import deployversioner.deployversioner
 
 class TestDeployVersioner(unittest.TestCase):
     def setUp(self):
         self.tests_path = get_tests_path()
 
-    @unittest.mock.patch("requests.get", autospec=True)
-    def test_set_image_tag(self, mock_requests_get):
+    def tearDown(self):
+        # clients hold on to the mocked session of the test
+        deployversioner.deployversioner.close_clients()
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_set_image_tag(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         mock_requests_get.return_value = self.get_mock_response_from_file(
             "data/files-gui-yaml-response.txt")
         gitlab_request = deployversioner.deployversioner.GitlabRequest(
@@ -33,8 +44,9 @@ class TestDeployVersioner(unittest.TestCase):
             self.assertEqual(docs, depl_docs)
         self.assertEqual(mock_requests_get.call_count, 1)
 
-    @unittest.mock.patch("requests.get", autospec=True)
-    def test_that_set_image_tag_sets_all_tags_in_a_yaml_doc(self, mock_requests_get):
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_that_set_image_tag_sets_all_tags_in_a_yaml_doc(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         mock_requests_get.return_value = self.get_mock_response_from_file(
             "data/files-batch-exchange-sink-yaml-response.txt")
         gitlab_request = deployversioner.deployversioner.GitlabRequest(
@@ -44,8 +56,9 @@ class TestDeployVersioner(unittest.TestCase):
         self.assertEqual(result.count("TAG-2"), 2)
         self.assertEqual(mock_requests_get.call_count, 1)
     
-    @unittest.mock.patch("requests.get", autospec=True)
-    def test_that_set_image_tag_sets_all_tags_in_a_cronjob_yaml_doc(self, mock_requests_get):
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_that_set_image_tag_sets_all_tags_in_a_cronjob_yaml_doc(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         mock_requests_get.return_value = self.get_mock_response_from_file(
             "data/files-cronjob-yaml-response.txt")
         gitlab_request = deployversioner.deployversioner.GitlabRequest(
@@ -55,10 +68,9 @@ class TestDeployVersioner(unittest.TestCase):
         self.assertEqual(result.count("main-171"), 1)
         self.assertEqual(mock_requests_get.call_count, 1)
 
-    @unittest.mock.patch("requests.get", autospec=True)
     @unittest.mock.patch("requests.Session", autospec=True)
-    def test_that_change_image_tag_makes_a_commit_message_covering_all_bumped_tags(
-            self, mock_requests_session, mock_requests_get):
+    def test_that_change_image_tag_makes_a_commit_message_covering_all_bumped_tags(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         repo_tree_response = json.dumps([
             {
                 "id": "5ab350dcf92bf662b2b309b4db83415afc2d6baa",
@@ -118,15 +130,17 @@ spec:
             "gitlab.url", "token", 103, "staging")
         proposed_commits, changed_image_tags = deployversioner.deployversioner.change_image_tag(
             gitlab_request, "files", "TAG-2")
+        self.mock_file_revisions(mock_requests_session, proposed_commits)
         deployversioner.deployversioner.commit_changes(
             gitlab_request, proposed_commits, "TAG-2", changed_image_tags)
         request = mock_requests_session.return_value.post.call_args[1]
-        commit_message = json.loads(request["data"])["commit_message"]
+        commit_message = json.loads(b"".join(request["data"]))["commit_message"]
         self.assertEqual("Bump docker tag from master-01 to TAG-2" in commit_message, True)
         self.assertEqual("Bump docker tag from master-02 to TAG-2" in commit_message, True)
 
-    @unittest.mock.patch("requests.get", autospec=True)
-    def test_multiple_yaml_files(self, mock_requests_get):
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_multiple_yaml_files(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         repo_tree_response = json.dumps([
             {
                 "id": "5ab350dcf92bf662b2b309b4db83415afc2d6baa",
@@ -178,8 +192,9 @@ spec:
         self.assertEqual(len(result), 2)
         self.assertEqual(mock_requests_get.call_count, 3)
 
-    @unittest.mock.patch("requests.get", autospec=True)
-    def test_set_image_tag_identical_new_tag(self, mock_requests_get):
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_set_image_tag_identical_new_tag(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         mock_requests_get.return_value = self.get_mock_response_from_file(
             "data/files-services-dummy-sink-yaml-response.txt")
         gitlab_request = deployversioner.deployversioner.GitlabRequest(
@@ -195,9 +210,9 @@ spec:
         self.assertEqual(imagename, "docker-io.dbc.dk/author-name-suggester-service")
         self.assertEqual(image_tag, "master-9")
 
-    @unittest.mock.patch("requests.get", autospec=True)
     @unittest.mock.patch("requests.Session", autospec=True)
-    def test_commit_changes(self, mock_requests_session, mock_requests_get):
+    def test_commit_changes(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         repo_tree_response = json.dumps([
             {
                 "id": "5ab350dcf92bf662b2b309b4db83415afc2d6baa",
@@ -239,10 +254,11 @@ spec:
             "gitlab.url", "token", 103, "staging")
         proposed_commits, changed_tags = deployversioner.deployversioner.change_image_tag(
             gitlab_request, "files", "TAG-2")
+        self.mock_file_revisions(mock_requests_session, proposed_commits)
         deployversioner.deployversioner.commit_changes(
             gitlab_request, proposed_commits, "TAG-2", changed_tags)
         request = mock_requests_session.return_value.post.call_args[1]
-        data = json.loads(request["data"])
+        data = json.loads(b"".join(request["data"]))
 
         self.assertEqual([d["file_path"] for d in data["actions"]].sort(),
                          ["services/dummy-sink.yml", "services/batch-exchange-sink.yml", "services/diff-sink.yml"].sort())
@@ -251,11 +267,11 @@ spec:
         self.assertEqual(data["commit_message"], "Bump docker tag to TAG-2\n\nBump docker tag from master-01 to TAG-2")
         self.assertEqual(request["headers"], {"private-token": "token",
             "Content-Type": "application/json"})
+        self.assertEqual({d["last_commit_id"] for d in data["actions"]}, {"last-commit"})
 
-    @unittest.mock.patch("requests.get", autospec=True)
     @unittest.mock.patch("requests.Session", autospec=True)
-    def test_commit_changes_error_400(self, mock_requests_session,
-            mock_requests_get):
+    def test_commit_changes_error_400(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         repo_tree_response = json.dumps([
             {
                 "id": "5ab350dcf92bf662b2b309b4db83415afc2d6baa",
@@ -297,18 +313,24 @@ spec:
         # wraps makes sure that methods of the original object is called
         mock_commit_response = unittest.mock.Mock(requests.Response,
             wraps=commit_response)
+        mock_commit_response.status_code = commit_response.status_code
+        mock_commit_response.headers = commit_response.headers
         mock_requests_session.return_value.post.return_value = mock_commit_response
         gitlab_request = deployversioner.deployversioner.GitlabRequest(
             "gitlab.url", "token", 103, "staging")
         proposed_commits, changed_tags = deployversioner.deployversioner.change_image_tag(
             gitlab_request, "files", "TAG-2")
+        self.mock_file_revisions(mock_requests_session, proposed_commits)
         with self.assertRaises(deployversioner.deployversioner
                 .VersionerError):
             deployversioner.deployversioner.commit_changes(
                 gitlab_request, proposed_commits, "TAG-2", changed_tags)
+        # a rejected commit is only retried if a file has changed since
+        self.assertEqual(mock_requests_session.return_value.post.call_count, 1)
 
-    @unittest.mock.patch("requests.get", autospec=True)
-    def test_get_file_contents(self, mock_requests_get):
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_get_file_contents(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         mock_requests_get.return_value = self.get_mock_response_from_file(
             "data/files-gui-yaml-response.txt")
         gitlab_request = deployversioner.deployversioner.GitlabRequest(
@@ -322,9 +344,10 @@ spec:
         self.assertEqual(mock_requests_get.call_args[1]["headers"], {"private-token": "token"})
 
     # TODO: this test doesn't seem to make sense
-    @unittest.mock.patch("requests.get", autospec=True)
-    @unittest.mock.patch("requests.post", autospec=True)
-    def test_file_does_not_exist(self, mock_requests_post, mock_requests_get):
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_file_does_not_exist(self, mock_requests_session):
+        mock_requests_session.return_value.head.return_value = self.get_mock_response(b"", status_code=404)
+        mock_requests_session.return_value.get.return_value = self.get_mock_response(b"[]")
         gitlab_request = deployversioner.deployversioner.GitlabRequest(
             "gitlab.url", "token", 103, "staging")
         with self.assertRaises(deployversioner.deployversioner
@@ -332,8 +355,9 @@ spec:
             deployversioner.deployversioner.change_image_tag(
                 gitlab_request, "services/no_exist.yaml", "TAG-2")
 
-    @unittest.mock.patch("requests.get", autospec=True)
-    def test_get_project_number(self, mock_requests_get):
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_get_project_number(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
         mock_requests_get.return_value = self.get_mock_response_from_file(
             "data/projects-test-namespace-test-project-response.txt")
         self.assertEqual( 103, deployversioner.deployversioner
@@ -341,17 +365,332 @@ spec:
             'test_namespace/test_project', 'token') )
         self.assertEqual(mock_requests_get.call_count, 1)
 
-    def get_mock_response(self, content):
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_change_image_tag_keeps_tree_order_with_concurrent_fetches(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
+        file_paths = ["files/file{}.yml".format(i) for i in range(5)]
+        responses = {"/repository/tree/": get_tree_response("files", file_paths)}
+        for i, p in enumerate(file_paths):
+            responses[urllib.parse.quote(p, safe="")] = get_deployment_yaml(
+                "service{}".format(i), "docker-image:master-0{}".format(i))
+        # make the first file the slowest so it finishes last
+        mock_requests_get.side_effect = self.get_mock_responses_by_url(responses,
+            delays={urllib.parse.quote(file_paths[0], safe=""): 0.1})
+        gitlab_request = deployversioner.deployversioner.GitlabRequest(
+            "gitlab.url", "token", 103, "staging")
+        proposed_commits, changed_image_tags = deployversioner.deployversioner.change_image_tag(
+            gitlab_request, "files", "TAG-2", max_concurrency=5)
+        self.assertEqual([c["file_path"] for c in proposed_commits], file_paths)
+        self.assertEqual(changed_image_tags, {"master-0{}".format(i) for i in range(5)})
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_change_image_tag_surfaces_errors_from_workers(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
+        file_paths = ["files/file1.yml", "files/file2.yml"]
+        responses = {"/repository/tree/": get_tree_response("files", file_paths),
+            "file1.yml": get_deployment_yaml("service1", "docker-image:master-01"),
+            "file2.yml": get_deployment_yaml("service2", "docker-image-without-tag")}
+        mock_requests_get.side_effect = self.get_mock_responses_by_url(responses)
+        gitlab_request = deployversioner.deployversioner.GitlabRequest(
+            "gitlab.url", "token", 103, "staging")
+        with self.assertRaisesRegex(deployversioner.deployversioner.VersionerError,
+                "invalid image format"):
+            deployversioner.deployversioner.change_image_tag(
+                gitlab_request, "files", "TAG-2", max_concurrency=2)
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_requests_share_one_session(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
+        mock_requests_get.return_value = self.get_mock_response_from_file(
+            "data/files-gui-yaml-response.txt")
+        gitlab_request = deployversioner.deployversioner.GitlabRequest(
+            "gitlab.url", "token", 103, "staging")
+        deployversioner.deployversioner.get_file_contents(gitlab_request, "gui.yaml")
+        deployversioner.deployversioner.get_file_contents(gitlab_request, "gui.yaml")
+        self.assertEqual(mock_requests_session.call_count, 1)
+        self.assertEqual(mock_requests_get.call_count, 2)
+
+    def test_normalize_url(self):
+        self.assertEqual(deployversioner.deployversioner.normalize_url("gitlab.url"),
+            "https://gitlab.url")
+        self.assertEqual(deployversioner.deployversioner.normalize_url("http://gitlab.url/"),
+            "http://gitlab.url")
+
+    def test_gitlab_retry_never_retries_commits(self):
+        client = deployversioner.deployversioner.GitlabClient("gitlab.url", "token")
+        retry = client.session.get_adapter("https://gitlab.url/api/v4/projects").max_retries
+        self.assertFalse(retry.is_retry("POST", 400))
+        self.assertFalse(retry.is_retry("POST", 502))
+        self.assertFalse(retry.is_retry("GET", 400))
+        self.assertTrue(retry.is_retry("GET", 502))
+        self.assertFalse(retry.is_retry("GET", 404))
+        # a connection dropped after the commit was sent
+        with self.assertRaises(urllib3.exceptions.ProtocolError):
+            retry.increment(method="POST", url="/x", error=urllib3.exceptions.ProtocolError("reset"))
+        self.assertEqual(retry.increment(method="GET", url="/x",
+            error=urllib3.exceptions.ProtocolError("reset")).total, 2)
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_iter_tree_fetches_remaining_pages_from_total_pages(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
+        page_size = deployversioner.deployversioner.TREE_PAGE_SIZE
+        pages = [[{"id": "{}-{}".format(page, i), "type": "blob", "path": "f{}-{}.yml".format(page, i)}
+            for i in range(page_size if page < 3 else 7)] for page in range(1, 4)]
+        def side_effect(url, *args, **kwargs):
+            page = int(urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)["page"][0])
+            return self.get_mock_response(json.dumps(pages[page - 1]).encode("utf8"),
+                headers={"X-Total-Pages": "3"})
+        mock_requests_get.side_effect = side_effect
+        gitlab_request = deployversioner.deployversioner.GitlabRequest(
+            "gitlab.url", "token", 103, "staging")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            entries = list(deployversioner.deployversioner.iter_tree(gitlab_request, "", executor))
+        self.assertEqual(entries, pages[0] + pages[1] + pages[2])
+        self.assertEqual(mock_requests_get.call_count, 3)
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_iter_tree_falls_back_to_keyset_pagination(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
+        page_size = deployversioner.deployversioner.TREE_PAGE_SIZE
+        first_page = [{"id": "a{}".format(i), "type": "blob", "path": "a{}.yml".format(i)}
+            for i in range(page_size)]
+        second_page = [{"id": "b1", "type": "blob", "path": "b1.yml"}]
+        mock_requests_get.side_effect = [
+            self.get_mock_response(json.dumps(first_page).encode("utf8")),
+            self.get_mock_response(json.dumps(second_page).encode("utf8")),
+        ]
+        gitlab_request = deployversioner.deployversioner.GitlabRequest(
+            "gitlab.url", "token", 103, "staging")
+        entries = list(deployversioner.deployversioner.iter_tree(gitlab_request, "files"))
+        self.assertEqual(entries, first_page + second_page)
+        keyset_url = mock_requests_get.call_args_list[1][0][0]
+        self.assertIn("pagination=keyset", keyset_url)
+        self.assertIn("page_token=a{}".format(page_size - 1), keyset_url)
+
+    def test_rewrite_image_tags_only_changes_the_tag(self):
+        file_contents = """# deployment of service1
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: service1   # keep this comment
+spec:
+  template:
+    spec:
+      containers:
+      - name: service1
+        image: "docker-image:master-01"
+---
+kind: ConfigMap
+apiVersion: v1
+data: {image: "docker-image:master-01"}
+---
+apiVersion: batch/v1
+kind: CronJob
+spec:
+  jobTemplate:
+    spec:
+      template:
+        spec:
+          containers:
+            - image: 'docker-image:master-02'
+"""
+        result, changed_image_tags = deployversioner.deployversioner.rewrite_image_tags_in_place(
+            file_contents, "TAG-2")
+        self.assertEqual(result, file_contents
+            .replace('"docker-image:master-01"\n---\nkind', '"docker-image:TAG-2"\n---\nkind')
+            .replace("'docker-image:master-02'", "'docker-image:TAG-2'"))
+        self.assertEqual(changed_image_tags, {"master-01", "master-02"})
+
+    def test_rewrite_image_tags_falls_back_to_dump_for_anchors(self):
+        file_contents = """kind: StatefulSet
+spec:
+  template:
+    spec:
+      containers:
+      - image: &image docker-image:master-01
+metadata:
+  labels: {image: *image}
+"""
+        with self.assertRaises(deployversioner.deployversioner.InPlaceRewriteNotPossible):
+            deployversioner.deployversioner.rewrite_image_tags_in_place(file_contents, "TAG-2")
+        result, changed_image_tags = deployversioner.deployversioner.rewrite_image_tags(
+            file_contents, "TAG-2")
+        doc = yaml.safe_load(result)
+        self.assertEqual(doc["spec"]["template"]["spec"]["containers"][0]["image"], "docker-image:TAG-2")
+        self.assertEqual(doc["metadata"]["labels"]["image"], "docker-image:master-01")
+        self.assertEqual(changed_image_tags, {"master-01"})
+
+    def test_rewrite_image_tags_in_place_matches_dump(self):
+        for response_filename in ["data/files-gui-yaml-response.txt",
+                "data/files-batch-exchange-sink-yaml-response.txt",
+                "data/files-cronjob-yaml-response.txt"]:
+            with open(os.path.join(self.tests_path, response_filename)) as fp:
+                file_contents = fp.read()
+            in_place, in_place_tags = deployversioner.deployversioner.rewrite_image_tags_in_place(
+                file_contents, "TAG-2")
+            dumped, dumped_tags = deployversioner.deployversioner.rewrite_image_tags_by_dump(
+                file_contents, "TAG-2")
+            self.assertEqual([d for d in yaml.safe_load_all(in_place) if d is not None],
+                [d for d in yaml.safe_load_all(dumped)])
+            self.assertEqual(in_place_tags, dumped_tags)
+
+    def test_prescan_needs_rewrite(self):
+        prescan_needs_rewrite = deployversioner.deployversioner.prescan_needs_rewrite
+        self.assertFalse(prescan_needs_rewrite("kind: Service\nspec: {ports: [80]}\n", "TAG-2"))
+        self.assertFalse(prescan_needs_rewrite(
+            get_deployment_yaml("service1", "docker-image:TAG-2"), "TAG-2"))
+        self.assertTrue(prescan_needs_rewrite(
+            get_deployment_yaml("service1", "docker-image:TAG-1"), "TAG-2"))
+        self.assertTrue(prescan_needs_rewrite(
+            '{"kind": "Job", "spec": {"template": {"spec": {"containers": '
+            '[{"image": "docker-image:TAG-1"}]}}}}', "TAG-2"))
+        # prefix of the new tag isn't mistaken for the new tag
+        self.assertTrue(prescan_needs_rewrite(
+            get_deployment_yaml("service1", "docker-image:TAG-2"), "2"))
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_change_image_tag_skips_non_workloads_without_parsing(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
+        file_paths = ["files/configmap.yml", "files/deployment.yml"]
+        mock_requests_get.side_effect = self.get_mock_responses_by_url({
+            "/repository/tree/": get_tree_response("files", file_paths),
+            "configmap.yml": "kind: ConfigMap\ndata: {key: value}\n",
+            "deployment.yml": get_deployment_yaml("service1", "docker-image:master-01")})
+        gitlab_request = deployversioner.deployversioner.GitlabRequest(
+            "gitlab.url", "token", 103, "staging")
+        with unittest.mock.patch("deployversioner.deployversioner.rewrite_image_tags_in_place",
+                wraps=deployversioner.deployversioner.rewrite_image_tags_in_place) as mock_rewrite, \
+                self.assertLogs("deployversioner.deployversioner", "INFO") as logs:
+            proposed_commits, _ = deployversioner.deployversioner.change_image_tag(
+                gitlab_request, "files", "TAG-2")
+        self.assertEqual([c["file_path"] for c in proposed_commits], ["files/deployment.yml"])
+        self.assertEqual(mock_rewrite.call_count, 1)
+        self.assertIn("parsed 1 manifests, skipped 1", "\n".join(logs.output))
+
+    def test_transform_blob_pre_scans_before_finding_references(self):
+        def transform(content, cached=False, references=None):
+            blob = deployversioner.deployversioner.FetchedBlob({"id": "1", "path": "files/file.yml"},
+                content, references, cached, None)
+            with unittest.mock.patch("deployversioner.deployversioner.find_image_references",
+                    wraps=deployversioner.deployversioner.find_image_references) as mock_find:
+                result, references = deployversioner.deployversioner.transform_blob(blob, "TAG-2", True)
+            return result["parsed"], references, mock_find.call_count
+        tagged = get_deployment_yaml("service1", "docker-image:TAG-2")
+        self.assertEqual(transform("kind: ConfigMap\ndata: {key: value}\n"), (False, [], 0))
+        # the references of a tagged workload aren't cached, so a later tag finds them
+        self.assertEqual(transform(tagged), (False, None, 0))
+        parsed, references, found = transform(get_deployment_yaml("service1", "docker-image:master-01"))
+        self.assertEqual((parsed, len(references), found), (True, 1, 1))
+        self.assertEqual(transform(get_deployment_yaml("service1", "docker-image:master-01"), True,
+            references), (False, references, 0))
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_change_image_tag_uses_blob_cache(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
+        file_paths = ["files/configmap.yml", "files/deployment.yml"]
+        mock_requests_get.side_effect = self.get_mock_responses_by_url({
+            "/repository/tree/": get_tree_response("files", file_paths),
+            "configmap.yml": "kind: ConfigMap\ndata: {key: value}\n",
+            "deployment.yml": get_deployment_yaml("service1", "docker-image:master-01")})
+        gitlab_request = deployversioner.deployversioner.GitlabRequest(
+            "gitlab.url", "token", 103, "staging")
+        with tempfile.TemporaryDirectory() as cache_dir:
+            blob_cache = deployversioner.cache.BlobCache(cache_dir)
+            first_run = deployversioner.deployversioner.change_image_tag(
+                gitlab_request, "files", "TAG-2", blob_cache=blob_cache)
+            self.assertEqual(mock_requests_get.call_count, 3)
+            with unittest.mock.patch("deployversioner.deployversioner.find_image_references") as mock_find:
+                second_run = deployversioner.deployversioner.change_image_tag(
+                    gitlab_request, "files", "TAG-2", blob_cache=blob_cache)
+                unchanged = deployversioner.deployversioner.change_image_tag(
+                    gitlab_request, "files", "master-01", blob_cache=blob_cache)
+            self.assertEqual(mock_find.call_count, 0)
+        # only the tree is listed again
+        self.assertEqual(mock_requests_get.call_count, 5)
+        self.assertEqual(first_run, second_run)
+        self.assertEqual(first_run[0][0]["content"],
+            get_deployment_yaml("service1", "docker-image:TAG-2"))
+        self.assertEqual(unchanged, ([], set()))
+
+    @unittest.mock.patch("requests.Session", autospec=True)
+    def test_main_invalidates_cached_project_id_on_project_not_found(self, mock_requests_session):
+        mock_requests_get = mock_requests_session.return_value.get
+        def side_effect(url, *args, **kwargs):
+            if "/projects/103/" in url:
+                return self.get_mock_response(b'{"message":"404 Project Not Found"}', status_code=404)
+            if "/projects/metascrum%2Frrflow-deploy" in url:
+                return self.get_mock_response(b'{"id": 104}')
+            if "/repository/tree/" in url:
+                return self.get_mock_response(get_tree_response("files", ["files/file1.yml"]).encode("utf8"))
+            return self.get_mock_response(get_deployment_yaml("service1", "docker-image:master-01").encode("utf8"))
+        mock_requests_get.side_effect = side_effect
+        with tempfile.TemporaryDirectory() as cache_dir:
+            project_id_cache = deployversioner.cache.ProjectIdCache(cache_dir)
+            project_id_cache.put("https://gitlab.url", "metascrum/rrflow-deploy", 103)
+            argv = ["set-new-version", "files", "token", "metascrum/rrflow-deploy", "TAG-2",
+                "--gitlab-url", "https://gitlab.url", "--cache-dir", cache_dir, "--dry-run"]
+            with unittest.mock.patch("sys.argv", argv), \
+                    unittest.mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                deployversioner.deployversioner.main()
+            self.assertEqual(project_id_cache.get("https://gitlab.url", "metascrum/rrflow-deploy"), 104)
+        self.assertIn("docker-image:TAG-2", stdout.getvalue())
+
+    def get_mock_responses_by_url(self, responses, delays=None):
+        """returns a side effect which answers a request with the response
+        whose key is a substring of the requested url"""
+        delays = delays if delays is not None else {}
+        def side_effect(url, *args, **kwargs):
+            for key, delay in delays.items():
+                if key in url:
+                    time.sleep(delay)
+            for key, content in responses.items():
+                if key in url:
+                    return self.get_mock_response(content.encode("utf8"))
+            raise AssertionError("unexpected request for {}".format(url))
+        return side_effect
+
+    def get_mock_response(self, content, headers=None, links=None, status_code=200):
         mock_response = unittest.mock.Mock(requests.Response)
+        mock_response.status_code = status_code
+        mock_response.url = "https://gitlab.url"
+        mock_response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        mock_response.links = links if links is not None else {}
         mock_response.content = content
         mock_response.text = mock_response.content.decode("utf8")
         mock_response.json = lambda: json.loads(mock_response.text)
         return mock_response
 
+    def mock_file_revisions(self, mock_requests_session, proposed_commits, last_commit_id="last-commit"):
+        r"""make the files of proposed_commits unchanged since they were fetched"""
+        blob_ids = {urllib.parse.quote(c["file_path"], safe=""): c["blob_id"] for c in proposed_commits}
+        def head(url, **kwargs):
+            blob_id = blob_ids[url.split("/repository/files/")[1].split("?")[0]]
+            return self.get_mock_response(b"", {"X-Gitlab-Blob-Id": blob_id,
+                "X-Gitlab-Last-Commit-Id": last_commit_id})
+        mock_requests_session.return_value.head.side_effect = head
+
     def get_mock_response_from_file(self, response_filename):
         with open(os.path.join(self.tests_path, response_filename), "rb") as fp:
             return self.get_mock_response(fp.read())
 
+def get_tree_response(directory, file_paths):
+    tree = [{"id": "0", "name": directory, "type": "tree", "path": directory}]
+    tree.extend({"id": str(i + 1), "name": p.split("/")[-1], "type": "blob", "path": p}
+        for i, p in enumerate(file_paths))
+    return json.dumps(tree)
+
+def get_deployment_yaml(name, image):
+    return """apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: {}
+spec:
+  template:
+    spec:
+      containers:
+      - image: {}
+""".format(name, image)
+
 def get_tests_path():
     try:
         # get the parent directory of the directory this file is in
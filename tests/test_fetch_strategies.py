@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import deployversioner.deployversioner
+
+from fakegitlab import FakeGitlab, GitlabTestCase, deployments, make_project
+
+def get_project():
+    files = deployments(5, "master-0{}".format)
+    files["env/configmap.yml"] = "kind: ConfigMap\ndata: {key: value}\n"
+    files["README.md"] = "# deploy\n"
+    return make_project(files)
+
+class TestFetchStrategies(GitlabTestCase):
+    def change_image_tag(self, gitlab, **kwargs):
+        return deployversioner.deployversioner.change_image_tag(
+            self.gitlab_request(gitlab), "env", "TAG-2", **kwargs)
+
+    def test_graphql_fetches_files_in_batches(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            expected = self.change_image_tag(gitlab)
+            self.assertEqual(len(gitlab.requests_to("/raw")), 6)
+            deployversioner.deployversioner.close_clients()
+            gitlab.requests.clear()
+            result = self.change_image_tag(gitlab, fetch_strategy="graphql", graphql_batch_size=4)
+        # the last commits of files are only known if they are fetched over rest
+        self.assertEqual([c.pop("last_commit_id") for c in expected[0]], ["0" * 40] * 5)
+        self.assertEqual(result, expected)
+        self.assertEqual(len(result[0]), 5)
+        self.assertEqual(len(gitlab.requests_to("/api/graphql")), 2)
+        self.assertEqual(len(gitlab.requests_to("/raw")), 0)
+
+    def test_graphql_falls_back_to_rest(self):
+        with FakeGitlab([get_project()], graphql=False) as gitlab:
+            result = self.change_image_tag(gitlab, fetch_strategy="graphql", graphql_batch_size=2,
+                max_concurrency=1)
+        self.assertEqual(len(result[0]), 5)
+        self.assertEqual(result[1], {"master-0{}".format(n) for n in range(5)})
+        # graphql isn't tried again once it has failed
+        self.assertEqual(len(gitlab.requests_to("/api/graphql")), 1)
+        self.assertEqual(len(gitlab.requests_to("/raw")), 6)
+
+    def test_failed_graphql_queries_fall_back_for_their_files(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            gitlab.graphql_errors = ["Timeout on Query.projects"]
+            result = self.change_image_tag(gitlab, fetch_strategy="graphql", graphql_batch_size=2,
+                max_concurrency=1)
+        self.assertEqual(len(result[0]), 5)
+        # only the files of the failed query are fetched over rest
+        self.assertEqual(len(gitlab.requests_to("/api/graphql")), 3)
+        self.assertEqual(len(gitlab.requests_to("/raw")), 2)
+
+    def test_graphql_without_blobs_is_given_up(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            gitlab.graphql_errors = ["Field 'blobs' doesn't exist on type 'Repository'"]
+            result = self.change_image_tag(gitlab, fetch_strategy="graphql", graphql_batch_size=2,
+                max_concurrency=1)
+        self.assertEqual(len(result[0]), 5)
+        self.assertEqual(len(gitlab.requests_to("/api/graphql")), 1)
+        self.assertEqual(len(gitlab.requests_to("/raw")), 6)
+
+    def test_archive_fetches_all_files_in_one_request(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            expected_commits, expected_tags = self.change_image_tag(gitlab)
+            gitlab.requests.clear()
+            commits, tags = self.change_image_tag(gitlab, fetch_strategy="archive")
+        self.assertEqual(tags, expected_tags)
+        # the last commits of files read from an archive are looked up when committing
+        for c in expected_commits:
+            del c["last_commit_id"]
+        self.assertEqual(commits, expected_commits)
+        self.assertEqual(len(gitlab.requests_to("/repository/archive.tar.gz")), 1)
+        self.assertEqual(len(gitlab.requests_to("/raw")), 0)
+
+    def test_auto_uses_archive_above_threshold(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            self.change_image_tag(gitlab, fetch_strategy="auto", archive_threshold=6)
+            self.assertEqual(len(gitlab.requests_to("/repository/archive.tar.gz")), 0)
+            self.assertEqual(len(gitlab.requests_to("/raw")), 6)
+            gitlab.requests.clear()
+            self.change_image_tag(gitlab, fetch_strategy="auto", archive_threshold=5)
+            self.assertEqual(len(gitlab.requests_to("/repository/archive.tar.gz")), 1)
+            self.assertEqual(len(gitlab.requests_to("/raw")), 0)
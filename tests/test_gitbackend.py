@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import base64
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+import deployversioner.cache
+import deployversioner.deployversioner
+import deployversioner.gitbackend
+
+from fakegitlab import deployment, deployments
+
+class EvictingBlobCache(deployversioner.cache.BlobCache):
+    r"""blob cache which loses blob_id right after it is first found in it"""
+    def __init__(self, directory, blob_id):
+        super().__init__(directory)
+        self.blob_id = blob_id
+
+    def get(self, blob_id):
+        if blob_id == self.blob_id:
+            self.blob_id = None
+            return None
+        return super().get(blob_id)
+
+def git(directory, *args):
+    return subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@localhost"] + list(args),
+        cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout.decode("utf8")
+
+@unittest.skipIf(shutil.which("git") is None, "git is not installed")
+class TestGitBackend(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.remote = os.path.join(self.directory.name, "remote.git")
+        git(self.directory.name, "init", "-q", "--bare", self.remote)
+        git(self.remote, "config", "uploadpack.allowFilter", "true")
+        # file:// makes git use the same protocol as for a remote, so --depth works
+        self.remote_url = "file://" + self.remote
+        self.cache_dir = os.path.join(self.directory.name, "cache")
+        self.push(deployments(3, "master-0{}".format))
+        self.push({"other/file.yml": deployment("other", "master-1"), "README.md": "# deploy\n"})
+
+    def push(self, files, branch="staging"):
+        clone = tempfile.mkdtemp(dir=self.directory.name)
+        git(clone, "clone", "-q", self.remote_url, ".")
+        if git(clone, "ls-remote", "origin", branch):
+            git(clone, "checkout", "-q", branch)
+        else:
+            git(clone, "checkout", "-q", "-b", branch)
+        for file_path, content in files.items():
+            os.makedirs(os.path.join(clone, os.path.dirname(file_path)), exist_ok=True)
+            with open(os.path.join(clone, file_path), "w") as fp:
+                fp.write(content)
+        git(clone, "add", "-A")
+        git(clone, "commit", "-q", "-m", "update")
+        git(clone, "push", "-q", "origin", branch)
+
+    def show(self, file_path, branch="staging"):
+        return git(self.remote, "show", "{}:{}".format(branch, file_path))
+
+    def update(self, file_object, tag, blob_cache=None):
+        with deployversioner.gitbackend.open_working_copy(self.remote_url, None, self.cache_dir) as working_copy:
+            proposed_commits, changed_image_tags = deployversioner.gitbackend.change_image_tag(
+                working_copy, "staging", file_object, tag, blob_cache)
+            deployversioner.gitbackend.commit_changes(working_copy, "staging", proposed_commits, tag,
+                changed_image_tags)
+            return working_copy
+
+    def test_change_image_tag_pushes_one_commit(self):
+        working_copy = self.update("env", "TAG-2")
+        for n in range(3):
+            self.assertEqual(self.show("env/file{}.yml".format(n)),
+                deployment("service{}".format(n), "TAG-2"))
+        self.assertEqual(self.show("other/file.yml"), deployment("other", "master-1"))
+        message = git(self.remote, "log", "-1", "--format=%B", "staging").split("\n")
+        self.assertEqual(message[0], "Bump docker tag to TAG-2")
+        self.assertEqual(sorted(l for l in message[1:] if l), ["Bump docker tag from master-0{} to TAG-2".format(n)
+            for n in range(3)])
+        # only the manifests being changed are checked out
+        self.assertTrue(os.path.exists(os.path.join(working_copy.directory, "env", "file0.yml")))
+        self.assertFalse(os.path.exists(os.path.join(working_copy.directory, "other")))
+        self.assertFalse(os.path.exists(os.path.join(working_copy.directory, "README.md")))
+
+    def test_working_copy_is_reused_between_runs(self):
+        self.update("env/file0.yml", "TAG-2")
+        # a change pushed by someone else is fetched by the next run
+        self.push({"env/file1.yml": deployment("service1", "TAG-1")})
+        working_copy = self.update("env", "TAG-3")
+        self.assertEqual(working_copy.directory, deployversioner.gitbackend.mirror_directory(
+            self.cache_dir, self.remote_url))
+        self.assertEqual(self.show("env/file1.yml"), deployment("service1", "TAG-3"))
+        self.assertEqual(git(self.remote, "rev-list", "--count", "staging"), "5\n")
+        # the working copy stays shallow
+        self.assertEqual(git(working_copy.directory, "rev-list", "--count", "HEAD"), "2\n")
+
+    def test_files_evicted_from_the_cache_are_checked_out(self):
+        blob_cache = deployversioner.cache.BlobCache(self.cache_dir)
+        with deployversioner.gitbackend.open_working_copy(self.remote_url, None, self.cache_dir) as working_copy:
+            deployversioner.gitbackend.change_image_tag(working_copy, "staging", "env", "TAG-2", blob_cache)
+        blob_id = git(self.remote, "rev-parse", "staging:env/file1.yml").strip()
+        self.update("env", "TAG-2", EvictingBlobCache(self.cache_dir, blob_id))
+        for n in range(3):
+            self.assertEqual(self.show("env/file{}.yml".format(n)), deployment("service{}".format(n), "TAG-2"))
+
+    def test_api_token_is_passed_in_the_environment(self):
+        working_copy = deployversioner.gitbackend.GitWorkingCopy("https://gitlab.url/project.git",
+            self.directory.name, "secret-token")
+        with unittest.mock.patch("subprocess.run") as run, \
+                unittest.mock.patch.dict(os.environ, {"GIT_CONFIG_COUNT": "1"}):
+            working_copy.git("status")
+        command = run.call_args[0][0]
+        env = run.call_args[1]["env"]
+        credentials = base64.b64encode(b"oauth2:secret-token").decode("ascii")
+        self.assertFalse(any(credentials in arg for arg in command))
+        self.assertEqual(env["GIT_CONFIG_COUNT"], "2")
+        self.assertEqual(env["GIT_CONFIG_KEY_1"], "http.extraHeader")
+        self.assertEqual(env["GIT_CONFIG_VALUE_1"], "Authorization: Basic {}".format(credentials))
+
+    def test_unchanged_and_missing_files(self):
+        blob_cache = deployversioner.cache.BlobCache(self.cache_dir)
+        with self.assertRaises(deployversioner.deployversioner.VersionUnchangedException):
+            self.update("env/file0.yml", "master-00", blob_cache)
+        with self.assertRaises(deployversioner.deployversioner.VersionerFileNotFound):
+            self.update("env/missing.yml", "TAG-2", blob_cache)
+        self.update("env/file0.yml", "TAG-2", blob_cache)
+        self.assertEqual(self.show("env/file0.yml"), deployment("service0", "TAG-2"))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import json
+import tempfile
+
+import deployversioner.cli
+import deployversioner.deployversioner
+import deployversioner.index
+
+from fakegitlab import DEPLOYMENT, FakeGitlab, GitlabTestCase, blob_sha, make_project
+
+SIDECARS = """apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: sidecars
+spec:
+  template:
+    spec:
+      initContainers:
+      - image: "docker-io.dbc.dk/migrate:1"
+      containers:
+      - name: main
+        image: docker-io.dbc.dk/rrflow:master-01
+      - name: proxy
+        image: docker-io.dbc.dk/proxy:2
+---
+apiVersion: batch/v1
+kind: CronJob
+spec:
+  jobTemplate:
+    spec:
+      template:
+        spec:
+          containers:
+          - image: docker-io.dbc.dk/cleanup:3
+"""
+
+def get_project():
+    files = {"services/service{}.yml".format(n): DEPLOYMENT.format("service{}".format(n),
+        "docker-io.dbc.dk/service{}:master-0{}".format(n, n)) for n in range(8)}
+    files["services/rrflow.yml"] = DEPLOYMENT.format("rrflow", "docker-io.dbc.dk/rrflow:master-01")
+    files["services/sidecars.yml"] = SIDECARS
+    files["README.md"] = "# deploy\n"
+    return make_project(files)
+
+class TestIndex(GitlabTestCase):
+    def test_build_index(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            image_index = deployversioner.index.build_index(self.gitlab_request(gitlab))
+        self.assertEqual(len(image_index.files), 10)
+        self.assertEqual(image_index.lookup("docker-io.dbc.dk/rrflow"), [
+            deployversioner.index.IndexEntry("services/rrflow.yml", 0,
+                "spec.template.spec.containers[0].image", "master-01",
+                blob_sha(DEPLOYMENT.format("rrflow", "docker-io.dbc.dk/rrflow:master-01"))),
+            deployversioner.index.IndexEntry("services/sidecars.yml", 0,
+                "spec.template.spec.containers[0].image", "master-01", blob_sha(SIDECARS))])
+        self.assertEqual([(e.container, e.tag) for e in image_index.lookup("docker-io.dbc.dk/migrate")],
+            [("spec.template.spec.initContainers[0].image", "1")])
+        self.assertEqual([(e.document, e.container) for e in image_index.lookup("docker-io.dbc.dk/cleanup")],
+            [(1, "spec.jobTemplate.spec.template.spec.containers[0].image")])
+        self.assertEqual(image_index.lookup("docker-io.dbc.dk/unknown"), [])
+
+    def test_bump_image_fetches_only_files_using_it(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            image_index = deployversioner.index.build_index(self.gitlab_request(gitlab))
+            gitlab.requests.clear()
+            proposed_commits, changed_image_tags = deployversioner.index.bump_image(
+                self.gitlab_request(gitlab), image_index, "docker-io.dbc.dk/rrflow", "TAG-2")
+            self.assertEqual(len(gitlab.requests_to("/raw")), 2)
+            self.assertEqual(len(gitlab.requests_to("/repository/tree")), 0)
+            deployversioner.deployversioner.commit_changes(self.gitlab_request(gitlab), proposed_commits,
+                "TAG-2", changed_image_tags)
+        self.assertEqual(changed_image_tags, {"master-01"})
+        files = project.branches["staging"]
+        self.assertEqual(files["services/rrflow.yml"], DEPLOYMENT.format("rrflow", "docker-io.dbc.dk/rrflow:TAG-2"))
+        # only the named image is changed in a file with several containers
+        self.assertEqual(files["services/sidecars.yml"], SIDECARS.replace("rrflow:master-01", "rrflow:TAG-2"))
+
+    def test_bump_image_rebases_only_the_image(self):
+        project = get_project()
+        sidecars = SIDECARS.replace("proxy:2", "proxy:3")
+        with FakeGitlab([project]) as gitlab:
+            image_index = deployversioner.index.build_index(self.gitlab_request(gitlab))
+            proposed_commits, changed_image_tags = deployversioner.index.bump_image(
+                self.gitlab_request(gitlab), image_index, "docker-io.dbc.dk/rrflow", "TAG-2")
+            # another pipeline changes a file with several containers before the commit is made
+            gitlab.before_commit = lambda p: p.push("staging", {"services/sidecars.yml": sidecars})
+            deployversioner.deployversioner.commit_changes(self.gitlab_request(gitlab), proposed_commits,
+                "TAG-2", changed_image_tags, rebase=deployversioner.index.rebase_image)
+            self.assertEqual(len(gitlab.requests_to("/repository/commits")), 2)
+        files = project.branches["staging"]
+        self.assertEqual(files["services/sidecars.yml"], sidecars.replace("rrflow:master-01", "rrflow:TAG-2"))
+        self.assertEqual(files["services/rrflow.yml"], DEPLOYMENT.format("rrflow", "docker-io.dbc.dk/rrflow:TAG-2"))
+        self.assertEqual(len(project.commits), 2)
+
+    def test_bump_image_reindexes_changed_files(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            image_index = deployversioner.index.build_index(self.gitlab_request(gitlab))
+            changed = SIDECARS.replace("      - name: proxy\n",
+                "      - name: other\n        image: x:1\n      - name: proxy\n")
+            project.push("staging", {"services/sidecars.yml": changed})
+            proposed_commits, _ = deployversioner.index.bump_image(
+                self.gitlab_request(gitlab), image_index, "docker-io.dbc.dk/proxy", "3")
+        self.assertEqual(proposed_commits[0]["content"], changed.replace("proxy:2", "proxy:3"))
+        self.assertEqual(image_index.files["services/sidecars.yml"][0], blob_sha(changed))
+
+    def test_bump_command_reuses_stored_index(self):
+        project = get_project()
+        with tempfile.TemporaryDirectory() as cache_dir, FakeGitlab([project]) as gitlab:
+            def bump(tag):
+                with self.assertRaises(SystemExit) as e:
+                    deployversioner.cli.main(["bump", "metascrum/rrflow-deploy", "docker-io.dbc.dk/rrflow",
+                        tag, "--gitlab-url", gitlab.url, "--gitlab-api-token", "token",
+                        "--cache-dir", cache_dir])
+                self.assertEqual(e.exception.code, 0)
+            bump("TAG-2")
+            self.assertEqual(len(gitlab.requests_to("/repository/tree")), 1)
+            bump("TAG-3")
+            self.assertEqual(len(gitlab.requests_to("/repository/tree")), 1)
+            stored = deployversioner.index.load_index(deployversioner.index.index_file(cache_dir,
+                gitlab.url, "metascrum/rrflow-deploy", "staging"))
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output), self.assertRaises(SystemExit):
+                deployversioner.cli.main(["index", "metascrum/rrflow-deploy", "--gitlab-url", gitlab.url,
+                    "--gitlab-api-token", "token", "--cache-dir", cache_dir])
+        self.assertEqual(len(project.commits), 2)
+        self.assertEqual([e.tag for e in stored.lookup("docker-io.dbc.dk/rrflow")], ["TAG-3", "TAG-3"])
+        self.assertEqual(len(json.loads(output.getvalue())["docker-io.dbc.dk/rrflow"]), 2)
+
+    def test_refresh_index_looks_only_at_changed_files(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            image_index = deployversioner.index.build_index(self.gitlab_request(gitlab))
+            project.push("staging", {
+                "services/service3.yml": DEPLOYMENT.format("service3", "docker-io.dbc.dk/rrflow:master-01"),
+                "services/rrflow.yml": None,
+                "services/new.yml": DEPLOYMENT.format("new", "docker-io.dbc.dk/new:1"),
+                "README.md": "# deploy\n\nchanged\n"})
+            gitlab.requests.clear()
+            deployversioner.index.refresh_index(self.gitlab_request(gitlab), image_index)
+            self.assertEqual(len(gitlab.requests_to("/repository/tree")), 0)
+            self.assertEqual(len(gitlab.requests_to("/raw")), 2)
+            self.assertEqual(image_index.commit, project.head("staging"))
+            # nothing is fetched when the branch hasn't moved
+            gitlab.requests.clear()
+            deployversioner.index.refresh_index(self.gitlab_request(gitlab), image_index)
+            self.assertEqual(len(gitlab.requests_to("/repository/compare")), 0)
+        self.assertEqual([e.path for e in image_index.lookup("docker-io.dbc.dk/rrflow")],
+            ["services/service3.yml", "services/sidecars.yml"])
+        self.assertEqual([e.path for e in image_index.lookup("docker-io.dbc.dk/new")], ["services/new.yml"])
+        self.assertEqual(image_index.lookup("docker-io.dbc.dk/service3"), [])
+
+    def test_refresh_index_with_trailing_slash(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            image_index = deployversioner.index.build_index(self.gitlab_request(gitlab), "services/")
+            project.push("staging", {
+                "services/service3.yml": DEPLOYMENT.format("service3", "docker-io.dbc.dk/rrflow:master-01")})
+            deployversioner.index.refresh_index(self.gitlab_request(gitlab), image_index)
+        self.assertEqual([e.path for e in image_index.lookup("docker-io.dbc.dk/rrflow")],
+            ["services/rrflow.yml", "services/service3.yml", "services/sidecars.yml"])
+
+    def test_refresh_index_falls_back_to_full_walk(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            image_index = deployversioner.index.build_index(self.gitlab_request(gitlab))
+            project.push("staging", {"services/service3.yml": None, "services/service4.yml": None})
+            gitlab.requests.clear()
+            image_index = deployversioner.index.refresh_index(self.gitlab_request(gitlab), image_index,
+                max_changes=1)
+            self.assertEqual(len(gitlab.requests_to("/repository/tree")), 1)
+            self.assertEqual(len(image_index.files), 8)
+            # a commit gitlab doesn't know, e.g. after a force push
+            image_index.commit = "f" * 40
+            gitlab.requests.clear()
+            image_index = deployversioner.index.refresh_index(self.gitlab_request(gitlab), image_index)
+            self.assertEqual(len(gitlab.requests_to("/repository/tree")), 1)
+        self.assertEqual(image_index.commit, project.head("staging"))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import deployversioner.cli
+import deployversioner.deployversioner
+import deployversioner.metrics
+
+from fakegitlab import FakeGitlab, GitlabTestCase, deployments, make_project
+
+def get_project():
+    return make_project(deployments(3))
+
+class TestMetrics(GitlabTestCase):
+    def tearDown(self):
+        deployversioner.metrics.disable()
+        super().tearDown()
+
+    def test_requests_are_counted_per_phase(self):
+        recorded = deployversioner.metrics.enable()
+        with FakeGitlab([get_project()]) as gitlab:
+            gitlab_request = self.gitlab_request(gitlab)
+            proposed_commits, changed_image_tags = deployversioner.deployversioner.change_image_tag(
+                gitlab_request, "env", "TAG-2")
+            deployversioner.deployversioner.commit_changes(gitlab_request, proposed_commits, "TAG-2",
+                changed_image_tags)
+        data = recorded.to_json()
+        self.assertEqual(data["http"]["tree"]["requests"], 1)
+        self.assertEqual(data["http"]["fetch"]["requests"], 3)
+        # the files are pinned to the last commits they were fetched with
+        self.assertEqual(data["http"]["commit"]["requests"], 1)
+        self.assertEqual(data["http"]["commit"]["status"], {"201": 1})
+        self.assertGreater(data["http"]["commit"]["sent_bytes"], 0)
+        self.assertEqual(sorted(data["phases"]), ["change", "commit", "tree"])
+        self.assertEqual(data["phases"]["commit"]["count"], 1)
+        self.assertEqual(sorted(data["files"]), ["env/file0.yml", "env/file1.yml", "env/file2.yml"])
+        text = recorded.to_prometheus()
+        self.assertIn('deployversioner_http_requests{phase="fetch",status="200"} 3\n', text)
+        self.assertIn("deployversioner_files_rewritten 3\n", text)
+
+    def test_tree_phase_times_only_the_requests(self):
+        recorded = deployversioner.metrics.enable()
+        with FakeGitlab([get_project()]) as gitlab:
+            for _ in deployversioner.deployversioner.iter_tree(self.gitlab_request(gitlab), "env"):
+                time.sleep(0.1)
+        self.assertLess(recorded.phases["tree"][0], 0.1)
+
+    def test_requests_are_counted_where_they_are_made(self):
+        recorded = deployversioner.metrics.enable()
+        with FakeGitlab([get_project()]) as gitlab:
+            proposed_commits, changed_image_tags = deployversioner.deployversioner.change_image_tag(
+                self.gitlab_request(gitlab), "env/file0.yml", "TAG-2")
+            proposed_commits[0]["last_commit_id"] = None
+            deployversioner.deployversioner.commit_changes(self.gitlab_request(gitlab), proposed_commits, "TAG-2",
+                changed_image_tags)
+        # the lookup of a single file is part of fetching it, the lookup of its last commit of committing it
+        self.assertEqual(recorded.http["fetch"].status, {200: 2})
+        self.assertEqual(recorded.http["commit"].status, {200: 1, 201: 1})
+
+    def test_rewrites_in_processes_are_timed(self):
+        self.addCleanup(deployversioner.deployversioner.close_transform_pool)
+        recorded = deployversioner.metrics.enable()
+        with FakeGitlab([get_project()]) as gitlab:
+            deployversioner.deployversioner.change_image_tag(self.gitlab_request(gitlab), "env", "TAG-2",
+                execution="process")
+        self.assertEqual(sorted(recorded.files), ["env/file0.yml", "env/file1.yml", "env/file2.yml"])
+        self.assertTrue(all(seconds > 0 for seconds in recorded.files.values()))
+
+    def test_archive_bytes_are_counted(self):
+        recorded = deployversioner.metrics.enable()
+        with FakeGitlab([get_project()]) as gitlab:
+            gitlab_request = self.gitlab_request(gitlab)
+            deployversioner.deployversioner.change_image_tag(gitlab_request, "env", "TAG-2",
+                fetch_strategy="archive")
+        self.assertEqual(recorded.http["fetch"].requests, 1)
+        self.assertGreater(recorded.http["fetch"].received_bytes, 0)
+
+    def test_disabled_metrics_record_nothing(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            gitlab_request = self.gitlab_request(gitlab)
+            deployversioner.deployversioner.change_image_tag(gitlab_request, "env", "TAG-2")
+        self.assertIsNone(deployversioner.metrics.current)
+
+    def test_metrics_are_exported_by_the_cli(self):
+        with tempfile.TemporaryDirectory() as directory, FakeGitlab([get_project()]) as gitlab:
+            textfile = os.path.join(directory, "deployversioner.prom")
+            stderr = io.StringIO()
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(stderr), \
+                    self.assertRaises(SystemExit):
+                deployversioner.cli.main(["index", "metascrum/rrflow-deploy", "--gitlab-url", gitlab.url,
+                    "--gitlab-api-token", "token", "--no-cache", "--metrics-json",
+                    "--metrics-textfile", textfile])
+            with open(textfile) as fp:
+                text = fp.read()
+        data = json.loads(stderr.getvalue())
+        self.assertEqual(data["http"]["project_lookup"]["requests"], 1)
+        self.assertIn("project_lookup", data["phases"])
+        self.assertIn('deployversioner_http_requests{phase="tree",status="200"} 1\n', text)
+        self.assertIsNone(deployversioner.metrics.current)
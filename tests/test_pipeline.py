@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import tempfile
+import threading
+import time
+
+import deployversioner.cache
+import deployversioner.deployversioner
+
+from fakegitlab import FakeGitlab, GitlabTestCase, blob_sha, deployment, make_project
+
+def get_project(**changed_files):
+    files = {"env/file{:02d}.yml".format(n): deployment("service{}".format(n), "master-0{}".format(n % 3))
+        for n in range(12)}
+    files["env/configmap.yml"] = "kind: ConfigMap\ndata: {key: value}\n"
+    files["env/current.yml"] = deployment("current", "TAG-2")
+    files.update(changed_files)
+    return make_project(files)
+
+class TestPipeline(GitlabTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        deployversioner.deployversioner.close_transform_pool()
+
+    def change_image_tag(self, gitlab, **kwargs):
+        return deployversioner.deployversioner.change_image_tag(
+            self.gitlab_request(gitlab), "env", "TAG-2", **kwargs)
+
+    def test_execution_modes_give_the_same_result(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            expected = self.change_image_tag(gitlab, execution="serial")
+            for execution in ["thread", "process"]:
+                with self.subTest(execution=execution):
+                    self.assertEqual(self.change_image_tag(gitlab, execution=execution), expected)
+        self.assertEqual([c["file_path"] for c in expected[0]], ["env/file{:02d}.yml".format(n) for n in range(12)])
+        self.assertEqual(expected[1], {"master-00", "master-01", "master-02"})
+
+    def test_process_execution_fills_blob_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir, FakeGitlab([get_project()]) as gitlab:
+            blob_cache = deployversioner.cache.BlobCache(cache_dir)
+            expected = self.change_image_tag(gitlab, execution="process", blob_cache=blob_cache)
+            gitlab.requests.clear()
+            result = self.change_image_tag(gitlab, execution="process", blob_cache=blob_cache)
+            self.assertEqual(len(gitlab.requests_to("/raw")), 0)
+            _, references = blob_cache.get(blob_sha(deployment("service0", "master-00")))
+        # cached files are looked up before committing instead of when they are read
+        for c in expected[0]:
+            del c["last_commit_id"]
+        self.assertEqual(result, expected)
+        self.assertEqual(len(references), 1)
+
+    def test_errors_of_rewrites_are_raised(self):
+        two_containers = deployment("service3", "master-0") + "      - image: other:1\n"
+        with FakeGitlab([get_project(**{"env/file03.yml": two_containers})]) as gitlab:
+            for execution in deployversioner.deployversioner.EXECUTION_MODES:
+                with self.subTest(execution=execution), \
+                        self.assertRaises(deployversioner.deployversioner.VersionerError):
+                    self.change_image_tag(gitlab, execution=execution)
+
+    def test_pending_fetches_are_bounded(self):
+        pending = []
+        peak = []
+        lock = threading.Lock()
+        def fetch(n):
+            with lock:
+                pending.append(n)
+                peak.append(len(pending))
+            file = {"path": "f{}.yml".format(n), "id": str(n), "type": "blob"}
+            return [deployversioner.deployversioner.FetchedBlob(file, deployment(n, "1"), None, False, None)]
+        class SlowTransforms(concurrent.futures.ThreadPoolExecutor):
+            def submit(self, fn, *args, **kwargs):
+                def transform():
+                    time.sleep(0.01)
+                    with lock:
+                        pending.pop(0)
+                    return fn(*args, **kwargs)
+                return super().submit(transform)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as io_executor, \
+                SlowTransforms(max_workers=1) as transform_executor:
+            pipeline = deployversioner.deployversioner.RewritePipeline("2", None, io_executor,
+                transform_executor, 3)
+            futures = [pipeline.submit(fetch, n) for n in range(20)]
+            results = [r for f in futures for r in f.result()]
+        self.assertLessEqual(max(peak), 3)
+        self.assertEqual([r["commit_blob"]["file_path"] for r in results], ["f{}.yml".format(n) for n in range(20)])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import os
+import tempfile
+
+import deployversioner.cli
+import deployversioner.deployversioner
+import deployversioner.plan
+
+from fakegitlab import FakeGitlab, GitlabTestCase, blob_sha, deployment, deployments, make_project
+
+def get_project():
+    files = deployments(4, lambda n: "master-0{}".format(n % 2))
+    files["env/current.yml"] = deployment("current", "TAG-2")
+    files["README.md"] = "# deploy\n"
+    return make_project(files)
+
+class TestPlan(GitlabTestCase):
+    def assert_applied(self, project):
+        for file_path, content in deployments(4, "TAG-2").items():
+            self.assertEqual(project.branches["staging"][file_path], content)
+
+    def test_plan_is_applied_without_fetching_again(self):
+        project = get_project()
+        with tempfile.TemporaryDirectory() as plan_dir, FakeGitlab([project]) as gitlab:
+            plan = deployversioner.plan.make_plan(self.gitlab_request(gitlab), "env", "TAG-2")
+            filename = os.path.join(plan_dir, "plan.json.gz")
+            deployversioner.plan.save_plan(filename, plan)
+            gitlab.requests.clear()
+            loaded = deployversioner.plan.load_plan(filename)
+            deployversioner.plan.apply_plan(loaded.gitlab_request("token"), loaded)
+        self.assertEqual(loaded.head, "0" * 40)
+        self.assertEqual(loaded.changed_image_tags, ["master-00", "master-01"])
+        self.assertEqual([f["path"] for f in loaded.files], ["env/file{}.yml".format(n) for n in range(4)])
+        self.assertEqual(loaded.files[1]["changed_image_tags"], ["master-01"])
+        self.assertEqual(loaded.files[1]["blob_id"], blob_sha(deployment("service1", "master-01")))
+        # one request for the head of the branch and one for the commit
+        self.assertEqual([method for method, _ in gitlab.requests], ["GET", "POST"])
+        self.assertEqual(len(project.commits), 1)
+        self.assert_applied(project)
+
+    def test_plan_survives_commits_to_other_files(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            plan = deployversioner.plan.make_plan(self.gitlab_request(gitlab), "env", "TAG-2")
+            project.push("staging", {"README.md": "# deploy\n\nchanged\n"})
+            deployversioner.plan.apply_plan(self.gitlab_request(gitlab), plan)
+            self.assertEqual(len(gitlab.requests_to("/repository/compare")), 1)
+        self.assertEqual(len(project.commits), 2)
+        self.assert_applied(project)
+
+    def test_out_of_date_plan_is_refused(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            plan = deployversioner.plan.make_plan(self.gitlab_request(gitlab), "env", "TAG-2")
+            project.push("staging", {"env/file2.yml": deployment("service2", "master-03")})
+            with self.assertRaisesRegex(deployversioner.deployversioner.VersionerError, "env/file2.yml"):
+                deployversioner.plan.apply_plan(self.gitlab_request(gitlab), plan)
+        self.assertEqual(len(project.commits), 1)
+
+    def test_unreadable_plan(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as fp:
+            fp.write('{"version": 0}')
+            fp.flush()
+            with self.assertRaises(deployversioner.deployversioner.VersionerError):
+                deployversioner.plan.load_plan(fp.name)
+
+    def test_plan_and_apply_commands(self):
+        project = get_project()
+        with tempfile.TemporaryDirectory() as plan_dir, FakeGitlab([project]) as gitlab:
+            filename = os.path.join(plan_dir, "plan.json")
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output), self.assertRaises(SystemExit) as e:
+                deployversioner.cli.main(["plan", "metascrum/rrflow-deploy", "env", "TAG-2", filename,
+                    "--gitlab-url", gitlab.url, "--gitlab-api-token", "token", "--no-cache"])
+            self.assertEqual(e.exception.code, 0)
+            self.assertEqual(len(project.commits), 0)
+            with self.assertRaises(SystemExit) as e:
+                deployversioner.cli.main(["apply", filename, "--gitlab-api-token", "token"])
+            self.assertEqual(e.exception.code, 0)
+        self.assertEqual(output.getvalue().splitlines()[0], "env/file0.yml: master-00 -> TAG-2")
+        self.assertEqual(len(project.commits), 1)
+        self.assert_applied(project)
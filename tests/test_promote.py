@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+
+import deployversioner.batch
+import deployversioner.cli
+import deployversioner.deployversioner
+import deployversioner.promote
+
+from fakegitlab import FakeGitlab, GitlabTestCase, PROJECT_NAME, deployment, deployments, make_project
+
+def get_project():
+    staging = deployments(6)
+    staging["env/current.yml"] = deployment("current", "TAG-2")
+    staging["README.md"] = "# deploy\n"
+    prod = dict(staging)
+    prod["env/file5.yml"] = deployment("service5", "master-00")
+    return make_project(staging, prod=prod, test=dict(staging))
+
+class TestPromote(GitlabTestCase):
+    def promote(self, gitlab, targets, **kwargs):
+        return deployversioner.promote.run_promotion(gitlab.url, "token", PROJECT_NAME, targets,
+            "TAG-2", **kwargs)
+
+    def assert_promoted(self, project, branch):
+        for file_path, content in deployments(6, "TAG-2").items():
+            self.assertEqual(project.branches[branch][file_path], content)
+
+    def test_parse_target(self):
+        self.assertEqual(deployversioner.promote.parse_target("prod:env/file1.yml"), ("prod", "env/file1.yml"))
+        self.assertEqual(deployversioner.promote.parse_target("prod:"), ("prod", ""))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            deployversioner.promote.parse_target("env/file1.yml")
+
+    def test_blobs_shared_by_branches_are_fetched_once(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            results = self.promote(gitlab, [("staging", "env"), ("prod", "env"), ("test", "env")])
+        self.assertEqual([r.outcome for r in results], [deployversioner.batch.COMMITTED] * 3)
+        self.assertEqual(len(results[1].files), 6)
+        # the 7 manifests of staging and the one of prod that differs
+        self.assertEqual(len(gitlab.requests_to("/raw")), 8)
+        self.assertEqual(len(gitlab.requests_to("/projects/metascrum")), 1)
+        self.assertEqual(sorted(c["branch"] for c in project.commits), ["prod", "staging", "test"])
+        for branch in ["staging", "prod", "test"]:
+            self.assert_promoted(project, branch)
+        prod_commit = [c for c in project.commits if c["branch"] == "prod"][0]
+        self.assertIn("master-00", prod_commit["commit_message"])
+
+    def test_targets_of_one_branch_are_committed_together(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            results = self.promote(gitlab, [("staging", "env/file0.yml"), ("staging", "env/file1.yml"),
+                ("prod", "env/file0.yml"), ("prod", "env/current.yml")])
+        self.assertEqual([r.outcome for r in results], [deployversioner.batch.COMMITTED] * 3 +
+            [deployversioner.batch.UNCHANGED])
+        self.assertEqual(len(gitlab.requests_to("/raw")), 3)
+        self.assertEqual(sorted(len(c["actions"]) for c in project.commits), [1, 2])
+
+    def test_failing_targets_dont_stop_the_others(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            results = self.promote(gitlab, [("staging", "env"), ("prod", "missing"), ("missing", "env")])
+        self.assertEqual([r.outcome for r in results], [deployversioner.batch.COMMITTED,
+            deployversioner.batch.ERROR, deployversioner.batch.ERROR])
+        self.assertEqual([c["branch"] for c in project.commits], ["staging"])
+
+    def test_dry_run(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            results = self.promote(gitlab, [("staging", "env"), ("prod", "env/file5.yml")], dry_run=True)
+        self.assertEqual([r.outcome for r in results], [deployversioner.batch.DRY_RUN] * 2)
+        self.assertEqual(results[1].files, ["env/file5.yml"])
+        self.assertEqual(len(project.commits), 0)
+
+    def test_promote_command(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output), self.assertRaises(SystemExit) as e:
+                deployversioner.cli.main(["promote", "metascrum/rrflow-deploy", "TAG-2", "staging:env", "prod:",
+                    "--gitlab-url", gitlab.url, "--gitlab-api-token", "token", "--no-cache",
+                    "--fetch-strategy", "graphql", "--graphql-batch-size", "3"])
+        self.assertEqual(e.exception.code, 0)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([(r["branch"], r["outcome"]) for r in lines], [("staging", "committed"),
+            ("prod", "committed")])
+        self.assertEqual(len(gitlab.requests_to("/raw")), 0)
+        self.assert_promoted(project, "staging")
+        self.assert_promoted(project, "prod")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+import requests
+
+import deployversioner.deployversioner
+import deployversioner.metrics
+import deployversioner.ratelimit
+
+from fakegitlab import FakeGitlab, GitlabTestCase, PROJECT_ID, deployment, deployments, make_project
+
+def get_response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = deployversioner.ratelimit.RateLimiter(4, clock=self.clock)
+
+    def request(self, status_code=200, headers=None, seconds=0.01, request_class="GET repository/tree"):
+        started = self.limiter.acquire()
+        self.clock.now += seconds
+        return self.limiter.release(started, get_response(status_code, headers), request_class)
+
+    def test_limit_grows_by_about_one_per_round(self):
+        for _ in range(5):
+            self.request()
+        self.assertEqual(int(self.limiter.limit), 5)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+    def test_limit_is_halved_once_per_round(self):
+        started = [self.limiter.acquire() for _ in range(4)]
+        self.clock.now += 0.01
+        for s in started:
+            self.limiter.release(s, get_response(502))
+        self.assertEqual(self.limiter.limit, 2)
+        # a request let through after the decrease is counted again
+        self.request(503)
+        self.assertEqual(self.limiter.limit, 1)
+        self.request(503)
+        self.assertEqual(self.limiter.limit, 1)
+
+    def test_slow_requests_decrease_limit(self):
+        self.request(seconds=0.01)
+        limit = self.limiter.limit
+        self.request(seconds=1.0)
+        self.assertEqual(self.limiter.limit, limit / 2)
+
+    def test_latencies_are_compared_per_request_class(self):
+        for _ in range(8):
+            self.request(seconds=0.01)
+            self.request(seconds=2.0, request_class="POST graphql")
+            self.request(seconds=1.0, request_class="GET repository/archive.tar.gz")
+        self.assertEqual(self.limiter.decreased_at, float("-inf"))
+        self.assertGreater(self.limiter.limit, 4)
+        limit = self.limiter.limit
+        self.request(seconds=9.0, request_class="POST graphql")
+        self.assertEqual(self.limiter.limit, limit / 2)
+
+    def test_request_class(self):
+        request_class = deployversioner.ratelimit.request_class
+        self.assertEqual(request_class("GET", "https://gitlab.url/api/v4/projects/103/repository/tree/?ref=a"),
+            "GET repository/tree")
+        self.assertEqual(request_class("HEAD", "https://gitlab.url/api/v4/projects/103/repository/files/a.yml?ref=a"),
+            "HEAD repository/files")
+        self.assertEqual(request_class("POST", "https://gitlab.url/api/graphql"), "POST graphql")
+        self.assertEqual(request_class("GET", "https://gitlab.url/api/v4/projects/metascrum%2Frrflow-deploy"),
+            "GET projects")
+
+    def test_retry_after_pauses_requests(self):
+        self.assertEqual(self.request(429, {"Retry-After": "30"}), 30)
+        self.assertEqual(self.limiter.paused_until, 130.01)
+        self.assertEqual(self.limiter.limit, 2)
+
+    def test_rate_limited_without_retry_after_backs_off(self):
+        self.assertEqual(self.request(429), 1)
+        self.clock.now += 1
+        self.assertEqual(self.request(429), 2)
+        self.clock.now += 2
+        self.request()
+        self.assertEqual(self.request(429), 1)
+
+    def test_remaining_budget_limits_concurrency(self):
+        self.request(headers={"RateLimit-Remaining": "2"})
+        self.assertEqual(self.limiter.limit, 2)
+        reset = int(time.time()) + 60
+        self.request(headers={"RateLimit-Remaining": "0", "RateLimit-Reset": str(reset)})
+        self.assertAlmostEqual(self.limiter.paused_until - self.clock.now, 60, delta=2)
+
+    def test_failed_requests_release_their_slot(self):
+        started = self.limiter.acquire()
+        self.assertIsNone(self.limiter.release(started, None))
+        self.assertEqual(self.limiter.in_flight, 0)
+        self.assertEqual(self.limiter.limit, 2)
+
+class TestRateLimitedClient(GitlabTestCase):
+    def tearDown(self):
+        super().tearDown()
+        deployversioner.metrics.disable()
+
+    def test_clients_of_one_gitlab_share_a_limiter(self):
+        first = deployversioner.deployversioner.get_client("gitlab.url", "token")
+        second = deployversioner.deployversioner.get_client("https://gitlab.url/", "other-token")
+        other = deployversioner.deployversioner.get_client("other.url", "token")
+        self.assertIs(first.limiter, second.limiter)
+        self.assertIsNot(first.limiter, other.limiter)
+
+    def test_rate_limited_requests_are_retried(self):
+        project = make_project(deployments(4))
+        recorded = deployversioner.metrics.enable()
+        with FakeGitlab([project]) as gitlab:
+            gitlab.throttled = 3
+            gitlab_request = self.gitlab_request(gitlab)
+            proposed_commits, changed_image_tags = deployversioner.deployversioner.change_image_tag(
+                gitlab_request, "env", "TAG-2")
+            gitlab.throttled = 1
+            deployversioner.deployversioner.commit_changes(gitlab_request, proposed_commits, "TAG-2",
+                changed_image_tags)
+        self.assertEqual(len(proposed_commits), 4)
+        self.assertEqual(project.branches["staging"]["env/file0.yml"], deployment("service0", "TAG-2"))
+        self.assertEqual(len(project.commits), 1)
+        http = recorded.to_json()["http"]
+        self.assertEqual(sum(stats["retries"] for stats in http.values()), 4)
+        self.assertEqual(sum(stats["status"].get("429", 0) for stats in http.values()), 4)
+
+    def test_rate_limited_commits_are_retried(self):
+        project = make_project({"a.yml": "a: 1\n"})
+        with FakeGitlab([project]) as gitlab:
+            gitlab.throttled = 1
+            client = deployversioner.deployversioner.get_client(gitlab.url, "token")
+            body = deployversioner.deployversioner.CommitBody("staging", "update", [
+                {"file_path": "a.yml", "content": "a: 2\n"}])
+            response = client.post(client.api_url("projects/{}/repository/commits".format(PROJECT_ID)),
+                headers={"Content-Type": "application/json"}, data=body)
+        # gitlab hasn't made a commit it rate limited, so it is safe to send again
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(gitlab.requests_to("/repository/commits")), 2)
+        self.assertEqual(len(project.commits), 1)
+
+    def test_rate_limited_requests_give_up(self):
+        with FakeGitlab([]) as gitlab:
+            gitlab.throttled = deployversioner.deployversioner.RATE_LIMIT_RETRIES + 1
+            client = deployversioner.deployversioner.get_client(gitlab.url, "token")
+            response = client.get(client.api_url("projects/{}".format(PROJECT_ID)))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(gitlab.requests), deployversioner.deployversioner.RATE_LIMIT_RETRIES + 1)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import asyncio
+import http.client
+import json
+
+import deployversioner.batch
+import deployversioner.deployversioner
+import deployversioner.service
+
+from fakegitlab import FakeGitlab, GitlabTestCase, deployment, make_project
+
+def get_project():
+    return make_project({
+        "services/{}.yml".format(name): deployment(name, "master-01") for name in ["a", "b", "c"]})
+
+def post(port, body, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    try:
+        connection.request("POST", "/events", json.dumps(body), headers or {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode("utf8"))
+    finally:
+        connection.close()
+
+class TestService(GitlabTestCase):
+    def run_service(self, gitlab, scenario, debounce=0.2, max_delay=5.0, secret=None):
+        r"""serve webhooks while scenario is called with the port and service, return the results"""
+        results = []
+        def run(items):
+            group_results = deployversioner.batch.run_merged_group(gitlab.url, "token", items)
+            results.extend(group_results)
+            return group_results
+        runner = deployversioner.service.Service(run, debounce, max_delay)
+        handler = deployversioner.service.WebhookHandler(runner, secret=secret)
+        async def run():
+            started = asyncio.get_running_loop().create_future()
+            task = asyncio.ensure_future(deployversioner.service.serve(runner, handler, "127.0.0.1", 0,
+                started.set_result))
+            server = await started
+            port = server.sockets[0].getsockname()[1]
+            try:
+                await scenario(port, runner)
+            finally:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        try:
+            asyncio.run(run())
+        finally:
+            runner.close()
+        return results
+
+    def test_burst_of_updates_is_one_commit(self):
+        project = get_project()
+        async def scenario(port, runner):
+            loop = asyncio.get_running_loop()
+            for name, tag in [("a", "TAG-2"), ("b", "TAG-2"), ("c", "TAG-3")]:
+                status, body = await loop.run_in_executor(None, post, port,
+                    {"project": "metascrum/rrflow-deploy", "path": "services/{}.yml".format(name), "tag": tag})
+                self.assertEqual((status, body), (202, {"queued": 1}))
+            await asyncio.sleep(0.6)
+        with FakeGitlab([project]) as gitlab:
+            results = self.run_service(gitlab, scenario)
+        self.assertEqual(len(project.commits), 1)
+        self.assertEqual(project.commits[0]["commit_message"],
+            "Bump docker tags to TAG-2, TAG-3\n\nBump docker tag from master-01 to TAG-2\n"
+            "Bump docker tag from master-01 to TAG-2\nBump docker tag from master-01 to TAG-3")
+        self.assertEqual(project.branches["staging"]["services/c.yml"], deployment("c", "TAG-3"))
+        self.assertEqual([r.outcome for r in results], [deployversioner.batch.COMMITTED] * 3)
+
+    def test_later_update_of_a_file_wins(self):
+        project = get_project()
+        async def scenario(port, runner):
+            loop = asyncio.get_running_loop()
+            status, _ = await loop.run_in_executor(None, post, port, [
+                {"project": "metascrum/rrflow-deploy", "path": "services", "tag": "TAG-2"},
+                {"project": "metascrum/rrflow-deploy", "path": "services/b.yml", "tag": "TAG-3"}])
+            self.assertEqual(status, 202)
+        with FakeGitlab([project]) as gitlab:
+            results = self.run_service(gitlab, scenario, debounce=10)
+        # pending updates are committed when the service stops
+        self.assertEqual(len(project.commits), 1)
+        self.assertEqual(project.branches["staging"]["services/a.yml"], deployment("a", "TAG-2"))
+        self.assertEqual(project.branches["staging"]["services/b.yml"], deployment("b", "TAG-3"))
+        self.assertEqual([r.files for r in results], [["services/a.yml", "services/c.yml"],
+            ["services/b.yml"]])
+
+    def test_invalid_requests_are_rejected(self):
+        project = get_project()
+        async def scenario(port, runner):
+            loop = asyncio.get_running_loop()
+            update = {"project": "metascrum/rrflow-deploy", "path": "services/a.yml", "tag": "TAG-2"}
+            status, _ = await loop.run_in_executor(None, post, port, update)
+            self.assertEqual(status, 401)
+            status, _ = await loop.run_in_executor(None, post, port, {"project": "x"},
+                {"X-Gitlab-Token": "secret"})
+            self.assertEqual(status, 400)
+            status, _ = await loop.run_in_executor(None, post, port, update, {"X-Gitlab-Token": "secret"})
+            self.assertEqual(status, 202)
+        with FakeGitlab([project]) as gitlab:
+            self.run_service(gitlab, scenario, secret="secret")
+        self.assertEqual(len(project.commits), 1)
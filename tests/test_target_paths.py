@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import tempfile
+
+import deployversioner.cache
+import deployversioner.deployversioner
+
+from fakegitlab import FakeGitlab, GitlabTestCase, deployment, make_project
+
+def get_project():
+    return make_project({
+        "prod/app.yml": deployment("app", "master-01"),
+        "prod/db/db.yml": deployment("db", "master-01"),
+        "prod-old/app.yml": deployment("old-app", "master-00"),
+        "staging/app.yml": deployment("staging-app", "master-00"),
+    })
+
+class TestTargetPaths(GitlabTestCase):
+    def change_image_tag(self, gitlab, file_object, **kwargs):
+        return deployversioner.deployversioner.change_image_tag(
+            self.gitlab_request(gitlab), file_object, "TAG-2", **kwargs)
+
+    def test_in_path(self):
+        in_path = deployversioner.deployversioner.in_path
+        self.assertTrue(in_path("prod/app.yml", "prod"))
+        self.assertTrue(in_path("prod/app.yml", "prod/"))
+        self.assertTrue(in_path("prod/app.yml", "prod/app.yml"))
+        self.assertTrue(in_path("prod/app.yml", ""))
+        self.assertFalse(in_path("prod-old/app.yml", "prod"))
+        self.assertFalse(in_path("staging/prod/app.yml", "prod"))
+        self.assertFalse(in_path("prod/app.yml.orig", "prod/app.yml"))
+
+    def test_single_file_is_changed_without_listing_the_tree(self):
+        project = get_project()
+        with FakeGitlab([project]) as gitlab:
+            commits, tags = self.change_image_tag(gitlab, "prod/app.yml")
+            last_commit_id = project.last_commit_id("staging", "prod/app.yml")
+        self.assertEqual([c["file_path"] for c in commits], ["prod/app.yml"])
+        self.assertEqual(commits[0]["last_commit_id"], last_commit_id)
+        self.assertEqual(tags, {"master-01"})
+        self.assertEqual(len(gitlab.requests_to("/repository/tree")), 0)
+        self.assertEqual([method for method, _ in gitlab.requests], ["HEAD", "GET"])
+
+    def test_cached_single_file_is_not_downloaded(self):
+        with tempfile.TemporaryDirectory() as cache_dir, FakeGitlab([get_project()]) as gitlab:
+            blob_cache = deployversioner.cache.BlobCache(cache_dir)
+            expected = self.change_image_tag(gitlab, "prod/app.yml", blob_cache=blob_cache)
+            gitlab.requests.clear()
+            result = self.change_image_tag(gitlab, "prod/app.yml", blob_cache=blob_cache)
+        self.assertEqual(result, expected)
+        self.assertEqual([method for method, _ in gitlab.requests], ["HEAD"])
+
+    def test_directory_doesnt_match_sibling_prefix(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            commits, tags = self.change_image_tag(gitlab, "prod")
+            # the directory is listed by itself, not with its siblings
+            trees = gitlab.requests_to("/repository/tree")
+        self.assertEqual(sorted(c["file_path"] for c in commits), ["prod/app.yml", "prod/db/db.yml"])
+        self.assertEqual(tags, {"master-01"})
+        self.assertTrue(all("path=prod" in path for _, path in trees))
+
+    def test_missing_targets_are_not_found(self):
+        with FakeGitlab([get_project()]) as gitlab:
+            for file_object in ["prod/missing.yml", "pro", "missing"]:
+                with self.subTest(file_object=file_object), \
+                        self.assertRaises(deployversioner.deployversioner.VersionerFileNotFound):
+                    self.change_image_tag(gitlab, file_object)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import os
+import pathlib
+import sys
+import unittest
+
+import yaml
+
+import deployversioner.deployversioner
+import deployversioner.yamlbackend
+
+FIXTURES = ["gui.yaml", "data/files-gui-yaml-response.txt",
+    "data/files-batch-exchange-sink-yaml-response.txt",
+    "data/files-cronjob-yaml-response.txt",
+    "data/files-services-dummy-sink-yaml-response.txt"]
+
+class TestYamlBackend(unittest.TestCase):
+    def setUp(self):
+        self.tests_path = get_tests_path()
+
+    def test_default_backend_prefers_libyaml(self):
+        backend = deployversioner.yamlbackend.default_backend()
+        if yaml.__with_libyaml__:
+            self.assertEqual(backend.name, "libyaml")
+        else:
+            self.assertEqual(backend.name, "pure-python")
+
+    @unittest.skipIf(deployversioner.yamlbackend.LIBYAML is None, "pyyaml is built without libyaml")
+    def test_backends_give_identical_output(self):
+        for fixture in FIXTURES:
+            with self.subTest(fixture=fixture):
+                with open(os.path.join(self.tests_path, fixture)) as fp:
+                    file_contents = fp.read()
+                results = []
+                for backend in deployversioner.yamlbackend.available_backends():
+                    in_place = deployversioner.deployversioner.rewrite_image_tags_in_place(
+                        file_contents, "TAG-2", backend)
+                    dumped = deployversioner.deployversioner.rewrite_image_tags_by_dump(
+                        file_contents, "TAG-2", backend)
+                    results.append((in_place, dumped))
+                self.assertEqual(len(results), 2)
+                self.assertEqual(results[0], results[1])
+
+def get_tests_path():
+    try:
+        # get the parent directory of the directory this file is in
+        p = pathlib.PurePath(sys.modules[__name__].__file__)
+        return str(p.parents[0])
+    except IndexError:
+        return "tests"